@@ -1,26 +1,68 @@
 import streamlit as st
-import json
 import os
 from datetime import datetime
 from uuid import uuid4
 import time
 import hashlib
+import atexit
 from dotenv import load_dotenv
-import requests
+import circuit_breaker
+import http_client
+import metrics
+import retention
+import storage
 from streamlit_google_auth import Authenticate
+from data_context import DataContext
+from message_cache import MessageCache
+from render import CHAT_CSS, render_transcript
+from user_directory import UserDirectory
+from write_behind import WriteBehindQueue
+from storage import (
+    get_user, create_user, patch_users, delete_users,
+    load_admin_settings, save_admin_settings, find_username_by_email,
+    search_global_chat, load_stats,
+)
 
 # Load environment variables
 load_dotenv()
 FIREBASE_API_KEY = os.getenv("FIREBASE_API_KEY")
-FIREBASE_DB_URL = os.getenv("FIREBASE_DB_URL")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 GOOGLE_PROJECT_ID = os.getenv("GOOGLE_PROJECT_ID", "anonymous--chats")
+# Identity Toolkit base URL; point it at firebase_emulator.py for offline runs
+FIREBASE_AUTH_URL = os.getenv("FIREBASE_AUTH_URL", "https://identitytoolkit.googleapis.com").rstrip("/")
+# Seconds before a sign-in request to Identity Toolkit gives up
+AUTH_TIMEOUT = float(os.getenv("FIREBASE_AUTH_TIMEOUT", "10"))
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "Admin")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "Shuvo@123")
 
-if FIREBASE_DB_URL and FIREBASE_DB_URL.endswith("/"):
-    FIREBASE_DB_URL = FIREBASE_DB_URL[:-1]
+# Number of messages shown in the chat window
+CHAT_WINDOW_SIZE = storage.CHAT_WINDOW_SIZE
+# Number of messages kept in the shared message cache: the window plus as
+# many again, so a cold load or resync only moves about one window. Older
+# history is paged from storage ("Load older messages").
+MAX_LOCAL_MESSAGES = 2 * CHAT_WINDOW_SIZE
+# Seconds before the shared message cache polls storage again
+MESSAGE_CACHE_TTL = 1
+# Messages that may wait in the write-behind queue before senders block
+WRITE_QUEUE_SIZE = 1000
+# Seconds before the admin user list reloads users changed elsewhere
+USER_DIRECTORY_TTL = 30
+# Admin user list: sort options (field, descending) and page sizes
+USER_SORTS = {
+    "Newest first": ("created_at", True),
+    "Oldest first": ("created_at", False),
+    "Banned first": ("status", True),
+    "Username": ("username", False),
+}
+USER_PAGE_SIZES = [25, 50, 100]
+# Port for the Prometheus /metrics endpoint; disabled when unset
+METRICS_PORT = os.getenv("METRICS_PORT")
+# Seconds between background retention passes over the message store
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "300"))
+# Seconds a rerun waits for its parallel reads before using defaults for the
+# counters and settings
+PREFETCH_TIMEOUT = float(os.getenv("PREFETCH_TIMEOUT", "2"))
 
 
 def get_google_authenticator():
@@ -71,29 +113,7 @@ def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 
-def load_users():
-    # Try Firebase first
-    if FIREBASE_DB_URL:
-        try:
-            response = requests.get(f"{FIREBASE_DB_URL}/users.json")
-            if response.status_code == 200:
-                users = response.json()
-                return users if users else {}
-        except Exception:
-            pass
-    
-    # Fallback to local
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        if os.path.exists("database/users.json"):
-            with open("database/users.json", "r") as f:
-                return json.load(f)
-        return {}
-    except Exception:
-        return {}
-
-
+@metrics.timed("auth.firebase_auth")
 def firebase_auth(email, password, mode="login"):
     """
     mode can be 'login' or 'signup'
@@ -101,7 +121,7 @@ def firebase_auth(email, password, mode="login"):
     if not FIREBASE_API_KEY:
         return {"error": "Firebase API Key not found in environment variables."}
 
-    url = f"https://identitytoolkit.googleapis.com/v1/accounts:{'signInWithPassword' if mode == 'login' else 'signUp'}?key={FIREBASE_API_KEY}"
+    url = f"{FIREBASE_AUTH_URL}/v1/accounts:{'signInWithPassword' if mode == 'login' else 'signUp'}?key={FIREBASE_API_KEY}"
     
     payload = {
         "email": email,
@@ -110,7 +130,7 @@ def firebase_auth(email, password, mode="login"):
     }
     
     try:
-        response = requests.post(url, json=payload)
+        response = http_client.post(url, json=payload, timeout=AUTH_TIMEOUT)
         data = response.json()
         
         if response.status_code == 200:
@@ -119,9 +139,11 @@ def firebase_auth(email, password, mode="login"):
             error_message = data.get("error", {}).get("message", "Unknown error")
             return {"success": False, "error": error_message}
     except Exception as e:
+        metrics.record_error()
         return {"success": False, "error": str(e)}
 
 
+@metrics.timed("auth.firebase_google_login")
 def firebase_google_login(id_token):
     """
     Authenticate with Firebase using a Google ID Token
@@ -129,7 +151,7 @@ def firebase_google_login(id_token):
     if not FIREBASE_API_KEY:
         return {"error": "Firebase API Key not found"}
 
-    url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithIdp?key={FIREBASE_API_KEY}"
+    url = f"{FIREBASE_AUTH_URL}/v1/accounts:signInWithIdp?key={FIREBASE_API_KEY}"
     
     payload = {
         "postBody": f"id_token={id_token}&providerId=google.com",
@@ -138,7 +160,7 @@ def firebase_google_login(id_token):
     }
     
     try:
-        response = requests.post(url, json=payload)
+        response = http_client.post(url, json=payload, timeout=AUTH_TIMEOUT)
         data = response.json()
         
         if response.status_code == 200:
@@ -151,149 +173,90 @@ def firebase_google_login(id_token):
         else:
             return {"success": False, "error": data.get("error", {}).get("message", "Unknown error")}
     except Exception as e:
+        metrics.record_error()
         return {"success": False, "error": str(e)}
 
 
-def load_admin_settings():
-    # Try Firebase first
-    if FIREBASE_DB_URL:
-        try:
-            response = requests.get(f"{FIREBASE_DB_URL}/admin_settings.json")
-            if response.status_code == 200:
-                settings = response.json()
-                return settings if settings else {"auto_refresh_interval": 2}
-        except Exception:
-            pass
-
-    # Fallback to local
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        if os.path.exists("database/admin_settings.json"):
-            with open("database/admin_settings.json", "r") as f:
-                return json.load(f)
-        return {"auto_refresh_interval": 2}  # Default 2 seconds
-    except Exception:
-        return {"auto_refresh_interval": 2}
-
-
-def save_admin_settings(settings):
-    # Save to Firebase
-    if FIREBASE_DB_URL:
-        try:
-            requests.put(f"{FIREBASE_DB_URL}/admin_settings.json", json=settings)
-        except Exception:
-            pass
-
-    # Save to local
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        with open("database/admin_settings.json", "w") as f:
-            json.dump(settings, f, indent=2)
-    except Exception:
-        pass
-
-
-def save_users(users):
-    # Save to Firebase
-    if FIREBASE_DB_URL:
-        try:
-            requests.put(f"{FIREBASE_DB_URL}/users.json", json=users)
-        except Exception:
-            pass
-
-    # Save to local
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        with open("database/users.json", "w") as f:
-            json.dump(users, f, indent=2)
-    except Exception:
-        pass
+@st.cache_resource
+def get_write_queue():
+    # One background writer per process, drained when the server shuts down
+    write_queue = WriteBehindQueue(storage.append_global_chat_messages,
+                                   max_size=WRITE_QUEUE_SIZE)
+    atexit.register(write_queue.close)
+    return write_queue
 
 
+@metrics.timed("app.save_global_chat_message")
 def save_global_chat_message(message):
-    # Save to Firebase
-    if FIREBASE_DB_URL:
-        try:
-            # In Realtime DB, we can use POST to push to a list
-            requests.post(f"{FIREBASE_DB_URL}/messages.json", json=message)
-        except Exception:
-            pass
-
-    # Save to local
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-
-        global_chat_file = "database/global_chat.json"
-
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "r") as f:
-                global_chat = json.load(f)
-        else:
-            global_chat = {"messages": []}
-
-        global_chat["messages"].append(message)
+    # Show the message right away; storage is written by the background queue
+    get_message_cache().add(message)
+    if not get_write_queue().submit(message):
+        # Queue is full or closed: fall back to a synchronous write
+        storage.save_global_chat_message(message)
 
-        # Keep only last 1000 messages
-        if len(global_chat["messages"]) > 1000:
-            global_chat["messages"] = global_chat["messages"][-1000:]
 
-        with open(global_chat_file, "w") as f:
-            json.dump(global_chat, f, indent=2)
-    except Exception:
-        pass
+@st.cache_resource
+def get_message_cache():
+    # Shared by all sessions of this process
+    return MessageCache(storage.fetch_global_chat, max_messages=MAX_LOCAL_MESSAGES,
+                        ttl=MESSAGE_CACHE_TTL)
 
 
+@metrics.timed("app.load_global_chat")
 def load_global_chat():
-    # Try Firebase first
-    if FIREBASE_DB_URL:
-        try:
-            response = requests.get(f"{FIREBASE_DB_URL}/messages.json")
-            if response.status_code == 200:
-                messages_dict = response.json()
-                if messages_dict:
-                    # Convert dict values to list if it's a dict of pushed items
-                    if isinstance(messages_dict, dict):
-                        return list(messages_dict.values())
-                    return messages_dict
-        except Exception:
-            pass
-
-    # Fallback to local
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-
-        global_chat_file = "database/global_chat.json"
-
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "r") as f:
-                global_chat = json.load(f)
-            return global_chat.get("messages", [])
-        return []
-    except Exception:
-        return []
+    return list(get_message_cache().snapshot()[1])
+
+
+@st.cache_resource
+def get_user_directory():
+    # Sorted user indexes shared by all admin sessions of this process
+    return UserDirectory(storage.load_users, ttl=USER_DIRECTORY_TTL)
+
+
+@st.cache_resource
+def get_retention_job():
+    # One compaction thread per process
+    job = retention.RetentionJob(interval=RETENTION_INTERVAL)
+    atexit.register(job.stop)
+    return job
+
+
+@st.cache_resource
+def get_metrics_server():
+    # One /metrics endpoint per process
+    return metrics.serve(int(METRICS_PORT))
+
+
+@metrics.timed("app.load_older_messages")
+def load_older_messages(window):
+    """Fetch the page before the oldest message shown ("Load older messages")."""
+    history = st.session_state.get("chat_history")
+    if history is None:
+        # First page: continue from the oldest shown message that has a
+        # cursor (ones sent by this process may not be stored yet)
+        cursor = next((c for c in map(storage.message_cursor, window) if c is not None), None)
+        history = {
+            "messages": [],
+            "cursor": cursor,
+            "more": cursor is not None,
+            "anchor": window[0].get("message_id") if window else None,
+        }
+    if history["more"]:
+        page = storage.fetch_global_chat_before(history["cursor"], CHAT_WINDOW_SIZE)
+        shown = {m.get("message_id") for m in window}
+        shown.update(m.get("message_id") for m in history["messages"])
+        older = [m for m in page["messages"] if m.get("message_id") not in shown]
+        history = {**history, "messages": older + history["messages"],
+                   "cursor": page["cursor"], "more": page["more"]}
+    st.session_state.chat_history = history
 
 
+@metrics.timed("app.clear_global_chat")
 def clear_global_chat():
-    # Clear Firebase
-    if FIREBASE_DB_URL:
-        try:
-            requests.delete(f"{FIREBASE_DB_URL}/messages.json")
-        except Exception:
-            pass
-
-    # Clear Local
-    try:
-        global_chat_file = "database/global_chat.json"
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "w") as f:
-                json.dump({"messages": []}, f, indent=2)
-    except Exception:
-        pass
+    # Let queued sends land first so they are cleared as well
+    get_write_queue().drain()
+    storage.clear_global_chat()
+    get_message_cache().reset()
 
 
 def initialize_session():
@@ -313,12 +276,43 @@ def initialize_session():
         st.session_state.current_user = None
     if "is_admin" not in st.session_state:
         st.session_state.is_admin = False
-    if "last_global_check" not in st.session_state:
-        st.session_state.last_global_check = time.time()
     if "manual_logout" not in st.session_state:
         st.session_state.manual_logout = False
 
 
+def find_or_create_email_user(email, name=None):
+    """
+    Username for a Firebase-authenticated ``email``, creating a profile on
+    the first login. Returns ``(username, created)``. A profile is never
+    overwritten: when the username derived from the email belongs to someone
+    else, a number is appended.
+    """
+    username = find_username_by_email(email)
+    if username:
+        return username, False
+    base = email.split("@")[0]
+    suffix = 1
+    while True:
+        username = base if suffix == 1 else f"{base}{suffix}"
+        if create_user(username, {
+            "name": name or username,
+            "email": email,
+            "status": "active",
+            "created_at": datetime.now().isoformat(),
+            "last_login": datetime.now().isoformat()
+        }):
+            return username, True
+        existing = get_user(username)
+        if existing is None:
+            # Storage unreachable; nothing was written
+            return None, False
+        if storage.email_key(existing.get("email") or "") == storage.email_key(email):
+            # Their own profile, missing from the email index
+            storage.index_user_email(email, username)
+            return username, False
+        suffix += 1
+
+
 def login_form():
     st.markdown("""
         <div style='text-align: center; margin-bottom: 2rem;'>
@@ -344,52 +338,32 @@ def login_form():
                     if FIREBASE_API_KEY:
                         result = firebase_auth(email, password, mode="login")
                         if result.get("success"):
-                            # Find username by email
-                            users = load_users()
-                            username = None
-                            for uname, udata in users.items():
-                                if udata.get("email") == email:
-                                    username = uname
-                                    break
-                            
-                            if username:
-                                if users[username].get("status", "active") == "banned":
-                                    st.error("Your account has been banned. Please contact admin.")
-                                else:
-                                    st.session_state.authenticated = True
-                                    st.session_state.current_user = username
-                                    st.session_state.is_admin = False
-                                    st.success("Login successful! Redirecting...")
-                                    time.sleep(1)
-                                    st.rerun()
+                            # Find the profile by email; the first login creates one
+                            username, created = find_or_create_email_user(email)
+                            user = get_user(username) if username else None
+
+                            if not username:
+                                st.error("Your profile could not be loaded. Please try again.")
+                            elif user and user.get("status", "active") == "banned":
+                                st.error("Your account has been banned. Please contact admin.")
                             else:
-                                # First time login with this email but no local profile
-                                # Create a default username from email
-                                username = email.split("@")[0]
-                                users[username] = {
-                                    "name": username,
-                                    "email": email,
-                                    "status": "active",
-                                    "created_at": datetime.now().isoformat(),
-                                    "last_login": datetime.now().isoformat()
-                                }
-                                save_users(users)
                                 st.session_state.authenticated = True
                                 st.session_state.current_user = username
                                 st.session_state.is_admin = False
-                                st.success("Logged in and profile created!")
+                                st.success("Logged in and profile created!" if created
+                                           else "Login successful! Redirecting...")
                                 time.sleep(1)
                                 st.rerun()
                         else:
                             st.error(f"Login failed: {result.get('error')}")
                     else:
                         # Fallback to local authentication (username instead of email)
-                        users = load_users()
                         username = email # Treatment of email field as username for fallback
-                        if username in users:
-                            stored_password = users[username].get("password")
+                        user = get_user(username)
+                        if user:
+                            stored_password = user.get("password")
                             if stored_password == hash_password(password):
-                                if users[username].get("status", "active") == "banned":
+                                if user.get("status", "active") == "banned":
                                     st.error("Your account has been banned.")
                                 else:
                                     st.session_state.authenticated = True
@@ -416,16 +390,13 @@ def login_form():
                         if FIREBASE_API_KEY:
                             result = firebase_auth(new_email, new_password, mode="signup")
                             if result.get("success"):
-                                users = load_users()
-                                if new_username not in users:
-                                    users[new_username] = {
-                                        "name": new_name,
-                                        "email": new_email,
-                                        "status": "active",
-                                        "created_at": datetime.now().isoformat(),
-                                        "last_login": datetime.now().isoformat()
-                                    }
-                                    save_users(users)
+                                if create_user(new_username, {
+                                    "name": new_name,
+                                    "email": new_email,
+                                    "status": "active",
+                                    "created_at": datetime.now().isoformat(),
+                                    "last_login": datetime.now().isoformat()
+                                }):
                                     st.session_state.authenticated = True
                                     st.session_state.current_user = new_username
                                     st.session_state.is_admin = False
@@ -438,17 +409,14 @@ def login_form():
                                 st.error(f"SignUp failed: {result.get('error')}")
                         else:
                             # Fallback local signup
-                            users = load_users()
-                            if new_username not in users:
-                                users[new_username] = {
-                                    "name": new_name,
-                                    "email": new_email,
-                                    "password": hash_password(new_password),
-                                    "status": "active",
-                                    "created_at": datetime.now().isoformat(),
-                                    "last_login": datetime.now().isoformat()
-                                }
-                                save_users(users)
+                            if create_user(new_username, {
+                                "name": new_name,
+                                "email": new_email,
+                                "password": hash_password(new_password),
+                                "status": "active",
+                                "created_at": datetime.now().isoformat(),
+                                "last_login": datetime.now().isoformat()
+                            }):
                                 st.session_state.authenticated = True
                                 st.session_state.current_user = new_username
                                 st.session_state.is_admin = False
@@ -525,24 +493,11 @@ def login_form():
                         email = user_info.get('email')
                         name = user_info.get('name', user_info.get('given_name', email.split('@')[0]))
                         
-                        users = load_users()
-                        username = None
-                        for uname, udata in users.items():
-                            if udata.get("email") == email:
-                                username = uname
-                                break
-                        
+                        username, _ = find_or_create_email_user(email, name)
                         if not username:
-                            username = email.split("@")[0]
-                            users[username] = {
-                                "name": name,
-                                "email": email,
-                                "status": "active",
-                                "created_at": datetime.now().isoformat(),
-                                "last_login": datetime.now().isoformat()
-                            }
-                            save_users(users)
-                        
+                            st.error("Your profile could not be loaded. Please try again.")
+                            st.stop()
+
                         st.session_state.authenticated = True
                         st.session_state.current_user = username
                         st.session_state.is_admin = False
@@ -572,78 +527,203 @@ def logout():
     st.rerun()
 
 
-def admin_panel():
-    st.title("Admin Panel")
+def update_users(updates):
+    directory = get_user_directory()
+    # The directory's copies spare the backend reading the users first
+    before = {}
+    for path in updates:
+        username = path.strip("/").partition("/")[0]
+        user_data = directory.get(username)
+        if user_data is not None:
+            before[username] = user_data
+    patch_users(updates, before)
+    directory.apply(updates)
 
-    tab1, tab2, tab3 = st.tabs(["User Management", "Chat Management", "Settings"])
 
-    with tab1:
-        st.subheader("User Management")
+def remove_users(usernames):
+    directory = get_user_directory()
+    delete_users({username: directory.get(username) for username in usernames})
+    directory.apply({username: None for username in usernames})
 
-        users = load_users()
 
-        if users:
-            for username, user_data in users.items():
-                col1, col2, col3, col4 = st.columns([2, 1.5, 1, 1])
+def clear_user_selection(usernames):
+    for username in usernames:
+        st.session_state.pop(f"select_{username}", None)
 
-                with col1:
-                    st.write(f"**{user_data['name']}** ({username})")
-                    st.caption(user_data['email'])
-                    created_at = user_data.get('created_at', 'Unknown')
-                    if created_at != 'Unknown':
-                        try:
-                            created_dt = datetime.fromisoformat(created_at)
-                            created_at = created_dt.strftime('%m/%d/%Y %H:%M')
-                        except:
-                            pass
-                    st.caption(f"Created: {created_at}")
 
-                with col2:
-                    status = user_data.get('status', 'active')
-                    if status == 'active':
-                        st.success("🟢 Active")
-                    else:
-                        st.error("🔴 Banned")
+def set_users_status(usernames, status):
+    update_users({f"{username}/status": status for username in usernames})
+    clear_user_selection(usernames)
+    action = "banned" if status == "banned" else "unbanned"
+    st.session_state.user_notice = f"{len(usernames)} user(s) {action}"
 
-                with col3:
-                    if user_data.get('status', 'active') == 'active':
-                        if st.button("Ban", key=f"ban_{username}"):
-                            users[username]['status'] = 'banned'
-                            save_users(users)
-                            st.success(f"User {username} has been banned")
-                            st.rerun()
-                    else:
-                        if st.button("Unban", key=f"unban_{username}"):
-                            users[username]['status'] = 'active'
-                            save_users(users)
-                            st.success(f"User {username} has been unbanned")
-                            st.rerun()
-
-                with col4:
-                    if st.button("Delete", key=f"delete_{username}"):
-                        del users[username]
-                        save_users(users)
-                        st.success(f"User {username} has been deleted")
-                        st.rerun()
 
-                st.divider()
-        else:
-            st.info("No users found")
+def delete_selected_users(usernames):
+    remove_users(usernames)
+    clear_user_selection(usernames)
+    st.session_state.user_notice = f"{len(usernames)} user(s) deleted"
+
+
+def reset_user_page():
+    st.session_state.user_page = 0
+
+
+def user_management():
+    directory = get_user_directory()
+
+    notice = st.session_state.pop("user_notice", None)
+    if notice:
+        st.success(notice)
+
+    col1, col2, col3, col4 = st.columns([3, 2, 1, 1])
+    with col1:
+        query = st.text_input("Search users", key="user_search", on_change=reset_user_page,
+                              placeholder="Start of a username, name or email")
+    with col2:
+        sort_label = st.selectbox("Sort by", list(USER_SORTS), key="user_sort", on_change=reset_user_page)
+    with col3:
+        page_size = st.selectbox("Per page", USER_PAGE_SIZES, key="user_page_size", on_change=reset_user_page)
+    with col4:
+        st.write("")
+        st.button("Reload", key="reload_users", on_click=directory.refresh, args=(True,),
+                  help="Pick up users changed by other app instances now")
+
+    sort, descending = USER_SORTS[sort_label]
+    page = st.session_state.get("user_page", 0)
+    users_page, total = directory.page(query, sort, descending, page * page_size, page_size)
+    if not users_page and page:
+        # The page emptied out (deletes, another search): go back to the last one
+        page = st.session_state.user_page = max(0, (total - 1) // page_size)
+        users_page, total = directory.page(query, sort, descending, page * page_size, page_size)
+
+    if not users_page:
+        st.info("No users found")
+        return
+
+    selected = [u for u, _ in users_page if st.session_state.get(f"select_{u}")]
+    col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
+    with col1:
+        st.caption(f"Showing {page * page_size + 1}–{page * page_size + len(users_page)} of {total} • "
+                   f"{len(selected)} selected")
+    with col2:
+        st.button("Ban selected", key="ban_selected", disabled=not selected,
+                  on_click=set_users_status, args=(selected, "banned"))
+    with col3:
+        st.button("Unban selected", key="unban_selected", disabled=not selected,
+                  on_click=set_users_status, args=(selected, "active"))
+    with col4:
+        st.button("Delete selected", key="delete_selected", disabled=not selected,
+                  on_click=delete_selected_users, args=(selected,))
+
+    for username, user_data in users_page:
+        col0, col1, col2, col3, col4 = st.columns([0.3, 2, 1.5, 1, 1])
+
+        with col0:
+            st.checkbox("Select", key=f"select_{username}", label_visibility="collapsed")
+
+        with col1:
+            st.write(f"**{user_data.get('name', username)}** ({username})")
+            st.caption(user_data.get('email', ''))
+            created_at = user_data.get('created_at', 'Unknown')
+            if created_at != 'Unknown':
+                try:
+                    created_dt = datetime.fromisoformat(created_at)
+                    created_at = created_dt.strftime('%m/%d/%Y %H:%M')
+                except:
+                    pass
+            st.caption(f"Created: {created_at}")
+
+        with col2:
+            status = user_data.get('status', 'active')
+            if status == 'active':
+                st.success("🟢 Active")
+            else:
+                st.error("🔴 Banned")
+
+        with col3:
+            if user_data.get('status', 'active') == 'active':
+                st.button("Ban", key=f"ban_{username}",
+                          on_click=set_users_status, args=([username], 'banned'))
+            else:
+                st.button("Unban", key=f"unban_{username}",
+                          on_click=set_users_status, args=([username], 'active'))
+
+        with col4:
+            st.button("Delete", key=f"delete_{username}",
+                      on_click=delete_selected_users, args=([username],))
+
+        st.divider()
+
+    col1, col2, col3 = st.columns([1, 2, 1])
+    last_page = (total - 1) // page_size
+    with col1:
+        st.button("◀ Previous", key="users_previous", disabled=page == 0,
+                  on_click=st.session_state.__setitem__, args=("user_page", page - 1))
+    with col2:
+        st.caption(f"Page {page + 1} of {last_page + 1}")
+    with col3:
+        st.button("Next ▶", key="users_next", disabled=page >= last_page,
+                  on_click=st.session_state.__setitem__, args=("user_page", page + 1))
+
+
+def admin_panel(ctx):
+    st.title("Admin Panel")
+
+    tab1, tab2, tab3, tab4 = st.tabs(["User Management", "Chat Management", "Settings", "Performance"])
+
+    with tab1:
+        st.subheader("User Management")
+        # Clicks in the list rerun only the list
+        st.fragment(user_management)()
 
     with tab2:
         st.subheader("Chat Management")
 
-        global_messages = load_global_chat()
+        global_messages = ctx.messages
 
         col1, col2 = st.columns([1, 1])
         with col1:
-            st.metric("Total Messages", len(global_messages))
+            st.metric("Total Messages", ctx.stats["messages"])
         with col2:
             if st.button("Clear All Messages", type="secondary"):
                 clear_global_chat()
                 st.success("All messages cleared!")
                 st.rerun()
 
+        write_stats = get_write_queue().metrics()
+        col1, col2, col3 = st.columns([1, 1, 1])
+        with col1:
+            st.metric("Write Queue Depth", write_stats["depth"])
+        with col2:
+            st.metric("Last Flush", f"{write_stats['last_flush_ms']:.1f} ms")
+        with col3:
+            st.metric("Avg Flush", f"{write_stats['avg_flush_ms']:.1f} ms")
+        st.caption(
+            f"{write_stats['flushed']} messages written in {write_stats['batches']} batches • "
+            f"{write_stats['failed']} failed ({write_stats['retries']} retries) • {write_stats['rejected']} sent synchronously (queue full)"
+        )
+
+        st.subheader("Search Messages")
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            search_query = st.text_input(
+                "Search", key="message_search",
+                placeholder='words, "exact phrase", user:username',
+            )
+        with col2:
+            search_user = st.text_input("User ID", key="message_search_user")
+        if search_query.strip() or search_user.strip():
+            started = time.perf_counter()
+            results = search_global_chat(search_query, search_user.strip() or None)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            st.caption(f"{len(results)} match(es), newest first • {elapsed_ms:.2f} ms")
+            for msg in results:
+                col1, col2 = st.columns([2, 4])
+                with col1:
+                    st.text(f"[{msg.get('timestamp', 'Unknown')}]")
+                with col2:
+                    st.text(f"{msg.get('user_id', 'Unknown')}: {msg.get('content', '')}")
+
         st.subheader("Recent Messages")
         if global_messages:
             # Show last 20 messages
@@ -665,7 +745,12 @@ def admin_panel():
     with tab3:
         st.subheader("Application Settings")
 
-        admin_settings = load_admin_settings()
+        admin_settings = ctx.settings
+        # Saving writes the whole settings dict, so defaults standing in for a
+        # slow read must never be saved over the stored settings
+        settings_loaded = "settings" not in ctx.timed_out
+        if not settings_loaded:
+            st.warning("Settings are still loading; showing defaults. Saving is disabled until the next refresh.")
 
         # Auto-refresh interval setting
         st.markdown("**Auto-Refresh Settings**")
@@ -677,10 +762,11 @@ def admin_panel():
             max_value=10,
             value=current_interval,
             step=1,
-            help="How often the chat refreshes automatically for all users"
+            help="How often the chat refreshes automatically for all users",
+            disabled=not settings_loaded,
         )
 
-        if new_interval != current_interval:
+        if settings_loaded and new_interval != current_interval:
             admin_settings["auto_refresh_interval"] = new_interval
             save_admin_settings(admin_settings)
             st.success(f"Auto-refresh interval updated to {new_interval} seconds!")
@@ -688,83 +774,211 @@ def admin_panel():
 
         st.info(f"Current auto-refresh interval: {current_interval} seconds")
 
+        st.markdown("---")
+        st.markdown("**Message Retention**")
+        retention_settings = {**retention.RETENTION_DEFAULTS, **admin_settings}
+        with st.form("retention_settings"):
+            max_messages = st.number_input("Keep at most this many messages (0 = no limit)",
+                                           min_value=0, step=100,
+                                           value=int(retention_settings["retention_max_messages"]))
+            max_age_days = st.number_input("Delete messages older than this many days (0 = never)",
+                                           min_value=0.0, step=1.0,
+                                           value=float(retention_settings["retention_max_age_days"]))
+            max_mb = st.number_input("Limit the local message store to this many MB (0 = no limit)",
+                                     min_value=0.0, step=10.0,
+                                     value=float(retention_settings["retention_max_mb"]))
+            if st.form_submit_button("Save Retention Settings", disabled=not settings_loaded):
+                admin_settings["retention_max_messages"] = int(max_messages)
+                admin_settings["retention_max_age_days"] = max_age_days
+                admin_settings["retention_max_mb"] = max_mb
+                save_admin_settings(admin_settings)
+                st.success("Retention settings saved; they apply on the next compaction pass.")
+
+        if st.button("Run Compaction Now"):
+            get_retention_job().run_now()
+        last_run = get_retention_job().last_result
+        if last_run:
+            finished = datetime.fromtimestamp(last_run["finished_at"]).strftime("%H:%M:%S")
+            st.caption(f"Last compaction at {finished}: {last_run['removed']} message(s) archived "
+                       f"in {last_run['duration_ms']:.0f} ms • runs every {RETENTION_INTERVAL:.0f}s")
+
         st.markdown("---")
         st.markdown("System Information")
         st.metric("Current Refresh Rate", f"{current_interval}s")
-        st.metric("Active Users", len(load_users()))
-        st.metric("Total Messages", len(load_global_chat()))
+        stats = ctx.stats
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Registered Users", stats["users"])
+        with col2:
+            st.metric("Banned Users", stats["banned"])
+        with col3:
+            st.metric("Total Messages", stats["messages"])
+        top_senders = sorted(stats["messages_per_user"].items(), key=lambda item: item[1], reverse=True)
+        if top_senders:
+            st.markdown("Top Senders")
+            st.dataframe(
+                [{"User ID": user_id, "Messages": count} for user_id, count in top_senders[:10]],
+                use_container_width=True, hide_index=True,
+            )
+
+    with tab4:
+        st.subheader("Performance")
+
+        operations = metrics.snapshot()
+        if operations:
+            st.dataframe(
+                [
+                    {
+                        "Operation": name,
+                        "Calls": op["calls"],
+                        "Errors": op["errors"],
+                        "Fallbacks": op["fallbacks"],
+                        "Mean (ms)": round(op["mean_ms"], 1),
+                        "p50 (ms)": op["p50_ms"],
+                        "p95 (ms)": op["p95_ms"],
+                        "p99 (ms)": op["p99_ms"],
+                        "Max (ms)": round(op["max_ms"], 1),
+                        "Sent (KB)": round(op["bytes_sent"] / 1024, 1),
+                        "Received (KB)": round(op["bytes_received"] / 1024, 1),
+                    }
+                    for name, op in operations.items()
+                ],
+                hide_index=True,
+                use_container_width=True,
+            )
+            st.caption("Percentiles are histogram bucket upper bounds. Fallbacks are calls served "
+                       "from local storage because Firebase was unavailable.")
+        else:
+            st.info("No storage calls recorded yet")
+
+        connections = http_client.connection_stats()
+        if connections:
+            st.caption("HTTP connections opened: " +
+                       ", ".join(f"{host}: {count}" for host, count in connections.items()))
+
+        breakers = circuit_breaker.all_stats()
+        if breakers:
+            st.markdown("**Circuit Breakers**")
+            st.dataframe(
+                [
+                    {
+                        "Dependency": name,
+                        "State": stats["state"],
+                        "Consecutive Failures": stats["consecutive_failures"],
+                        "Times Opened": stats["times_opened"],
+                        "Calls Sent to Fallback": stats["rejected_calls"],
+                        "Next Probe (s)": stats["retry_in_s"],
+                        "Last Failure": (datetime.fromtimestamp(stats["last_failure"]).strftime("%H:%M:%S")
+                                         if stats["last_failure"] else "-"),
+                    }
+                    for name, stats in breakers.items()
+                ],
+                hide_index=True,
+                use_container_width=True,
+            )
+            if any(stats["state"] != circuit_breaker.CLOSED for stats in breakers.values()):
+                if st.button("Close Breakers", help="Retry Firebase right away instead of waiting for the next probe"):
+                    for name in breakers:
+                        circuit_breaker.get_breaker(name).reset()
+                    st.rerun()
+
+        mirror = getattr(storage.get_backend(), "mirror", None)
+        if mirror is not None:
+            st.markdown("**Firebase Stream**")
+            st.dataframe(
+                [
+                    {
+                        "Path": f"/{path}",
+                        "Synced": stats["synced"],
+                        "Children": stats["children"],
+                        "Events": stats["events"],
+                        "Connects": stats["connects"],
+                        "Last Event (s ago)": stats["last_event_age_s"],
+                    }
+                    for path, stats in mirror.stats().items()
+                ],
+                hide_index=True,
+                use_container_width=True,
+            )
+            st.caption("Synced paths are read from the stream mirror without any request; "
+                       "the others fall back to REST reads until the stream reconnects.")
 
+        col1, col2 = st.columns([1, 1])
+        with col1:
+            st.download_button("Export (Prometheus)", metrics.to_prometheus(),
+                               file_name="metrics.prom", mime="text/plain")
+        with col2:
+            if st.button("Reset Metrics"):
+                metrics.reset()
+                st.rerun()
 
-def global_chat_interface():
-    # Custom CSS for chat styling
-    st.markdown("""
-    <style>
-    .chat-container {
-        display: flex;
-        flex-direction: column;
-        gap: 1rem;
-    }
-    .message-row-right {
-        display: flex;
-        justify-content: flex-end;
-        width: 100%;
-    }
-    .message-row-left {
-        display: flex;
-        justify-content: flex-start;
-        width: 100%;
-    }
-    .message-content {
-        max-width: 70%;
-        padding: 0.75rem;
-        border-radius: 0.5rem;
-        margin: 0.25rem;
-        background-color: var(--background-color);
-        border: 1px solid var(--border-color);
-        color: var(--text-color);
-    }
-    .message-time {
-        font-size: 0.8rem;
-        color: var(--secondary-text-color);
-        margin-top: 0.25rem;
-    }
 
-    /* Light mode */
-    [data-theme="light"] .message-content {
-        --background-color: #f8f9fa;
-        --border-color: #e9ecef;
-        --text-color: #333;
-        --secondary-text-color: #666;
-    }
+def message_counter(prefetched):
+    # The full run hands over its prefetched counters; the fragment's own
+    # timed reruns read fresh ones
+    stats = prefetched.pop("stats", None) or load_stats()
+    st.metric("Total Messages", stats["messages"])
+
+
+def message_pane(current_user, refresh_interval, prefetched):
+    # Runs as a fragment: periodic refreshes re-execute only this pane. The
+    # snapshot comes from the shared cache, which polls storage at most once
+    # per MESSAGE_CACHE_TTL for all sessions, and unchanged messages reuse
+    # their rendered HTML.
+    _, cached_messages = get_message_cache().snapshot()
+    global_messages = cached_messages[-CHAT_WINDOW_SIZE:]
+    stats = prefetched.pop("stats", None) or load_stats()
+
+    # Older pages stay above the window they were loaded from, which keeps
+    # growing with new messages instead of sliding past them
+    history = st.session_state.get("chat_history")
+    if history is not None:
+        start = next((i for i, m in enumerate(cached_messages)
+                      if m.get("message_id") == history["anchor"]), None)
+        if start is None:
+            # So many new messages arrived that the cache no longer reaches
+            # back to the loaded pages: return to the latest window
+            st.session_state.pop("chat_history", None)
+            history = None
+        else:
+            global_messages = history["messages"] + list(cached_messages[start:])
 
-    /* Dark mode */
-    [data-theme="dark"] .message-content,
-    .stApp[data-theme="dark"] .message-content,
-    .message-content {
-        background-color: #2b2b2b !important;
-        border: 1px solid #404040 !important;
-        color: #ffffff !important;
-    }
+    if global_messages:
+        st.subheader("")
 
-    [data-theme="dark"] .message-time,
-    .stApp[data-theme="dark"] .message-time,
-    .message-time {
-        color: #cccccc !important;
-    }
+        # Status info
+        col1_status, col2_status = st.columns([2, 1])
+        with col1_status:
+            st.info(f" {stats['messages']} messages • Auto-refresh: ON ({refresh_interval}s)")
+        with col2_status:
+            current_time_str = datetime.now().strftime("%H:%M:%S")
+            st.caption(f"Last update: {current_time_str}")
 
-    /* Fallback for any theme */
-    @media (prefers-color-scheme: dark) {
-        .message-content {
-            background-color: #2b2b2b !important;
-            border: 1px solid #404040 !important;
-            color: #ffffff !important;
-        }
-        .message-time {
-            color: #cccccc !important;
-        }
-    }
-    </style>
-    """, unsafe_allow_html=True)
+        # With fewer messages than a window the cache already holds them all
+        if history is None:
+            has_older = len(cached_messages) >= CHAT_WINDOW_SIZE
+        else:
+            has_older = history["more"]
+        col1_history, col2_history = st.columns([2, 1])
+        with col1_history:
+            if has_older:
+                st.button("Load older messages", key="load_older",
+                          on_click=load_older_messages, args=(global_messages,))
+        with col2_history:
+            if history is not None:
+                st.button("Back to latest", key="back_to_latest",
+                          on_click=st.session_state.pop, args=("chat_history", None))
+
+        # Message display: one element, fragments rendered once per message
+        st.markdown(render_transcript(global_messages, current_user), unsafe_allow_html=True)
+    else:
+        st.markdown("Welcome to Anonymous Chat!")
+
+
+def global_chat_interface(ctx):
+    # Auto-refresh settings
+    admin_settings = ctx.settings
+    refresh_interval = admin_settings.get("auto_refresh_interval", 2)
 
     # Header
     col1, col2 = st.columns([3, 1])
@@ -782,10 +996,9 @@ def global_chat_interface():
         st.title("Chat Info")
 
         # User info
-        users = load_users()
-        if st.session_state.current_user in users:
-            user_name = users[st.session_state.current_user]["name"]
-            st.success(f"Welcome, {user_name}")
+        user = ctx.user
+        if user:
+            st.success(f"Welcome, {user['name']}")
         else:
             st.success(f"Welcome, {st.session_state.current_user}")
 
@@ -797,87 +1010,35 @@ def global_chat_interface():
 
         st.markdown("---")
 
-        # Chat statistics
-        global_messages = load_global_chat()
-        st.metric("Total Messages", len(global_messages))
-        st.metric("Online Users", len(users))
+        # Chat statistics; the message count refreshes on its own
+        stats = ctx.stats
+        prefetched = {} if "stats" in ctx.timed_out else {"stats": stats}
+        st.fragment(message_counter, run_every=refresh_interval)(prefetched)
+        st.metric("Registered Users", stats["users"])
 
         # Admin can see auto-refresh settings, users cannot
         if st.session_state.is_admin:
-            admin_settings = load_admin_settings()
-            refresh_interval = admin_settings.get("auto_refresh_interval", 2)
             st.info(f"Auto-refresh: {refresh_interval}s")
 
         if st.button("Refresh Now"):
             st.rerun()
 
+        if ctx.timed_out:
+            st.caption(f"Still loading: {', '.join(sorted(ctx.timed_out))}; "
+                       "showing defaults until the next refresh.")
+
     # Check if user is banned
-    users = load_users()
-    if (st.session_state.current_user in users and
-            users[st.session_state.current_user].get("status", "active") == "banned"):
+    if ctx.user and ctx.user.get("status", "active") == "banned":
         st.error("Your account has been banned. You cannot send messages.")
         st.stop()
 
-    # Auto-refresh logic
-    admin_settings = load_admin_settings()
-    refresh_interval = admin_settings.get("auto_refresh_interval", 2)
-
-    current_time = time.time()
-    time_since_last_check = current_time - st.session_state.last_global_check
-
-    if time_since_last_check >= refresh_interval:
-        st.session_state.last_global_check = current_time
-        st.rerun()
-
     # Load and display messages
-    global_messages = load_global_chat()
     current_user = st.session_state.current_user
+    prefetched = {} if "stats" in ctx.timed_out else {"stats": ctx.stats}
+    # The stylesheet is sent once per page, not with every pane refresh
+    st.markdown(CHAT_CSS, unsafe_allow_html=True)
+    st.fragment(message_pane, run_every=refresh_interval)(current_user, refresh_interval, prefetched)
 
-    if global_messages:
-        st.subheader("")
-
-        # Status info
-        col1_status, col2_status = st.columns([2, 1])
-        with col1_status:
-            st.info(f" {len(global_messages)} messages • Auto-refresh: ON ({refresh_interval}s)")
-        with col2_status:
-            current_time_str = datetime.now().strftime("%H:%M:%S")
-            st.caption(f"Last update: {current_time_str}")
-
-        # Message display
-        st.markdown('<div class="chat-container">', unsafe_allow_html=True)
-
-        # Show last 50 messages
-        for message in global_messages[-50:]:
-            content = message.get("content", "")
-            timestamp = message.get("timestamp", "")
-            message_user = message.get("user_id", "")
-
-            is_current_user = (message_user == current_user)
-
-            if is_current_user:
-                st.markdown(f"""
-                <div class="message-row-right">
-                    <div class="message-content">
-                        <div><strong>You:</strong> {content}</div>
-                        <div class="message-time">{timestamp}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div class="message-row-left">
-                    <div class="message-content">
-                        <div><strong>Anonymous:</strong> {content}</div>
-                        <div class="message-time">{timestamp}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-
-        st.markdown('</div>', unsafe_allow_html=True)
-        st.markdown("<div style='height: 20px;'></div>", unsafe_allow_html=True)
-    else:
-        st.markdown("Welcome to Anonymous Chat!")
     # Chat input (only if user is not banned)
     if global_prompt := st.chat_input("Type your message..."):
         user_message = {
@@ -889,22 +1050,40 @@ def global_chat_interface():
         }
 
         save_global_chat_message(user_message)
-        st.session_state.last_global_check = time.time()
         st.rerun()
 
-    # Auto-refresh at the end
-    time.sleep(refresh_interval)
-    st.rerun()
-
 
 def main():
     initialize_session()
 
+    get_retention_job()
+    if METRICS_PORT:
+        get_metrics_server()
+
+    # Datasets for this run, each loaded at most once. Loaders may run on
+    # prefetch threads, so Streamlit state is read here, not inside them.
+    current_user = st.session_state.current_user
+    ctx = DataContext(
+        user=lambda: get_user(current_user),
+        stats=load_stats,
+        settings=load_admin_settings,
+        message_snapshot=get_message_cache().snapshot,
+    )
+
     # Check authentication
     if not st.session_state.authenticated:
         login_form()
         return
 
+    # Independent reads go out together. The ban check needs the user record
+    # and the chat needs the messages, so only the counters and the settings
+    # fall back to defaults when the reads are slow.
+    ctx.prefetch(
+        "user", "stats", "settings", "message_snapshot",
+        timeout=PREFETCH_TIMEOUT,
+        defaults={"stats": storage.empty_stats(), "settings": dict(storage.DEFAULT_ADMIN_SETTINGS)},
+    )
+
     # Check if admin panel should be shown
     if st.session_state.is_admin and st.session_state.get("show_admin", False):
         col1, col2 = st.columns([3, 1])
@@ -914,11 +1093,11 @@ def main():
             if st.button("← Back", use_container_width=True):
                 st.session_state.show_admin = False
                 st.rerun()
-        admin_panel()
+        admin_panel(ctx)
         return
 
     # Show main chat interface
-    global_chat_interface()
+    global_chat_interface(ctx)
 
 
 if __name__ == "__main__":
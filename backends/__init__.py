@@ -0,0 +1,81 @@
+"""
+Storage engines and the configuration that picks one.
+
+``STORAGE_BACKEND`` selects the engine:
+
+* ``firebase``: Firebase Realtime Database (needs ``FIREBASE_DB_URL``), with
+  the local engine as mirror and fallback. Default when FIREBASE_DB_URL is set.
+* ``json``: JSON files under ``DATABASE_DIR`` (default ``database``).
+  Default otherwise.
+* ``sqlite``: SQLite database in WAL mode at ``SQLITE_PATH`` (default
+  ``<DATABASE_DIR>/chat.db``).
+
+``LOCAL_STORAGE_BACKEND`` (``json`` or ``sqlite``) picks the local engine
+used behind Firebase. ``FIREBASE_STREAM=0`` turns off the streaming mirror of
+``/messages``, ``/users`` and ``/admin_settings`` (see firebase_stream.py)
+and reads those with REST requests again.
+"""
+import os
+import threading
+
+from .base import StorageBackend, apply_path_updates, email_key, empty_stats
+from .firebase import FirebaseBackend, new_push_key
+from .json_files import JsonBackend
+from .sqlite import SqliteBackend
+
+__all__ = [
+    "StorageBackend",
+    "FirebaseBackend",
+    "JsonBackend",
+    "SqliteBackend",
+    "apply_path_updates",
+    "email_key",
+    "empty_stats",
+    "new_push_key",
+    "create_backend",
+    "get_backend",
+    "set_backend",
+]
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _create_local_backend(name, database_dir):
+    if name == "json":
+        return JsonBackend(database_dir)
+    if name == "sqlite":
+        path = os.getenv("SQLITE_PATH") or os.path.join(database_dir, "chat.db")
+        return SqliteBackend(path)
+    raise ValueError(f"Unknown local storage backend: {name}")
+
+
+def create_backend(name=None, firebase_db_url=None, local_name=None, database_dir=None):
+    """Build a backend; arguments left as None are read from the environment."""
+    firebase_db_url = firebase_db_url or os.getenv("FIREBASE_DB_URL")
+    name = name or os.getenv("STORAGE_BACKEND") or ("firebase" if firebase_db_url else "json")
+    local_name = local_name or os.getenv("LOCAL_STORAGE_BACKEND", "json")
+    database_dir = database_dir or os.getenv("DATABASE_DIR", "database")
+
+    if name == "firebase":
+        if not firebase_db_url:
+            raise ValueError("STORAGE_BACKEND=firebase needs FIREBASE_DB_URL")
+        stream = os.getenv("FIREBASE_STREAM", "1") != "0"
+        return FirebaseBackend(firebase_db_url, _create_local_backend(local_name, database_dir), stream=stream)
+    return _create_local_backend(name, database_dir)
+
+
+def get_backend():
+    """Process-wide backend built from the environment on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend()
+        return _backend
+
+
+def set_backend(backend):
+    """Replace the process-wide backend (benchmarks, maintenance commands)."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,207 @@
+"""
+Storage backend interface.
+
+Every engine stores the same datasets:
+
+* users: dicts keyed by username, plus an email -> username index;
+* messages: chat messages in send order, read incrementally with a cursor;
+* settings: the flat admin settings dict;
+* stats: counters kept up to date on every write (see ``empty_stats``), so
+  counts never need the full users or messages.
+
+Backends raise on failure; the functions in storage.py turn failures into the
+same empty defaults the app has always used.
+"""
+import copy
+
+
+def email_key(email):
+    # Firebase keys may not contain "." so the usual "," substitution is used
+    return email.strip().lower().replace(".", ",")
+
+
+def shallow_copy(value):
+    """Copy dicts one level deep; nested values are shared and must not be modified."""
+    if isinstance(value, dict):
+        return {k: dict(v) if isinstance(v, dict) else v for k, v in value.items()}
+    return value
+
+
+def apply_path_updates(tree, updates):
+    """Apply Firebase multi-path PATCH semantics to a dict: "a/b" paths, None deletes."""
+    for path, value in updates.items():
+        parts = [p for p in path.split("/") if p]
+        node = tree
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                if value is None:
+                    break
+                child = node[part] = {}
+            node = child
+        else:
+            if value is None:
+                node.pop(parts[-1], None)
+            else:
+                node[parts[-1]] = value
+    return tree
+
+
+def empty_stats():
+    return {"messages": 0, "users": 0, "banned": 0, "messages_per_user": {}}
+
+
+def user_counts(user_data):
+    """``(users, banned)`` contributed by one user record (None when absent)."""
+    if not isinstance(user_data, dict):
+        return 0, 0
+    return 1, int(user_data.get("status", "active") == "banned")
+
+
+def user_count_changes(before, updates):
+    """
+    ``(users, banned)`` deltas of applying path ``updates`` to the touched
+    users, given their records ``before`` (``{username: data or None}``).
+    """
+    after = apply_path_updates(
+        {u: copy.deepcopy(d) for u, d in before.items() if isinstance(d, dict)}, updates
+    )
+    users = banned = 0
+    for username, user_data in before.items():
+        old_users, old_banned = user_counts(user_data)
+        new_users, new_banned = user_counts(after.get(username))
+        users += new_users - old_users
+        banned += new_banned - old_banned
+    return users, banned
+
+
+def touched_users(updates):
+    return {path.strip("/").partition("/")[0] for path in updates}
+
+
+def changes_user_counts(updates):
+    """Whether ``updates`` write whole user records or a status (the counted fields)."""
+    parts = [path.strip("/").split("/") for path in updates]
+    return any(len(p) == 1 or p[1] == "status" for p in parts)
+
+
+class StorageBackend:
+    name = None
+
+    # -- users ---------------------------------------------------------------
+
+    def load_users(self):
+        """Return every user record as ``{username: user_data}``."""
+        raise NotImplementedError
+
+    def save_users(self, users):
+        """Replace the whole users dataset."""
+        raise NotImplementedError
+
+    def get_user(self, username):
+        """Return one user record, or None."""
+        raise NotImplementedError
+
+    def patch_users(self, updates, before=None):
+        """
+        Apply ``{"user/field": value}`` updates atomically; None deletes.
+        ``before`` optionally holds the current records (None: no such user)
+        of touched users the caller already has, so backends that maintain
+        the counters from them need not read those users first.
+        """
+        raise NotImplementedError
+
+    def delete_users(self, users):
+        """Delete ``{username: user_data}`` and the email index entries of those records."""
+        self.patch_users({username: None for username in users},
+                         {username: user_data for username, user_data in users.items() if user_data is not None})
+        for user_data in users.values():
+            if (user_data or {}).get("email"):
+                self.unindex_email(user_data["email"])
+
+    def lookup_email(self, email):
+        """Return the username indexed for ``email``, or None."""
+        raise NotImplementedError
+
+    def has_email_index(self):
+        """
+        Whether the email index was ever built: True, False, or None when
+        that cannot be told right now (storage unreachable).
+        """
+        raise NotImplementedError
+
+    def index_email(self, email, username):
+        raise NotImplementedError
+
+    def unindex_email(self, email):
+        raise NotImplementedError
+
+    def replace_email_index(self, index):
+        """Replace the whole ``{email_key: username}`` index."""
+        raise NotImplementedError
+
+    # -- messages ------------------------------------------------------------
+
+    def append_messages(self, messages):
+        raise NotImplementedError
+
+    def fetch_messages(self, cursor=None, limit=50):
+        """
+        Return ``{"messages": [...], "cursor": ..., "reset": bool}``.
+
+        With a cursor produced by this backend only newer messages are
+        returned; otherwise the newest ``limit`` messages and ``reset`` True.
+        """
+        raise NotImplementedError
+
+    def fetch_messages_before(self, cursor, limit=50):
+        """
+        Return ``{"messages": [...], "cursor": ..., "more": bool}``: up to
+        ``limit`` messages sent before the message at ``cursor``, oldest
+        first. The returned cursor points at the oldest of them and ``more``
+        tells whether anything older is left.
+        """
+        raise NotImplementedError
+
+    def clear_messages(self):
+        raise NotImplementedError
+
+    def search_messages(self, query, user_id=None, limit=50):
+        """Messages matching a search query, newest first (see search_index.py)."""
+        raise NotImplementedError
+
+    def rebuild_search_index(self):
+        """Recreate the search index from the stored messages; returns the count."""
+        raise NotImplementedError
+
+    def compact_messages(self, max_records=0, max_age=0, max_bytes=0):
+        """
+        Drop messages outside the retention window: beyond the newest
+        ``max_records``, older than ``max_age`` seconds, or beyond
+        ``max_bytes`` of stored messages (0 disables a limit). Dropped
+        messages are archived gzip-compressed under ``archive_dir``. Returns
+        the number of messages removed.
+        """
+        raise NotImplementedError
+
+    # -- stats ---------------------------------------------------------------
+
+    def load_stats(self):
+        """
+        Return ``{"messages", "users", "banned", "messages_per_user"}``, the
+        counters maintained by the writes above.
+        """
+        raise NotImplementedError
+
+    def recount_stats(self):
+        """Recompute the counters from the stored data; returns them."""
+        raise NotImplementedError
+
+    # -- settings ------------------------------------------------------------
+
+    def load_settings(self):
+        """Return the admin settings dict, or None when nothing is stored."""
+        raise NotImplementedError
+
+    def save_settings(self, settings):
+        raise NotImplementedError
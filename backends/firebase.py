@@ -0,0 +1,667 @@
+"""
+Firebase Realtime Database backend (REST API).
+
+Reads try Firebase first and fall back to the local backend when the request
+fails. Writes go to Firebase and are mirrored to the local backend, so the
+app keeps working from local data while Firebase is unreachable. Both kinds
+of fallback are counted in metrics.
+
+REST calls share a process-wide circuit breaker per database (see
+circuit_breaker.py) and time out after ``FIREBASE_TIMEOUT`` seconds
+(default 5). While the breaker is open, calls go straight to the local
+backend instead of waiting on an unreachable Firebase.
+
+Counters live under ``/stats``. Every write that changes them carries the
+matching ``{".sv": {"increment": n}}`` server values in the same atomic
+multi-path PATCH at the database root. User counter deltas come from the
+records being replaced: the caller's copies (the admin user directory), the
+mirror, or else a read of each touched user. When ``/stats`` is missing it is
+recounted with ``shallow=true`` reads (keys only) and a query for the banned
+users, which needs ``".indexOn": "status"`` on ``/users`` in the rules.
+
+Plain path reads (no query) ask for the node's ETag and send the last one
+back in ``If-None-Match``. When the ETag is unchanged (a 304, or a 200 with
+the same ETag from servers that ignore the header) the parsed value from
+the previous read is returned without parsing the body again.
+
+Message push keys are generated by the writing process, so a key can sort
+below a cursor another process already reached (the write was in flight,
+or the clocks differ). Message polls therefore re-read the last
+``FIREBASE_CURSOR_OVERLAP`` seconds (default 10) behind the cursor; the
+message cache drops the ones it already has by message_id.
+
+With ``stream=True`` users, settings and message reads are answered from a
+process-wide ``FirebaseMirror`` (see firebase_stream.py) whenever it is in
+sync, so they cost no request at all.
+
+Search uses its own index of ``/messages`` (``firebase_search_index`` next to
+the local engine's), so every instance finds the messages of all the
+others. Before each search it indexes the keys after the newest indexed one
+(less the overlap) from the mirror, or with REST reads in batches, and
+drops the documents below the oldest key still stored.
+"""
+import gzip
+import json
+import logging
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from urllib.parse import quote
+
+import circuit_breaker
+import http_client
+import metrics
+from search_index import get_search_index
+
+from .base import (
+    StorageBackend, changes_user_counts, email_key, empty_stats, shallow_copy, touched_users,
+    user_count_changes, user_counts,
+)
+from .firebase_stream import NOT_SYNCED, get_mirror
+
+logger = logging.getLogger(__name__)
+
+_PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+_push_key_lock = threading.Lock()
+_last_push_time = 0
+_last_push_random = [0] * 12
+
+# Returned by reads that could not reach Firebase (None is a valid value)
+_UNAVAILABLE = object()
+
+# Messages read, archived and deleted per step of a compaction
+COMPACTION_BATCH = 500
+# Seconds one process may hold the compaction lease (/locks/compaction)
+COMPACTION_LEASE = 600
+# Messages read per request while the search index catches up
+SEARCH_INDEX_BATCH = 500
+
+# Seconds to wait for a connection and for each read of a response
+REQUEST_TIMEOUT = float(os.getenv("FIREBASE_TIMEOUT", "5"))
+
+# Seconds of messages re-read behind a poll cursor (write latency + clock skew)
+CURSOR_OVERLAP = float(os.getenv("FIREBASE_CURSOR_OVERLAP", "10"))
+
+# Paths whose last parsed value is kept with its ETag
+ETAG_CACHE_SIZE = 256
+
+
+def new_push_key():
+    """
+    Generate a Firebase-style push key on the client.
+
+    Same layout as the keys created by POST: 8 characters of millisecond
+    timestamp followed by 12 random characters, incremented for keys created
+    in the same millisecond, so keys sort in creation order under
+    orderBy="$key".
+    """
+    global _last_push_time
+    with _push_key_lock:
+        now = int(time.time() * 1000)
+        if now == _last_push_time:
+            for i in range(11, -1, -1):
+                if _last_push_random[i] < 63:
+                    _last_push_random[i] += 1
+                    break
+                _last_push_random[i] = 0
+        else:
+            _last_push_time = now
+            for i in range(12):
+                _last_push_random[i] = secrets.randbelow(64)
+        return _encode_time(now) + "".join(_PUSH_CHARS[i] for i in _last_push_random)
+
+
+def _encode_time(millis):
+    time_chars = []
+    for _ in range(8):
+        time_chars.append(_PUSH_CHARS[millis % 64])
+        millis //= 64
+    return "".join(reversed(time_chars))
+
+
+def overlap_cursor(cursor):
+    """The lowest push key ``CURSOR_OVERLAP`` seconds before ``cursor``."""
+    millis = max(0, push_key_time(cursor) - int(CURSOR_OVERLAP * 1000))
+    return _encode_time(millis) + _PUSH_CHARS[0] * 12
+
+
+def increment(amount):
+    """Server value adding ``amount`` to the stored number atomically."""
+    return {".sv": {"increment": amount}}
+
+
+def counter_key(user_id):
+    # Characters Firebase does not allow in keys
+    return re.sub(r"[.#$\[\]/]", "_", str(user_id))
+
+
+def message_count_updates(messages, sign=1):
+    """``/stats`` updates for adding (sign 1) or removing (sign -1) messages."""
+    updates = {"stats/messages": increment(sign * len(messages))}
+    for user_id, count in Counter(counter_key(m.get("user_id")) for m in messages).items():
+        updates[f"stats/messages_per_user/{user_id}"] = increment(sign * count)
+    return updates
+
+
+def push_key_time(key):
+    """Creation time in milliseconds encoded in the first 8 push key characters."""
+    millis = 0
+    for char in key[:8]:
+        millis = millis * 64 + _PUSH_CHARS.index(char)
+    return millis
+
+
+class FirebaseBackend(StorageBackend):
+    name = "firebase"
+
+    def __init__(self, db_url, local, stream=False, timeout=REQUEST_TIMEOUT):
+        self.db_url = db_url.rstrip("/")
+        self.local = local
+        self.timeout = timeout
+        self.breaker = circuit_breaker.get_breaker(f"firebase {self.db_url}")
+        self.mirror = get_mirror(self.db_url) if stream else None
+        self._stats_ready = False
+        # One search index catch-up at a time
+        self._search_lock = threading.Lock()
+        # path parts -> (etag, parsed value)
+        self._etags = OrderedDict()
+        self._etags_lock = threading.Lock()
+
+    def _mirrored(self, path, *children):
+        """Value from the stream mirror, or NOT_SYNCED."""
+        if self.mirror is None:
+            return NOT_SYNCED
+        return self.mirror.get(path, *children)
+
+    def _url(self, *parts):
+        path = "/".join(quote(part, safe="") for part in parts)
+        return f"{self.db_url}/{path}.json"
+
+    def _request(self, method, *parts, **kwargs):
+        """
+        Response of one REST call, or None when it failed or the breaker is
+        open. Timeouts, connection errors and 5xx responses count against
+        the breaker.
+        """
+        if not self.breaker.allow():
+            return None
+        try:
+            response = http_client.request(method, self._url(*parts), timeout=self.timeout, **kwargs)
+        except Exception:
+            self.breaker.record_failure()
+            return None
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def _get(self, *parts, params=None, conditional=True):
+        """
+        Value at the path, or _UNAVAILABLE when Firebase could not be read.
+        Reads without ``params`` are conditional unless ``conditional`` is
+        False (one-off reads of large trees not worth keeping in memory).
+        """
+        if params is not None or not conditional:
+            response = self._request("GET", *parts, params=params)
+            try:
+                if response is not None and response.status_code == 200:
+                    return response.json()
+            except ValueError:
+                pass
+            metrics.record_fallback()
+            return _UNAVAILABLE
+        return self._get_conditional(parts)
+
+    def _get_conditional(self, parts):
+        with self._etags_lock:
+            cached = self._etags.get(parts)
+        headers = {"X-Firebase-ETag": "true"}
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
+        response = self._request("GET", *parts, headers=headers)
+        try:
+            if response is not None and response.status_code in (200, 304):
+                etag = response.headers.get("ETag")
+                if cached is not None and etag == cached[0]:
+                    return shallow_copy(cached[1])
+                if response.status_code == 200:
+                    value = response.json()
+                    if etag:
+                        with self._etags_lock:
+                            self._etags[parts] = (etag, value)
+                            self._etags.move_to_end(parts)
+                            if len(self._etags) > ETAG_CACHE_SIZE:
+                                self._etags.popitem(last=False)
+                    return shallow_copy(value)
+        except ValueError:
+            pass
+        metrics.record_fallback()
+        return _UNAVAILABLE
+
+    def _send(self, method, *parts, json=None):
+        """Write to Firebase; failures leave the write in the local mirror only."""
+        response = self._request(method, *parts, json=json)
+        if response is not None and response.ok:
+            return True
+        metrics.record_fallback()
+        return False
+
+    # -- users ---------------------------------------------------------------
+
+    def load_users(self):
+        users = self._mirrored("users")
+        if users is not NOT_SYNCED:
+            return users or {}
+        # Try Firebase first, fall back to local
+        users = self._get("users")
+        if users is not _UNAVAILABLE:
+            return users or {}
+        return self.local.load_users()
+
+    def save_users(self, users):
+        counts = [user_counts(user_data) for user_data in users.values()]
+        self._ensure_stats()
+        self._send("PATCH", json={
+            "users": users or None,
+            "stats/users": sum(c[0] for c in counts),
+            "stats/banned": sum(c[1] for c in counts),
+        })
+        self.local.save_users(users)
+
+    def get_user(self, username):
+        user_data = self._mirrored("users", username)
+        if user_data is not NOT_SYNCED:
+            return user_data
+        user_data = self._get("users", username)
+        if user_data is not _UNAVAILABLE:
+            return user_data
+        return self.local.get_user(username)
+
+    def patch_users(self, updates, before=None):
+        payload = {f"users/{path.strip('/')}": value for path, value in updates.items()}
+        if changes_user_counts(updates):
+            payload.update(self._user_count_updates(updates, before))
+        self._send("PATCH", json=payload)
+        self.local.patch_users(updates, before)
+
+    def delete_users(self, users):
+        # The users, their email index entries and the counter increments
+        # go in one multi-path PATCH
+        updates = {username: None for username in users}
+        known = {username: user_data for username, user_data in users.items() if user_data is not None}
+        before = self._records_before(updates, known)
+        payload = {f"users/{username}": None for username in users}
+        for user_data in before.values():
+            if (user_data or {}).get("email"):
+                payload[f"user_emails/{email_key(user_data['email'])}"] = None
+        payload.update(self._user_count_updates(updates, before))
+        self._send("PATCH", json=payload)
+        self.local.delete_users(users)
+
+    def _records_before(self, updates, before):
+        """
+        Current records of the users touched by ``updates``: the caller's
+        copies, then the mirror, then one read per remaining user.
+        """
+        records = dict(before or {})
+        for username in touched_users(updates) - set(records):
+            records[username] = self.get_user(username)
+        return records
+
+    def _user_count_updates(self, updates, before):
+        # Server-side increments for the same multi-path PATCH as the
+        # change, like the message counters
+        users_delta, banned_delta = user_count_changes(self._records_before(updates, before), updates)
+        self._ensure_stats()
+        payload = {}
+        if users_delta:
+            payload["stats/users"] = increment(users_delta)
+        if banned_delta:
+            payload["stats/banned"] = increment(banned_delta)
+        return payload
+
+    def _count_users(self):
+        """
+        ``(users, banned)`` from the mirror, or from a shallow read of the
+        keys and a query for the banned users. Returns None when Firebase
+        could not be read.
+        """
+        mirrored = self._mirrored("users")
+        if mirrored is not NOT_SYNCED:
+            counts = [user_counts(user_data) for user_data in (mirrored or {}).values()]
+            return sum(c[0] for c in counts), sum(c[1] for c in counts)
+        keys = self._get("users", params={"shallow": "true"})
+        if keys is _UNAVAILABLE:
+            return None
+        count = len(keys or {})
+        banned = self._get("users", params={"orderBy": '"status"', "equalTo": '"banned"'})
+        if banned is _UNAVAILABLE:
+            logger.warning('Querying users by status failed; add ".indexOn": "status" under "users" '
+                           "to the database rules. Counting banned users from the full users tree.")
+            all_users = self._get("users")
+            if all_users is _UNAVAILABLE:
+                return None
+            banned = {u: d for u, d in (all_users or {}).items() if user_counts(d)[1]}
+        return count, len(banned or {})
+
+    def lookup_email(self, email):
+        username = self._get("user_emails", email_key(email))
+        if username is not _UNAVAILABLE:
+            return username
+        return self.local.lookup_email(email)
+
+    def has_email_index(self):
+        keys = self._get("user_emails", params={"shallow": "true"})
+        if keys is _UNAVAILABLE:
+            return None
+        return keys is not None
+
+    def index_email(self, email, username):
+        self._send("PUT", "user_emails", email_key(email), json=username)
+        self.local.index_email(email, username)
+
+    def unindex_email(self, email):
+        self._send("DELETE", "user_emails", email_key(email))
+        self.local.unindex_email(email)
+
+    def replace_email_index(self, index):
+        self._send("PUT", "user_emails", json=index)
+        self.local.replace_email_index(index)
+
+    # -- messages ------------------------------------------------------------
+
+    def append_messages(self, messages):
+        # One multi-path PATCH with client-generated push keys for the batch
+        # and the counter increments
+        self._ensure_stats()
+        payload = {f"messages/{new_push_key()}": message for message in messages}
+        payload.update(message_count_updates(messages))
+        self._send("PATCH", json=payload)
+        self.local.append_messages(messages)
+
+    def fetch_messages(self, cursor=None, limit=50):
+        # Push keys are the cursor here; any other cursor came from the
+        # local fallback and starts a fresh window. Polls start
+        # CURSOR_OVERLAP behind the cursor to catch keys written late.
+        key_cursor = cursor if isinstance(cursor, str) else None
+        start = overlap_cursor(key_cursor) if key_cursor else None
+        if self.mirror is not None:
+            children = self.mirror.children_after("messages", start, limit)
+            if children is not NOT_SYNCED:
+                children = [(key, message) for key, message in children if key != key_cursor]
+                return {
+                    "messages": [{**message, "key": key} for key, message in children],
+                    "cursor": max(children[-1][0], key_cursor or "") if children else cursor,
+                    "reset": key_cursor is None,
+                }
+        params = {"orderBy": '"$key"', "limitToLast": limit}
+        if start is not None:
+            params["startAt"] = json.dumps(start)
+        messages_dict = self._get("messages", params=params)
+        if messages_dict is not _UNAVAILABLE:
+            messages_dict = messages_dict or {}
+            keys = sorted(k for k in messages_dict if k != key_cursor)
+            return {
+                # The key is kept so the UI can page back from any message
+                "messages": [{**messages_dict[k], "key": k} for k in keys],
+                "cursor": max(keys[-1], key_cursor or "") if keys else cursor,
+                "reset": key_cursor is None,
+            }
+        return self.local.fetch_messages(cursor, limit)
+
+    def fetch_messages_before(self, cursor, limit=50):
+        if not isinstance(cursor, str):
+            return self.local.fetch_messages_before(cursor, limit)
+        if self.mirror is not None:
+            page = self.mirror.children_before("messages", cursor, limit)
+            if page is not NOT_SYNCED:
+                children, more = page
+                return {
+                    "messages": [{**message, "key": key} for key, message in children],
+                    "cursor": children[0][0] if children else cursor,
+                    "more": more,
+                }
+        # endAt is inclusive: the cursor message, the page and one more key
+        # that tells whether older messages exist
+        params = {"orderBy": '"$key"', "endAt": json.dumps(cursor), "limitToLast": limit + 2}
+        messages_dict = self._get("messages", params=params)
+        if messages_dict is _UNAVAILABLE:
+            return {"messages": [], "cursor": cursor, "more": False}
+        messages_dict = messages_dict or {}
+        keys = sorted(k for k in messages_dict if k != cursor)
+        more = len(keys) > limit
+        keys = keys[-limit:]
+        return {
+            "messages": [{**messages_dict[k], "key": k} for k in keys],
+            "cursor": keys[0] if keys else cursor,
+            "more": more,
+        }
+
+    def clear_messages(self):
+        self._ensure_stats()
+        self._send("PATCH", json={"messages": None, "stats/messages": 0, "stats/messages_per_user": None})
+        self.local.clear_messages()
+        self.search_index.clear()
+
+    @property
+    def search_index(self):
+        # Separate from the local engine's index, which only holds the
+        # messages this process wrote
+        directory = os.path.join(os.path.dirname(self.local.search_index_dir), "firebase_search_index")
+        return get_search_index(directory)
+
+    def search_messages(self, query, user_id=None, limit=50):
+        self._catch_up_search_index()
+        return self.search_index.search(query, user_id, limit)
+
+    def _catch_up_search_index(self):
+        """
+        Index the /messages written since the last search by any instance
+        (from CURSOR_OVERLAP behind the newest indexed key, for keys written
+        late) and drop what retention deleted. On a failed read the index
+        is searched as it is.
+        """
+        index = self.search_index
+        with self._search_lock:
+            last = index.last_position
+            start = overlap_cursor(last) if isinstance(last, str) else None
+            children = NOT_SYNCED if self.mirror is None else self.mirror.children_after("messages", start, sys.maxsize)
+            if children is not NOT_SYNCED:
+                index.add([message for _, message in children], [key for key, _ in children])
+                oldest = self.mirror.first_key("messages")
+            else:
+                while True:
+                    params = {"orderBy": '"$key"', "limitToFirst": SEARCH_INDEX_BATCH}
+                    if start is not None:
+                        params["startAt"] = json.dumps(start)
+                    messages = self._get("messages", params=params)
+                    if messages is _UNAVAILABLE:
+                        return
+                    keys = sorted(messages or {})
+                    index.add([messages[key] for key in keys], keys)
+                    if len(keys) < SEARCH_INDEX_BATCH:
+                        break
+                    start = keys[-1]
+                first = self._get("messages", params={"orderBy": '"$key"', "limitToFirst": 1})
+                if first is _UNAVAILABLE:
+                    return
+                oldest = min(first) if first else None
+            if oldest is not None:
+                index.prune_below(oldest)
+
+    def rebuild_search_index(self):
+        index = self.search_index
+        with self._search_lock:
+            index.clear()
+        self._catch_up_search_index()
+        index.checkpoint()
+        return index.stats()["messages"]
+
+    def compact_messages(self, max_records=0, max_age=0, max_bytes=0):
+        # Keys only (shallow), so finding the expired range does not
+        # download the messages. Push keys sort by creation time, which
+        # gives the age cutoff without reading any message. There is no
+        # cheap way to learn the stored size in Firebase, so max_bytes only
+        # applies to the local mirror.
+        removed = 0
+        keys = self._get("messages", params={"shallow": "true"})
+        if keys is not _UNAVAILABLE and keys:
+            keys = sorted(keys)
+            expired = 0
+            if max_records:
+                expired = max(expired, len(keys) - max_records)
+            if max_age:
+                cutoff = (time.time() - max_age) * 1000
+                expired = max(expired, sum(1 for key in keys if push_key_time(key) < cutoff))
+            if expired:
+                removed = self._archive_and_delete(keys[:expired])
+        self.local.compact_messages(max_records, max_age, max_bytes)
+        return removed
+
+    def _archive_and_delete(self, keys):
+        # Every app process runs a retention job. The lease lets one of them
+        # at a time delete, so a message is only counted down once.
+        token = self._acquire_lease("compaction", COMPACTION_LEASE)
+        if token is None:
+            return 0
+        try:
+            self._ensure_stats()
+            archive_dir = self.local.archive_dir
+            os.makedirs(archive_dir, exist_ok=True)
+            start_key = keys[0]
+            # Stop well before the lease could expire
+            deadline = time.monotonic() + COMPACTION_LEASE / 2
+            removed = 0
+            while time.monotonic() < deadline:
+                messages = self._get("messages", params={
+                    "orderBy": '"$key"',
+                    "startAt": json.dumps(start_key),
+                    "endAt": json.dumps(keys[-1]),
+                    "limitToFirst": COMPACTION_BATCH,
+                })
+                if messages is _UNAVAILABLE or not messages:
+                    break
+                batch = sorted(messages)
+                archive_path = os.path.join(archive_dir, f"firebase-messages-{batch[0]}-{batch[-1]}.jsonl.gz")
+                with gzip.open(archive_path + ".tmp", "wt") as f:
+                    for key in batch:
+                        f.write(json.dumps({"key": key, **messages[key]}, separators=(",", ":")) + "\n")
+                os.replace(archive_path + ".tmp", archive_path)
+
+                # Counted down from the messages just read, deleted in the same PATCH
+                payload = {f"messages/{key}": None for key in batch}
+                payload.update(message_count_updates([messages[key] for key in batch], -1))
+                if not self._send("PATCH", json=payload):
+                    break
+                removed += len(batch)
+                if len(batch) < COMPACTION_BATCH:
+                    break
+                # startAt is inclusive, but that key is gone now
+                start_key = batch[-1]
+            return removed
+        finally:
+            self._release_lease("compaction", token)
+
+    def _acquire_lease(self, name, seconds):
+        """
+        Take ``/locks/<name>`` with a conditional PUT (``if-match`` on the
+        ETag just read); returns the owner token, or None when another
+        process holds an unexpired lease or the PUT lost a race.
+        """
+        response = self._request("GET", "locks", name, headers={"X-Firebase-ETag": "true"})
+        if response is None or response.status_code != 200 or "ETag" not in response.headers:
+            return None
+        lease = response.json()
+        if isinstance(lease, dict) and lease.get("expires_at", 0) > time.time() * 1000:
+            return None
+        token = secrets.token_hex(8)
+        response = self._request(
+            "PUT", "locks", name,
+            json={"owner": token, "expires_at": int((time.time() + seconds) * 1000)},
+            headers={"if-match": response.headers["ETag"]},
+        )
+        return token if response is not None and response.ok else None
+
+    def _release_lease(self, name, token):
+        response = self._request("GET", "locks", name, headers={"X-Firebase-ETag": "true"})
+        if response is None or response.status_code != 200 or "ETag" not in response.headers:
+            return
+        lease = response.json()
+        if isinstance(lease, dict) and lease.get("owner") == token:
+            self._request("DELETE", "locks", name, headers={"if-match": response.headers["ETag"]})
+
+    # -- stats ---------------------------------------------------------------
+
+    def load_stats(self):
+        stats = self._mirrored("stats")
+        if stats is NOT_SYNCED:
+            stats = self._get("stats")
+            if stats is _UNAVAILABLE:
+                return self.local.load_stats()
+        if stats is None:
+            return self._recount_shallow() or self.local.load_stats()
+        return {**empty_stats(), **stats}
+
+    def _ensure_stats(self):
+        # Increments on a missing /stats would start the counters at zero,
+        # so data written before the counters existed is counted first
+        if self._stats_ready:
+            return
+        stats = self._mirrored("stats")
+        if stats is NOT_SYNCED:
+            stats = self._get("stats", params={"shallow": "true"})
+            if stats is _UNAVAILABLE:
+                return
+        if stats is not None or self._recount_shallow() is not None:
+            self._stats_ready = True
+
+    def _recount_shallow(self):
+        """
+        Recount without downloading the messages or users (shallow reads of
+        the keys plus a query for the banned users) and store the result;
+        None when Firebase could not be read. Per-user counts stay empty
+        until ``recount_stats``.
+        """
+        messages = self._get("messages", params={"shallow": "true"})
+        counts = self._count_users()
+        if messages is _UNAVAILABLE or counts is None:
+            return None
+        stats = {**empty_stats(), "messages": len(messages or {}), "users": counts[0], "banned": counts[1]}
+        self._send("PUT", "stats", json=stats)
+        return stats
+
+    def recount_stats(self):
+        # Full recount for maintenance: downloads the messages once
+        messages = self._get("messages", conditional=False)
+        users = self._get("users")
+        if messages is _UNAVAILABLE or users is _UNAVAILABLE:
+            return self.local.recount_stats()
+        counts = [user_counts(user_data) for user_data in (users or {}).values()]
+        stats = {
+            "messages": len(messages or {}),
+            "users": sum(c[0] for c in counts),
+            "banned": sum(c[1] for c in counts),
+            "messages_per_user": dict(Counter(counter_key(m.get("user_id")) for m in (messages or {}).values())),
+        }
+        self._send("PUT", "stats", json=stats)
+        return stats
+
+    # -- settings ------------------------------------------------------------
+
+    def load_settings(self):
+        settings = self._mirrored("admin_settings")
+        if settings is not NOT_SYNCED:
+            return settings
+        settings = self._get("admin_settings")
+        if settings is not _UNAVAILABLE:
+            return settings
+        return self.local.load_settings()
+
+    def save_settings(self, settings):
+        self._send("PUT", "admin_settings", json=settings)
+        self.local.save_settings(settings)
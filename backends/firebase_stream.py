@@ -0,0 +1,292 @@
+"""
+In-memory mirror of Firebase paths kept current by the REST streaming API.
+
+``FirebaseMirror`` opens one ``Accept: text/event-stream`` connection per
+mirrored path (``/messages``, ``/users``, ``/admin_settings`` and ``/stats``
+by default)
+from background threads. Firebase first sends the whole node as a ``put`` at
+``/`` and then a ``put`` or ``patch`` event for every change below it, so
+the mirror costs one download per connection plus the write rate, however
+many sessions read from it.
+
+A path is readable once its initial ``put`` arrived. When a connection
+drops (or Firebase sends ``cancel``/``auth_revoked``), the path is marked
+unsynced, so readers go back to plain REST reads, and the thread reconnects
+with exponential backoff; the fresh initial ``put`` resyncs the node.
+
+The mirror only changes through stream events, so it always reflects the
+server's order of writes. A process sees its own writes as soon as their
+event comes back on the stream.
+"""
+import bisect
+import json
+import logging
+import socket
+import threading
+import time
+from urllib.parse import quote
+
+import http_client
+
+from .base import apply_path_updates, shallow_copy
+
+logger = logging.getLogger(__name__)
+
+MIRRORED_PATHS = ("messages", "users", "admin_settings", "stats")
+
+# Returned by reads of a path that is not synced (None is a valid value)
+NOT_SYNCED = object()
+
+
+def _split(path):
+    return [part for part in path.split("/") if part]
+
+
+def _read_lines(raw):
+    """Lines of a streamed body as they arrive, without the newline."""
+    pending = []
+    while True:
+        chunk = raw.read1(65536)
+        if not chunk:
+            return
+        parts = chunk.split(b"\n")
+        if len(parts) == 1:
+            pending.append(chunk)
+            continue
+        pending.append(parts[0])
+        yield b"".join(pending)
+        yield from parts[1:-1]
+        pending = [parts[-1]]
+
+
+def _socket_of(response):
+    """Socket under a streamed ``requests`` response, or None."""
+    sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+    if sock is None:
+        # Once the body is being read, http.client owns the socket
+        # (HTTPResponse -> BufferedReader -> SocketIO)
+        fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+        sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    return sock
+
+
+class _Node:
+    def __init__(self):
+        self.synced = False
+        self.value = None
+        # Sorted child keys, for ordered reads of /messages
+        self.keys = []
+        self.events = 0
+        self.connects = 0
+        self.last_event = None
+
+
+class FirebaseMirror:
+    def __init__(self, db_url, paths=MIRRORED_PATHS, reconnect_delay=1.0,
+                 max_reconnect_delay=30.0, read_timeout=90.0):
+        self.db_url = db_url.rstrip("/")
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        # Firebase sends a keep-alive every 30 seconds
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._nodes = {path: _Node() for path in paths}
+        self._stop = threading.Event()
+        self._responses = {}
+        self._threads = [
+            threading.Thread(target=self._listen, args=(path,), name=f"firebase-stream-{path}", daemon=True)
+            for path in paths
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    # -- stream --------------------------------------------------------------
+
+    def _listen(self, path):
+        delay = self.reconnect_delay
+        url = f"{self.db_url}/{quote(path, safe='')}.json"
+        while not self._stop.is_set():
+            try:
+                response = http_client.get(
+                    url, stream=True, timeout=(10, self.read_timeout),
+                    headers={"Accept": "text/event-stream", "Accept-Encoding": "identity"},
+                )
+                self._responses[path] = response
+                if response.status_code == 200:
+                    with self._lock:
+                        self._nodes[path].connects += 1
+                    for event, data in self._events(response):
+                        if self._handle(path, event, data):
+                            # Got data, so the next failure starts over
+                            delay = self.reconnect_delay
+                        if event in ("cancel", "auth_revoked"):
+                            break
+                response.close()
+            except Exception:
+                if not self._stop.is_set():
+                    logger.debug("Stream of /%s failed", path, exc_info=True)
+            finally:
+                self._responses.pop(path, None)
+            with self._lock:
+                self._nodes[path].synced = False
+            if self._stop.wait(delay):
+                return
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    @staticmethod
+    def _events(response):
+        event, data = None, []
+        for line in _read_lines(response.raw):
+            line = line.decode("utf-8").rstrip("\r")
+            if not line:
+                if event:
+                    yield event, "\n".join(data)
+                event, data = None, []
+            elif line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data.append(line[5:].strip())
+
+    def _handle(self, path, event, data):
+        """Apply one event; returns True when the node changed."""
+        if event not in ("put", "patch"):
+            return False
+        payload = json.loads(data)
+        parts = _split(payload.get("path", "/"))
+        if event == "put":
+            changes = [(parts, payload.get("data"))]
+        else:
+            changes = [(parts + _split(key), value) for key, value in (payload.get("data") or {}).items()]
+        with self._lock:
+            node = self._nodes[path]
+            for change_parts, value in changes:
+                self._apply(node, change_parts, value)
+            if event == "put" and not parts:
+                node.synced = True
+            node.events += 1
+            node.last_event = time.time()
+        return True
+
+    @staticmethod
+    def _apply(node, parts, value):
+        # Called with the lock held
+        if not parts:
+            node.value = value
+            node.keys = sorted(value) if isinstance(value, dict) else []
+            return
+        if not isinstance(node.value, dict):
+            node.value = {}
+        apply_path_updates(node.value, {"/".join(parts): value})
+        key = parts[0]
+        i = bisect.bisect_left(node.keys, key)
+        listed = i < len(node.keys) and node.keys[i] == key
+        if key in node.value and not listed:
+            node.keys.insert(i, key)
+        elif key not in node.value and listed:
+            del node.keys[i]
+
+    # -- reads ---------------------------------------------------------------
+
+    def synced(self, path):
+        with self._lock:
+            node = self._nodes.get(path)
+            return bool(node and node.synced)
+
+    def get(self, path, *children):
+        """
+        Value at ``path/children...`` or NOT_SYNCED. Dicts are copied one
+        level deep; nested values are shared and must not be modified.
+        """
+        with self._lock:
+            node = self._nodes.get(path)
+            if node is None or not node.synced:
+                return NOT_SYNCED
+            value = node.value
+            for child in children:
+                value = value.get(child) if isinstance(value, dict) else None
+            return shallow_copy(value)
+
+    def children_after(self, path, cursor, limit):
+        """
+        The newest ``limit`` ``(key, value)`` children with a key above
+        ``cursor`` (all keys when cursor is None), in key order, or NOT_SYNCED.
+        """
+        with self._lock:
+            node = self._nodes.get(path)
+            if node is None or not node.synced:
+                return NOT_SYNCED
+            keys = node.keys
+            start = 0 if cursor is None else bisect.bisect_right(keys, cursor)
+            selected = keys[max(start, len(keys) - limit):]
+            return [(key, dict(node.value[key])) for key in selected]
+
+    def first_key(self, path):
+        """Lowest child key of ``path`` (None when it has no children), or NOT_SYNCED."""
+        with self._lock:
+            node = self._nodes.get(path)
+            if node is None or not node.synced:
+                return NOT_SYNCED
+            return node.keys[0] if node.keys else None
+
+    def children_before(self, path, cursor, limit):
+        """
+        ``(children, more)``: up to ``limit`` ``(key, value)`` children with a
+        key below ``cursor``, in key order, or NOT_SYNCED.
+        """
+        with self._lock:
+            node = self._nodes.get(path)
+            if node is None or not node.synced:
+                return NOT_SYNCED
+            end = bisect.bisect_left(node.keys, cursor)
+            start = max(0, end - limit)
+            children = [(key, dict(node.value[key])) for key in node.keys[start:end]]
+            return children, start > 0
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return {
+                path: {
+                    "synced": node.synced,
+                    "children": len(node.keys),
+                    "events": node.events,
+                    "connects": node.connects,
+                    "last_event_age_s": round(now - node.last_event, 1) if node.last_event else None,
+                }
+                for path, node in self._nodes.items()
+            }
+
+    def stop(self, timeout=5.0):
+        """Close the streams and wait up to ``timeout`` seconds for the listener threads."""
+        self._stop.set()
+        for response in list(self._responses.values()):
+            # Closing the response alone waits for the blocked read to return
+            # (the next keep-alive, up to 30 seconds); shutting the socket
+            # down ends that read at once
+            sock = _socket_of(response)
+            try:
+                if sock is not None:
+                    sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                response.close()
+            except Exception:
+                pass
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(db_url):
+    """Process-wide mirror of ``db_url``; the listener threads start on first use."""
+    db_url = db_url.rstrip("/")
+    with _mirrors_lock:
+        mirror = _mirrors.get(db_url)
+        if mirror is None:
+            mirror = _mirrors[db_url] = FirebaseMirror(db_url)
+        return mirror
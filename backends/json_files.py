@@ -0,0 +1,236 @@
+"""
+JSON file backend: the original local storage under ``database/``.
+
+Users, the email index and settings are single JSON files rewritten through a
+temporary file (so a change to one user costs a write of all of them); messages live in the append-only message log and are
+indexed for search under ``<directory>/search_index``. Messages dropped by
+retention are archived under ``<directory>/archive``. The user counters live
+in ``stats.json``, rewritten under the same lock and right after each
+``users.json`` replace. Message counters are not stored: the total comes from
+the log's sequence numbers and the messages per user are counted from the log
+incrementally, reading only what was appended since the previous count.
+
+Reads of the JSON files keep the parsed value together with the file's
+mtime, size and inode, so reading an unchanged file costs one ``stat``.
+Read-modify-write cycles always parse the file afresh.
+"""
+import json
+import os
+import threading
+from collections import Counter
+
+from message_log import get_message_log
+from search_index import get_search_index
+
+from .base import (
+    StorageBackend, apply_path_updates, email_key, empty_stats, shallow_copy, user_counts,
+)
+
+
+class JsonBackend(StorageBackend):
+    name = "json"
+
+    def __init__(self, directory="database"):
+        self.directory = directory
+        self.archive_dir = os.path.join(directory, "archive")
+        self.search_index_dir = os.path.join(directory, "search_index")
+        # Serialize read-modify-write cycles on the files of this directory
+        self._users_lock = threading.Lock()
+        self._email_index_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        # filename -> (stat key, parsed value)
+        self._parsed = {}
+        # Messages per user counted from the log, and the sequence numbers
+        # of the oldest message and the one after the last message counted
+        self._per_user = Counter()
+        self._per_user_first = None
+        self._per_user_next = None
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _read(self, filename, default):
+        path = self._path(filename)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                return json.load(f)
+        return default
+
+    def _stat_key(self, filename):
+        try:
+            st = os.stat(self._path(filename))
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _read_cached(self, filename, default):
+        """Like ``_read``; dicts are copied one level deep and nested values must not be modified."""
+        key = self._stat_key(filename)
+        if key is None:
+            return default
+        cached = self._parsed.get(filename)
+        if cached is None or cached[0] != key:
+            cached = self._parsed[filename] = (key, self._read(filename, default))
+        return shallow_copy(cached[1])
+
+    def _write(self, filename, data):
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file and rename so readers never see a partial file
+        path = self._path(filename)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+
+    @property
+    def message_log(self):
+        return get_message_log(self._path("global_chat"))
+
+    @property
+    def search_index(self):
+        return get_search_index(self.search_index_dir, lambda: self.message_log.read_since(0))
+
+    # -- users ---------------------------------------------------------------
+
+    def load_users(self):
+        return self._read_cached("users.json", {})
+
+    def save_users(self, users):
+        with self._users_lock:
+            self._write("users.json", users)
+            self._write_user_counts(users)
+
+    def get_user(self, username):
+        return self.load_users().get(username)
+
+    def patch_users(self, updates, before=None):
+        with self._users_lock:
+            users = apply_path_updates(self._read("users.json", {}), updates)
+            self._write("users.json", users)
+            # The whole file was just read, so the counts are taken from it
+            self._write_user_counts(users)
+
+    def delete_users(self, users):
+        self.patch_users({username: None for username in users})
+        keys = {email_key(d["email"]) for d in users.values() if (d or {}).get("email")}
+        if keys:
+            with self._email_index_lock:
+                index = self._read("user_emails.json", {})
+                for key in keys:
+                    index.pop(key, None)
+                self._write("user_emails.json", index)
+
+    def lookup_email(self, email):
+        return self._read_cached("user_emails.json", {}).get(email_key(email))
+
+    def has_email_index(self):
+        return os.path.exists(self._path("user_emails.json"))
+
+    def index_email(self, email, username):
+        with self._email_index_lock:
+            index = self._read("user_emails.json", {})
+            index[email_key(email)] = username
+            self._write("user_emails.json", index)
+
+    def unindex_email(self, email):
+        with self._email_index_lock:
+            index = self._read("user_emails.json", {})
+            if index.pop(email_key(email), None) is not None:
+                self._write("user_emails.json", index)
+
+    def replace_email_index(self, index):
+        with self._email_index_lock:
+            self._write("user_emails.json", index)
+
+    # -- messages ------------------------------------------------------------
+
+    def append_messages(self, messages):
+        # Opened first: a new index is built from the log as it is now
+        index = self.search_index
+        index.add(messages, self.message_log.extend(messages))
+
+    def fetch_messages(self, cursor=None, limit=50):
+        log = self.message_log
+        if isinstance(cursor, int):
+            messages = log.read_since(cursor, limit)
+            reset = False
+        else:
+            messages = log.read_tail(limit)
+            reset = True
+        new_cursor = messages[-1]["seq"] if messages else (cursor if not reset else 0)
+        return {"messages": messages, "cursor": new_cursor, "reset": reset}
+
+    def fetch_messages_before(self, cursor, limit=50):
+        if not isinstance(cursor, int):
+            return {"messages": [], "cursor": cursor, "more": False}
+        messages, more = self.message_log.read_before(cursor, limit)
+        new_cursor = messages[0]["seq"] if messages else cursor
+        return {"messages": messages, "cursor": new_cursor, "more": more}
+
+    def clear_messages(self):
+        self.message_log.clear()
+        self.search_index.clear()
+
+    def search_messages(self, query, user_id=None, limit=50):
+        return self.search_index.search(query, user_id, limit)
+
+    def rebuild_search_index(self):
+        return self.search_index.rebuild(self.message_log.read_since(0))
+
+    def compact_messages(self, max_records=0, max_age=0, max_bytes=0):
+        # Works on whole segments, so up to one segment more than the
+        # window may be kept
+        removed = self.message_log.compact(max_records, max_age, max_bytes, self.archive_dir)
+        if removed:
+            self.search_index.prune_below(self.message_log.first_seq)
+        return removed
+
+    # -- stats ---------------------------------------------------------------
+
+    def _write_user_counts(self, users):
+        # Caller holds _users_lock
+        counts = [user_counts(user_data) for user_data in users.values()]
+        self._write("stats.json", {"users": sum(c[0] for c in counts), "banned": sum(c[1] for c in counts)})
+
+    def _count_messages(self):
+        """``(messages, messages_per_user)`` from the log; only new messages are read."""
+        log = self.message_log
+        with self._stats_lock:
+            first_seq, next_seq = log.seq_range()
+            if first_seq != self._per_user_first:
+                # Compacted or cleared (sequence numbers are never reused)
+                self._per_user = Counter()
+                self._per_user_first = self._per_user_next = first_seq
+            if next_seq > self._per_user_next:
+                messages = log.read_since(self._per_user_next - 1)
+                self._per_user.update(str(m.get("user_id")) for m in messages)
+                if messages:
+                    self._per_user_next = messages[-1]["seq"] + 1
+            return next_seq - first_seq, dict(self._per_user)
+
+    def load_stats(self):
+        counts = self._read_cached("stats.json", None)
+        if counts is None:
+            with self._users_lock:
+                self._write_user_counts(self._read("users.json", {}))
+            counts = self._read_cached("stats.json", None) or {}
+        stats = empty_stats()
+        stats["users"] = counts.get("users", 0)
+        stats["banned"] = counts.get("banned", 0)
+        stats["messages"], stats["messages_per_user"] = self._count_messages()
+        return stats
+
+    def recount_stats(self):
+        with self._users_lock:
+            self._write_user_counts(self._read("users.json", {}))
+        with self._stats_lock:
+            self._per_user_first = None
+        return self.load_stats()
+
+    # -- settings ------------------------------------------------------------
+
+    def load_settings(self):
+        return self._read_cached("admin_settings.json", None)
+
+    def save_settings(self, settings):
+        self._write("admin_settings.json", settings)
@@ -0,0 +1,359 @@
+"""
+SQLite backend for single-node deployments.
+
+The database runs in WAL mode, so any number of readers can proceed while a
+write transaction is open, and every write is one transaction. Messages are
+indexed by insertion sequence and send time, users by normalized email.
+Each thread gets its own connection. Counters (messages, users, banned users,
+messages per user) are kept by triggers in the same transaction as the write
+they count. Message search uses the same inverted
+index as the JSON backend, stored next to the database.
+"""
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from search_index import get_search_index
+
+from .base import StorageBackend, email_key, empty_stats
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    email_key TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_email ON users (email_key);
+
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT,
+    user_id TEXT,
+    created_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at);
+
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+-- Counters maintained by triggers inside the writing transaction
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS message_counts (
+    user_id TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS count_message_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO counters (name, value) VALUES ('messages', 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+    INSERT INTO message_counts (user_id, value) VALUES (COALESCE(NEW.user_id, 'None'), 1)
+        ON CONFLICT (user_id) DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS count_message_delete AFTER DELETE ON messages BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'messages';
+    UPDATE message_counts SET value = value - 1 WHERE user_id = COALESCE(OLD.user_id, 'None');
+    DELETE FROM message_counts WHERE user_id = COALESCE(OLD.user_id, 'None') AND value <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS count_user_insert AFTER INSERT ON users BEGIN
+    INSERT INTO counters (name, value) VALUES ('users', 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+    INSERT INTO counters (name, value)
+        VALUES ('banned', json_extract(NEW.data, '$.status') IS 'banned')
+        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+END;
+CREATE TRIGGER IF NOT EXISTS count_user_delete AFTER DELETE ON users BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'users';
+    UPDATE counters SET value = value - (json_extract(OLD.data, '$.status') IS 'banned')
+        WHERE name = 'banned';
+END;
+CREATE TRIGGER IF NOT EXISTS count_user_update AFTER UPDATE OF data ON users BEGIN
+    INSERT INTO counters (name, value)
+        VALUES ('banned', (json_extract(NEW.data, '$.status') IS 'banned')
+                          - (json_extract(OLD.data, '$.status') IS 'banned'))
+        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+END;
+"""
+
+
+class SqliteBackend(StorageBackend):
+    name = "sqlite"
+
+    def __init__(self, path="database/chat.db"):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        self.archive_dir = os.path.join(directory, "archive")
+        self.search_index_dir = os.path.join(directory, "search_index")
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+        # Databases created before the counters existed
+        if self._connection().execute("SELECT 1 FROM counters WHERE name = 'users'").fetchone() is None:
+            self.recount_stats()
+
+    @property
+    def search_index(self):
+        return get_search_index(self.search_index_dir, self._all_messages)
+
+    def _all_messages(self):
+        rows = self._connection().execute("SELECT seq, data FROM messages ORDER BY seq").fetchall()
+        return [{**json.loads(data), "seq": seq} for seq, data in rows]
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode; write transactions are opened explicitly below
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write
+        # cycles (patch_users) cannot interleave with other writers
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _user_row(username, user_data):
+        email = user_data.get("email")
+        return (username, email_key(email) if email else None, json.dumps(user_data))
+
+    # -- users ---------------------------------------------------------------
+
+    def load_users(self):
+        rows = self._connection().execute("SELECT username, data FROM users").fetchall()
+        return {username: json.loads(data) for username, data in rows}
+
+    def save_users(self, users):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM users")
+            conn.executemany(
+                "INSERT INTO users (username, email_key, data) VALUES (?, ?, ?)",
+                [self._user_row(u, d) for u, d in users.items()],
+            )
+
+    def get_user(self, username):
+        row = self._connection().execute(
+            "SELECT data FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def patch_users(self, updates, before=None):
+        with self._transaction() as conn:
+            # Group "user/field" paths by user so each row is rewritten once
+            by_user = {}
+            for path, value in updates.items():
+                username, _, field = path.strip("/").partition("/")
+                by_user.setdefault(username, []).append((field, value))
+            for username, changes in by_user.items():
+                row = conn.execute(
+                    "SELECT data FROM users WHERE username = ?", (username,)
+                ).fetchone()
+                user_data = json.loads(row[0]) if row else None
+                for field, value in changes:
+                    if not field:
+                        user_data = value
+                    elif value is None:
+                        if user_data is not None:
+                            user_data.pop(field, None)
+                    else:
+                        user_data = user_data if user_data is not None else {}
+                        user_data[field] = value
+                if user_data is None:
+                    conn.execute("DELETE FROM users WHERE username = ?", (username,))
+                else:
+                    # An upsert, not INSERT OR REPLACE, so the update
+                    # trigger sees the old row
+                    conn.execute(
+                        "INSERT INTO users (username, email_key, data) VALUES (?, ?, ?)"
+                        " ON CONFLICT (username) DO UPDATE SET email_key = excluded.email_key,"
+                        " data = excluded.data",
+                        self._user_row(username, user_data),
+                    )
+
+    def lookup_email(self, email):
+        row = self._connection().execute(
+            "SELECT username FROM users WHERE email_key = ? LIMIT 1", (email_key(email),)
+        ).fetchone()
+        return row[0] if row else None
+
+    # The email index is the idx_users_email index, maintained by SQLite itself
+    def has_email_index(self):
+        # The index is the idx_users_email column index
+        return True
+
+    def index_email(self, email, username):
+        pass
+
+    def unindex_email(self, email):
+        pass
+
+    def replace_email_index(self, index):
+        pass
+
+    # -- messages ------------------------------------------------------------
+
+    def append_messages(self, messages):
+        # Opened first: a new index is built from the table as it is now
+        index = self.search_index
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT INTO messages (message_id, user_id, created_at, data) VALUES (?, ?, ?, ?)",
+                [(m.get("message_id"), m.get("user_id"), now, json.dumps(m)) for m in messages],
+            )
+            # The rows of one write transaction get consecutive sequence numbers
+            last = conn.execute("SELECT MAX(seq) FROM messages").fetchone()[0] or 0
+        index.add(messages, range(last - len(messages) + 1, last + 1))
+
+    def fetch_messages(self, cursor=None, limit=50):
+        conn = self._connection()
+        if isinstance(cursor, int):
+            rows = conn.execute(
+                "SELECT seq, data FROM messages WHERE seq > ? ORDER BY seq DESC LIMIT ?",
+                (cursor, limit),
+            ).fetchall()
+            reset = False
+        else:
+            rows = conn.execute(
+                "SELECT seq, data FROM messages ORDER BY seq DESC LIMIT ?", (limit,)
+            ).fetchall()
+            reset = True
+        messages = []
+        for seq, data in reversed(rows):
+            message = json.loads(data)
+            message["seq"] = seq
+            messages.append(message)
+        new_cursor = messages[-1]["seq"] if messages else (cursor if not reset else 0)
+        return {"messages": messages, "cursor": new_cursor, "reset": reset}
+
+    def fetch_messages_before(self, cursor, limit=50):
+        if not isinstance(cursor, int):
+            return {"messages": [], "cursor": cursor, "more": False}
+        # One row past the page tells whether there is more history
+        rows = self._connection().execute(
+            "SELECT seq, data FROM messages WHERE seq < ? ORDER BY seq DESC LIMIT ?",
+            (cursor, limit + 1),
+        ).fetchall()
+        messages = []
+        for seq, data in reversed(rows[:limit]):
+            message = json.loads(data)
+            message["seq"] = seq
+            messages.append(message)
+        new_cursor = messages[0]["seq"] if messages else cursor
+        return {"messages": messages, "cursor": new_cursor, "more": len(rows) > limit}
+
+    def clear_messages(self):
+        # AUTOINCREMENT keeps sequence numbers increasing across clears
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM messages")
+        self.search_index.clear()
+
+    def search_messages(self, query, user_id=None, limit=50):
+        return self.search_index.search(query, user_id, limit)
+
+    def rebuild_search_index(self):
+        return self.search_index.rebuild(self._all_messages())
+
+    def compact_messages(self, max_records=0, max_age=0, max_bytes=0):
+        conn = self._connection()
+        # Everything at or below `cutoff` is outside the retention window
+        cutoff = 0
+        if max_records:
+            row = conn.execute("SELECT MAX(seq) FROM messages").fetchone()
+            cutoff = max(cutoff, (row[0] or 0) - max_records)
+        if max_age:
+            row = conn.execute(
+                "SELECT MAX(seq) FROM messages WHERE created_at < ?", (time.time() - max_age,)
+            ).fetchone()
+            cutoff = max(cutoff, row[0] or 0)
+        if max_bytes:
+            row = conn.execute(
+                "SELECT seq FROM (SELECT seq, SUM(LENGTH(data)) OVER (ORDER BY seq DESC) AS newer"
+                " FROM messages) WHERE newer > ? ORDER BY seq DESC LIMIT 1",
+                (max_bytes,),
+            ).fetchone()
+            cutoff = max(cutoff, row[0] if row else 0)
+        if cutoff <= 0:
+            return 0
+
+        # Only rows at or below the cutoff are touched; new sends get
+        # higher sequence numbers, so archiving outside the transaction is safe
+        rows = conn.execute(
+            "SELECT seq, data FROM messages WHERE seq <= ? ORDER BY seq", (cutoff,)
+        ).fetchall()
+        if not rows:
+            return 0
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archive_path = os.path.join(self.archive_dir, f"messages-{rows[0][0]:012d}-{rows[-1][0]:012d}.jsonl.gz")
+        with gzip.open(archive_path + ".tmp", "wt") as f:
+            for seq, data in rows:
+                message = json.loads(data)
+                message["seq"] = seq
+                f.write(json.dumps(message, separators=(",", ":")) + "\n")
+        os.replace(archive_path + ".tmp", archive_path)
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM messages WHERE seq <= ?", (cutoff,))
+        self.search_index.prune_below(cutoff + 1)
+        return len(rows)
+
+    # -- stats ---------------------------------------------------------------
+
+    def load_stats(self):
+        conn = self._connection()
+        stats = empty_stats()
+        for name, value in conn.execute("SELECT name, value FROM counters"):
+            stats[name] = value
+        stats["messages_per_user"] = dict(conn.execute("SELECT user_id, value FROM message_counts"))
+        return stats
+
+    def recount_stats(self):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM counters")
+            conn.execute("DELETE FROM message_counts")
+            conn.execute("INSERT INTO counters (name, value) SELECT 'messages', COUNT(*) FROM messages")
+            conn.execute("INSERT INTO counters (name, value) SELECT 'users', COUNT(*) FROM users")
+            conn.execute(
+                "INSERT INTO counters (name, value) SELECT 'banned', COUNT(*) FROM users"
+                " WHERE json_extract(data, '$.status') IS 'banned'"
+            )
+            conn.execute(
+                "INSERT INTO message_counts (user_id, value)"
+                " SELECT COALESCE(user_id, 'None'), COUNT(*) FROM messages GROUP BY 1"
+            )
+        return self.load_stats()
+
+    # -- settings ------------------------------------------------------------
+
+    def load_settings(self):
+        rows = self._connection().execute("SELECT key, value FROM settings").fetchall()
+        if not rows:
+            return None
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_settings(self, settings):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM settings")
+            conn.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in settings.items()],
+            )
@@ -0,0 +1,5 @@
+"""
+Benchmarks for the storage layer and the app.
+
+Run from the repository root, e.g. ``python -m benchmarks.storage_bench``.
+"""
@@ -0,0 +1,310 @@
+"""
+End-to-end load simulator for one app.py process.
+
+Drives many simulated chat sessions through app.py with Streamlit's AppTest,
+all in this process, so they share the message cache, the write queue and
+the storage backend the way concurrent browser sessions on one server do.
+Every session behaves like an idle reader: it renders the chat, then waits
+for the shared cache to change and renders again, i.e. a browser whose pane
+refresh fires as soon as there is something new. Writers additionally send a message at random
+intervals through the chat input.
+
+Reports p50/p95/p99 rerun time (refreshes and sends separately), how long a
+sent message takes to show up in other sessions, storage operations per
+second and process RSS. AppTest swaps a process-wide runtime in and out
+around each run, so script runs are serialized here; rerun times are
+measured inside that lock and queueing behind other sessions shows up in
+the send-to-visible latency instead. AppTest cannot run a fragment on its
+own, so every refresh is a full script run. Session roles and send
+intervals come from --seed, so runs are repeatable::
+
+    python -m benchmarks.load_sim --sessions 50 --writers 0.2 --duration 30
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+import storage
+from backends import create_backend, set_backend
+from firebase_emulator import FirebaseEmulator
+from message_cache import MessageCache
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+# AppTest is not safe to run concurrently (see the module docstring)
+_run_lock = threading.Lock()
+# Seconds between checks of the shared cache's version while a session idles
+VERSION_POLL_INTERVAL = 0.05
+
+
+class CountingBackend:
+    """Wraps a storage backend and counts calls per method."""
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._lock = threading.Lock()
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.calls[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 2)
+    return {
+        "count": len(ordered),
+        "p50_ms": rank(50),
+        "p95_ms": rank(95),
+        "p99_ms": rank(99),
+        "max_ms": round(ordered[-1], 2),
+    }
+
+
+def wait_for_change(cache, seen_version, timeout, poll_interval=VERSION_POLL_INTERVAL):
+    """
+    Poll the shared cache until its version differs from ``seen_version`` or
+    ``timeout`` passes; returns the version. Delivery in the app is poll-based
+    (the pane's fragment timer), this only polls much faster than a browser.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        version = cache.refresh()
+        remaining = deadline - time.monotonic()
+        if version != seen_version or remaining <= 0:
+            return version
+        time.sleep(min(remaining, poll_interval))
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux (peak, not current)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.refresh_ms = []
+        self.send_ms = []
+        self.visible_ms = []
+        self.sent = {}  # token -> (session index, send time)
+        self.errors = Counter()
+        self.peak_rss = current_rss_mb()
+        self.stopping = threading.Event()
+
+    # -- one session -----------------------------------------------------------
+
+    def new_app(self, index):
+        at = AppTest.from_file(APP_PATH, default_timeout=self.args.run_timeout)
+        at.session_state["authenticated"] = True
+        at.session_state["current_user"] = f"user{index}"
+        at.session_state["is_admin"] = False
+        return at
+
+    def timed_run(self, at, samples, chat_text=None):
+        with _run_lock:
+            start = time.perf_counter()
+            try:
+                if chat_text is None:
+                    at.run()
+                else:
+                    at.chat_input[0].set_value(chat_text).run()
+            except Exception as e:
+                with self.lock:
+                    self.errors[type(e).__name__] += 1
+                return False
+            elapsed = (time.perf_counter() - start) * 1000
+        with self.lock:
+            samples.append(elapsed)
+            for exception in at.exception:
+                self.errors[exception.message[:80]] += 1
+        return True
+
+    def check_visible(self, at, index, seen):
+        text = " ".join(m.value for m in at.markdown)
+        now = time.perf_counter()
+        with self.lock:
+            pending = [(t, sent) for t, sent in self.sent.items() if t not in seen and sent[0] != index]
+        for token, (_, sent_at) in pending:
+            if token in text:
+                seen.add(token)
+                with self.lock:
+                    self.visible_ms.append((now - sent_at) * 1000)
+
+    def session(self, index, is_writer, rng, cache, deadline):
+        at = self.new_app(index)
+        seen = set()
+        counter = 0
+        next_send = time.perf_counter() + rng.expovariate(1 / self.args.send_interval)
+        while time.perf_counter() < deadline and not self.stopping.is_set():
+            if is_writer and time.perf_counter() >= next_send:
+                token = f"load-{index}-{counter}"
+                counter += 1
+                with self.lock:
+                    self.sent[token] = (index, time.perf_counter())
+                ok = self.timed_run(at, self.send_ms, chat_text=f"{token} {'x' * rng.randrange(10, 120)}")
+                next_send = time.perf_counter() + rng.expovariate(1 / self.args.send_interval)
+            else:
+                ok = self.timed_run(at, self.refresh_ms)
+            if not ok:
+                # A timed-out run leaves the AppTest unusable
+                at = self.new_app(index)
+                continue
+            self.check_visible(at, index, seen)
+
+            # Idle until there is something new to show
+            seen_version = at.session_state["_load_sim_version"] if "_load_sim_version" in at.session_state else -1
+            timeout = min(self.args.idle_timeout, deadline - time.perf_counter())
+            if is_writer:
+                timeout = max(0.0, min(timeout, next_send - time.perf_counter()))
+            wait_for_change(cache, seen_version, timeout=timeout)
+
+    # -- whole run -------------------------------------------------------------
+
+    def monitor(self):
+        while not self.stopping.wait(0.5):
+            rss = current_rss_mb()
+            with self.lock:
+                self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self):
+        args = self.args
+        rng = random.Random(args.seed)
+        sessions = []
+        for index in range(args.sessions):
+            sessions.append((index, rng.random() < args.writers, random.Random(rng.random())))
+
+        original_snapshot = MessageCache.snapshot
+        shared = {}
+
+        def recording_snapshot(cache):
+            # Hand the shared cache and the version the pane rendered back to
+            # the simulator
+            version, messages = original_snapshot(cache)
+            shared["cache"] = cache
+            st.session_state["_load_sim_version"] = version
+            return version, messages
+
+        MessageCache.snapshot = recording_snapshot
+        try:
+            # Warm up: first import of app.py and cache creation
+            self.new_app(0).run()
+            cache = shared["cache"]
+
+            rss_start = current_rss_mb()
+            monitor = threading.Thread(target=self.monitor, daemon=True)
+            monitor.start()
+            started = time.perf_counter()
+            deadline = started + args.duration
+            threads = [
+                threading.Thread(target=self.session, args=(i, w, r, cache, deadline), daemon=True)
+                for i, w, r in sessions
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            self.stopping.set()
+        finally:
+            MessageCache.snapshot = original_snapshot
+
+        backend = storage.get_backend()
+        calls = dict(backend.calls) if isinstance(backend, CountingBackend) else {}
+        return {
+            "config": vars(args),
+            "sessions": {"total": args.sessions, "writers": sum(1 for s in sessions if s[1])},
+            "elapsed_s": round(elapsed, 2),
+            "refresh": percentiles(self.refresh_ms),
+            "send": percentiles(self.send_ms),
+            "send_to_visible": percentiles(self.visible_ms),
+            "messages_sent": len(self.sent),
+            "reruns_per_s": round((len(self.refresh_ms) + len(self.send_ms)) / elapsed, 2),
+            "storage_ops_per_s": round(sum(calls.values()) / elapsed, 2),
+            "storage_calls": calls,
+            "rss_mb": {"start": round(rss_start, 1), "peak": round(self.peak_rss, 1),
+                       "end": round(current_rss_mb(), 1)},
+            "errors": dict(self.errors),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent session load simulator for app.py")
+    parser.add_argument("--sessions", type=int, default=20, help="simulated chat sessions")
+    parser.add_argument("--writers", type=float, default=0.2, help="fraction of sessions that send")
+    parser.add_argument("--send-interval", type=float, default=5.0,
+                        help="mean seconds between messages per writer")
+    parser.add_argument("--idle-timeout", type=float, default=10.0,
+                        help="longest idle wait before a session reruns anyway")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    parser.add_argument("--run-timeout", type=float, default=30.0, help="AppTest timeout per rerun")
+    parser.add_argument("--backend", default="json", choices=["json", "sqlite", "firebase"])
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds of latency added by the Firebase stand-in")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    # AppTest outside a server logs "missing ScriptRunContext" on every access
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").disabled = True
+
+    with tempfile.TemporaryDirectory(prefix="chat-load-") as workdir:
+        emulator = None
+        firebase_url = None
+        if args.backend == "firebase":
+            emulator = FirebaseEmulator(latency=args.latency, seed=args.seed)
+            firebase_url = emulator.start()
+        try:
+            backend = create_backend(args.backend, firebase_db_url=firebase_url, database_dir=workdir)
+            set_backend(CountingBackend(backend))
+            for index in range(args.sessions):
+                storage.create_user(f"user{index}", {
+                    "name": f"user{index}",
+                    "email": f"user{index}@example.com",
+                    "status": "active",
+                })
+            report = Simulation(args).run()
+        finally:
+            if emulator:
+                emulator.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
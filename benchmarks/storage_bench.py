@@ -0,0 +1,210 @@
+"""
+Storage micro-benchmarks across history sizes.
+
+Times the storage calls behind the app's hot paths for stores holding N
+messages and N users:
+
+* ``save_global_chat_message``: append one message
+* ``load_global_chat``: cold window load (no cursor) and incremental poll
+* ``fetch_global_chat_before``: one "load older" page before the window
+* ``search_global_chat``: a two-word query with a user filter
+* ``load_users`` / ``save_users``: whole users tree
+* ``patch_user``: single-field update
+* ``find_username_by_email``: the login email lookup
+
+The Firebase path runs against firebase_emulator.py, mirrored to a JSON
+backend in a temporary directory, exactly as in production. Results are
+written as JSON so runs from two commits can be compared::
+
+    python -m benchmarks.storage_bench --output before.json
+    python -m benchmarks.storage_bench --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import storage
+from backends import FirebaseBackend, JsonBackend, SqliteBackend, email_key, new_push_key, set_backend
+from firebase_emulator import FirebaseEmulator
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+DEFAULT_BACKENDS = ["json", "firebase"]
+SEED_BATCH = 1000
+
+
+def make_message(i):
+    return {
+        "message_id": f"bench-{i}",
+        "user_id": f"user{i % 500}",
+        "content": f"benchmark message number {i}",
+        "timestamp": "2024-01-01 12:00:00",
+    }
+
+
+def make_users(count):
+    return {
+        f"user{i}": {
+            "email": f"user{i}@example.com",
+            "password": "0" * 64,
+            "created_at": "2024-01-01 12:00:00",
+            "status": "active",
+            "auth_provider": "local",
+        }
+        for i in range(count)
+    }
+
+
+def build_backend(name, size, workdir, emulator):
+    """Create a backend of the given kind holding `size` users and messages."""
+    directory = os.path.join(workdir, f"{name}-{size}")
+    users = make_users(size)
+    email_index = {email_key(u["email"]): username for username, u in users.items()}
+
+    if name == "firebase":
+        emulator.reset({
+            "users": users,
+            "user_emails": email_index,
+            "messages": {new_push_key(): make_message(i) for i in range(size)},
+        })
+        backend = FirebaseBackend(emulator.url, JsonBackend(directory))
+        # The local mirror starts empty, as on a fresh node
+        return backend
+
+    if name == "sqlite":
+        backend = SqliteBackend(os.path.join(directory, "chat.db"))
+    else:
+        backend = JsonBackend(directory)
+    backend.save_users(users)
+    backend.replace_email_index(email_index)
+    for start in range(0, size, SEED_BATCH):
+        backend.append_messages([make_message(i) for i in range(start, min(size, start + SEED_BATCH))])
+    return backend
+
+
+def time_calls(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        "runs": repeat,
+        "min_ms": round(min(samples), 3),
+        "median_ms": round(statistics.median(samples), 3),
+        "mean_ms": round(statistics.mean(samples), 3),
+        "max_ms": round(max(samples), 3),
+    }
+
+
+def run_operations(size, repeat, rng):
+    """Time each operation against the currently configured backend."""
+    counter = iter(range(size, size + 10 ** 9))
+    users = storage.load_users()
+    window = storage.fetch_global_chat()
+    cursor = window["cursor"]
+    oldest = storage.message_cursor(window["messages"][0]) if window["messages"] else None
+
+    operations = {
+        "save_global_chat_message": lambda: storage.save_global_chat_message(make_message(next(counter))),
+        "load_global_chat_cold": lambda: storage.fetch_global_chat(None, storage.CHAT_WINDOW_SIZE),
+        "load_global_chat_poll": lambda: storage.fetch_global_chat(cursor, storage.CHAT_WINDOW_SIZE),
+        "load_older_page": lambda: storage.fetch_global_chat_before(oldest, storage.CHAT_WINDOW_SIZE),
+        "search_global_chat": lambda: storage.search_global_chat(
+            f"message {rng.randrange(size)}", f"user{rng.randrange(500)}"
+        ),
+        "load_users": storage.load_users,
+        "save_users": lambda: storage.save_users(users),
+        "patch_user": lambda: storage.patch_user(f"user{rng.randrange(size)}", {"status": "active"}),
+        "find_username_by_email": lambda: storage.find_username_by_email(
+            f"user{rng.randrange(size)}@example.com"
+        ),
+    }
+    return {name: time_calls(func, repeat) for name, func in operations.items()}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the median ratio against a previous run."""
+    with open(baseline_path, "r") as f:
+        baseline = {
+            (r["backend"], r["size"], r["operation"]): r for r in json.load(f)["results"]
+        }
+    print(f"{'backend':<9} {'size':>7} {'operation':<26} {'before':>10} {'after':>10} {'ratio':>7}")
+    for r in results:
+        before = baseline.get((r["backend"], r["size"], r["operation"]))
+        if not before:
+            continue
+        ratio = r["median_ms"] / before["median_ms"] if before["median_ms"] else float("inf")
+        print(f"{r['backend']:<9} {r['size']:>7} {r['operation']:<26} "
+              f"{before['median_ms']:>10.3f} {r['median_ms']:>10.3f} {ratio:>7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Storage micro-benchmarks")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated history sizes (messages and users)")
+    parser.add_argument("--backends", default=",".join(DEFAULT_BACKENDS),
+                        help="comma-separated backends: json, sqlite, firebase")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per operation")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds of latency added by the Firebase stand-in")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="previous results file to compare medians against")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    rng = random.Random(args.seed)
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="chat-bench-") as workdir, \
+            FirebaseEmulator(latency=args.latency, seed=args.seed) as emulator:
+        for backend_name in backends:
+            for size in sizes:
+                print(f"{backend_name} / {size}...", file=sys.stderr)
+                set_backend(build_backend(backend_name, size, workdir, emulator))
+                for operation, stats in run_operations(size, args.repeat, rng).items():
+                    results.append({"backend": backend_name, "size": size, "operation": operation, **stats})
+        set_backend(None)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "latency": args.latency,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Circuit breakers for remote dependencies with a local fallback.
+
+A breaker starts ``closed`` and lets every call through. After
+``failure_threshold`` consecutive failures (timeouts, connection errors,
+5xx responses) it ``opens``: calls are refused right away, so callers use
+their fallback without waiting on a dead host. After ``reset_timeout``
+seconds the breaker goes ``half_open`` and lets exactly one probe call
+through. A successful probe closes it again; a failed one reopens it for
+twice as long, up to ``max_reset_timeout``.
+
+Breakers are shared process-wide by name (see ``get_breaker``), so every
+Streamlit session benefits from what the others found out. ``all_stats()``
+feeds the admin panel's Performance tab.
+
+Defaults come from ``BREAKER_FAILURES`` (5), ``BREAKER_RESET_TIMEOUT``
+(5 seconds) and ``BREAKER_MAX_RESET_TIMEOUT`` (300 seconds).
+"""
+import os
+import threading
+import time
+
+FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURES", "5"))
+RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "5"))
+MAX_RESET_TIMEOUT = float(os.getenv("BREAKER_MAX_RESET_TIMEOUT", "300"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT,
+                 max_reset_timeout=MAX_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._current_timeout = reset_timeout
+        self._open_until = 0.0
+        self._probing = False
+        self._opened = 0
+        self._rejected = 0
+        self._last_failure = None
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow(self):
+        """Whether a call may go out now; a True in half-open state is the probe."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.monotonic() >= self._open_until:
+                self._state = HALF_OPEN
+                self._probing = False
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self._rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+            self._current_timeout = self.reset_timeout
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._last_failure = time.time()
+            if self._state == HALF_OPEN:
+                # The probe failed: back off further
+                self._current_timeout = min(self._current_timeout * 2, self.max_reset_timeout)
+                self._open()
+            elif self._state == CLOSED and self._failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        # Called with the lock held
+        self._state = OPEN
+        self._probing = False
+        self._open_until = time.monotonic() + self._current_timeout
+        self._opened += 1
+
+    def reset(self):
+        """Close the breaker by hand (e.g. after fixing the outage)."""
+        self.record_success()
+
+    def stats(self):
+        with self._lock:
+            retry_in = max(0.0, self._open_until - time.monotonic()) if self._state == OPEN else 0.0
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "times_opened": self._opened,
+                "rejected_calls": self._rejected,
+                "retry_in_s": round(retry_in, 1),
+                "last_failure": self._last_failure,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name, **kwargs):
+    """Process-wide breaker called ``name``, created with ``kwargs`` on first use."""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name, **kwargs)
+        return breaker
+
+
+def all_stats():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
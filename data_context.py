@@ -0,0 +1,89 @@
+"""
+Per-rerun data context.
+
+A Streamlit rerun renders the sidebar, the chat pane and possibly the admin
+panel, each of which needs the signed-in user, the messages, the counters or
+the admin settings.
+``DataContext`` loads each dataset lazily on first use and returns the same
+object for the rest of the run, so a rerun reads every dataset at most once.
+A new context is created at the start of every run; nothing is shared
+between runs or sessions.
+
+``prefetch()`` starts several loaders at once on a process-wide thread pool,
+so a run waits for the slowest read instead of the sum of all of them. The
+loads share one deadline: a dataset still loading when it passes is replaced
+by its default for this run (and listed in ``timed_out``), while datasets
+without a default are waited for.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# Threads shared by the prefetches of every session
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+
+class DataContext:
+    def __init__(self, **loaders):
+        self._loaders = loaders
+        self._values = {}
+        self._pending = {}
+        self._defaults = {}
+        self._deadline = None
+        self.timed_out = set()
+
+    def prefetch(self, *names, timeout=None, defaults=None):
+        """
+        Start loading ``names`` in the background. ``defaults`` maps names to
+        the value used when that load is not done ``timeout`` seconds from now;
+        loaders must not touch Streamlit state, they run outside the script
+        thread.
+        """
+        self._defaults.update(defaults or {})
+        if timeout is not None:
+            self._deadline = time.monotonic() + timeout
+        for name in names:
+            if name not in self._values and name not in self._pending:
+                self._pending[name] = _executor.submit(self._loaders[name])
+
+    def get(self, name):
+        if name in self._pending:
+            self._values[name] = self._join(name, self._pending.pop(name))
+        if name not in self._values:
+            self._values[name] = self._loaders[name]()
+        return self._values[name]
+
+    def _join(self, name, future):
+        if name not in self._defaults or self._deadline is None:
+            return future.result()
+        try:
+            return future.result(max(0.0, self._deadline - time.monotonic()))
+        except TimeoutError:
+            # The load keeps running in the pool; its result is dropped
+            self.timed_out.add(name)
+            return self._defaults[name]
+
+    @property
+    def user(self):
+        # Record of the signed-in user, or None
+        return self.get("user")
+
+    @property
+    def stats(self):
+        # Maintained counters (see storage.load_stats)
+        return self.get("stats")
+
+    @property
+    def settings(self):
+        return self.get("settings")
+
+    @property
+    def message_snapshot(self):
+        # (version, messages) from the shared message cache
+        return self.get("message_snapshot")
+
+    @property
+    def messages(self):
+        return self.message_snapshot[1]
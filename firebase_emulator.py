@@ -0,0 +1,572 @@
+"""
+Local stand-in for the Firebase services used by the app.
+
+Implements, in memory, the subset of the Realtime Database REST API and the
+Identity Toolkit endpoints that app.py and the storage backends call, so the
+Firebase code paths can be benchmarked and regression-tested offline:
+
+* ``GET/PUT/POST/PATCH/DELETE /<path>.json`` including multi-path PATCH and
+  the ``{".sv": "timestamp"}`` / ``{".sv": {"increment": n}}`` server values;
+* queries: ``orderBy`` (``"$key"``, ``"$value"`` or a child key) with
+  ``startAt``, ``endAt``, ``equalTo``, ``limitToFirst``, ``limitToLast``, and
+  ``shallow=true``;
+* ETags: ``X-Firebase-ETag: true`` returns the ETag of the node, ``if-match``
+  makes PUT/DELETE conditional (412 on mismatch). As an extension a GET with
+  ``If-None-Match`` equal to the current ETag answers 304 without a body;
+* streaming: ``Accept: text/event-stream`` sends an initial ``put`` followed by
+  ``put``/``patch`` events for every change below the path, with keep-alives;
+* ``/v1/accounts:signUp``, ``:signInWithPassword`` and ``:signInWithIdp``.
+
+Latency and failures can be injected to see how the app behaves against a
+slow or flaky backend. Start it in-process::
+
+    with FirebaseEmulator(latency=0.02) as emulator:
+        os.environ["FIREBASE_DB_URL"] = emulator.url
+        os.environ["FIREBASE_AUTH_URL"] = emulator.url
+
+or standalone with ``python firebase_emulator.py --port 9000``.
+"""
+import argparse
+import hashlib
+import json
+import queue
+import random
+import threading
+import time
+import uuid
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from backends.firebase import new_push_key
+
+KEEP_ALIVE_INTERVAL = 30
+
+
+def _split_path(path):
+    return [unquote(part) for part in path.strip("/").split("/") if part]
+
+
+def _etag(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _key_order(key):
+    # Keys that parse as 32-bit integers sort first, numerically
+    try:
+        number = int(key)
+        if -2 ** 31 <= number < 2 ** 31 and str(number) == key:
+            return (0, number, "")
+    except (TypeError, ValueError):
+        pass
+    return (1, 0, str(key))
+
+
+def _value_order(value):
+    # null < false < true < numbers < strings < objects
+    if value is None:
+        return (0, 0, "")
+    if value is False:
+        return (1, 0, "")
+    if value is True:
+        return (2, 0, "")
+    if isinstance(value, (int, float)):
+        return (3, value, "")
+    if isinstance(value, str):
+        return (4, 0, value)
+    return (5, 0, "")
+
+
+def _prune(value):
+    # Firebase never stores nulls or empty objects
+    if isinstance(value, dict):
+        pruned = {}
+        for key, child in value.items():
+            child = _prune(child)
+            if child is not None:
+                pruned[key] = child
+        return pruned or None
+    return value
+
+
+class Database:
+    """The in-memory JSON tree with Firebase write semantics."""
+
+    def __init__(self):
+        self.root = None
+        self.lock = threading.RLock()
+        self._subscribers = []
+
+    def get(self, parts):
+        node = self.root
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def _resolve_server_values(self, parts, value):
+        if isinstance(value, dict):
+            if ".sv" in value:
+                server_value = value[".sv"]
+                if server_value == "timestamp":
+                    return int(time.time() * 1000)
+                if isinstance(server_value, dict) and "increment" in server_value:
+                    current = self.get(parts)
+                    if not isinstance(current, (int, float)) or isinstance(current, bool):
+                        current = 0
+                    return current + server_value["increment"]
+                return None
+            return {k: self._resolve_server_values(parts + [k], v) for k, v in value.items()}
+        return value
+
+    def _set(self, parts, value):
+        if not parts:
+            self.root = _prune(value)
+            return
+        if not isinstance(self.root, dict):
+            self.root = {}
+        node = self.root
+        trail = []
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                child = node[part] = {}
+            trail.append((node, part))
+            node = child
+        value = _prune(value)
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+        # Drop parents left empty by a delete
+        while trail and not node:
+            parent, part = trail.pop()
+            parent.pop(part, None)
+            node = parent
+        if not self.root:
+            self.root = None
+
+    def put(self, parts, value):
+        with self.lock:
+            value = self._resolve_server_values(parts, deepcopy(value))
+            self._set(parts, value)
+            self._notify(parts, {"": self.get(parts)})
+
+    def patch(self, parts, updates):
+        with self.lock:
+            resolved = {}
+            for path, value in updates.items():
+                child_parts = parts + _split_path(path)
+                value = self._resolve_server_values(child_parts, deepcopy(value))
+                self._set(child_parts, value)
+                resolved[path] = value
+            self._notify(parts, resolved)
+
+    # -- streaming -----------------------------------------------------------
+
+    def subscribe(self, parts):
+        events = queue.Queue()
+        with self.lock:
+            self._subscribers.append((parts, events))
+            events.put(("put", {"path": "/", "data": deepcopy(self.get(parts))}))
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self._subscribers = [s for s in self._subscribers if s[1] is not events]
+
+    def _notify(self, parts, updates):
+        """
+        Send the written ``updates`` (paths relative to ``parts``, "" for
+        ``parts`` itself) to each listener, as Firebase does: only the
+        changed paths below the listener, relative to it. A write at or above
+        the listener's path sends the node's new value as a ``put`` at "/".
+        """
+        changes = [(parts + _split_path(path), value) for path, value in updates.items()]
+        for sub_parts, events in self._subscribers:
+            depth = len(sub_parts)
+            below = {}
+            replaced = False
+            for change_parts, value in changes:
+                if len(change_parts) > depth and change_parts[:depth] == sub_parts:
+                    below["/".join(change_parts[depth:])] = value
+                elif sub_parts[:len(change_parts)] == change_parts:
+                    replaced = True
+            if replaced:
+                events.put(("put", {"path": "/", "data": deepcopy(self.get(sub_parts))}))
+            if len(below) == 1:
+                path, value = next(iter(below.items()))
+                events.put(("put", {"path": "/" + path, "data": deepcopy(value)}))
+            elif below:
+                events.put(("patch", {"path": "/", "data": deepcopy(below)}))
+
+
+def apply_query(value, params):
+    """Filter a node the way the Realtime Database REST API does."""
+    if not isinstance(value, dict) or "orderBy" not in params:
+        return value
+    order_by = json.loads(params["orderBy"])
+
+    def sort_key(item):
+        key, child = item
+        if order_by == "$key":
+            return _key_order(key)
+        if order_by == "$value":
+            return _value_order(child) + _key_order(key)
+        nested = child.get(order_by) if isinstance(child, dict) else None
+        return _value_order(nested) + _key_order(key)
+
+    def bound(raw):
+        bound_value = json.loads(raw)
+        if order_by == "$key":
+            return _key_order(str(bound_value))
+        return _value_order(bound_value)
+
+    items = sorted(value.items(), key=sort_key)
+    width = 3
+    if "startAt" in params:
+        lower = bound(params["startAt"])
+        items = [i for i in items if sort_key(i)[:width] >= lower]
+    if "endAt" in params:
+        upper = bound(params["endAt"])
+        items = [i for i in items if sort_key(i)[:width] <= upper]
+    if "equalTo" in params:
+        target = bound(params["equalTo"])
+        items = [i for i in items if sort_key(i)[:width] == target]
+    if "limitToFirst" in params:
+        items = items[:int(params["limitToFirst"])]
+    if "limitToLast" in params:
+        limit = int(params["limitToLast"])
+        items = items[-limit:] if limit else []
+    return dict(items)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FirebaseEmulator/1.0"
+    # Headers and body go out in separate writes; without TCP_NODELAY every
+    # keep-alive response waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def emulator(self):
+        return self.server.emulator
+
+    # -- helpers -------------------------------------------------------------
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        self.emulator._count_bytes(received=len(raw))
+        return json.loads(raw) if raw else None
+
+    def _send_json(self, status, value, headers=None):
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, header_value in (headers or {}).items():
+            self.send_header(name, header_value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.emulator._count_bytes(sent=len(body))
+
+    def _send_empty(self, status, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        for name, header_value in (headers or {}).items():
+            self.send_header(name, header_value)
+        self.end_headers()
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if self.emulator._before_request(method, url.path):
+            self._send_json(503, {"error": "Injected failure"})
+            return
+        if url.path.startswith("/v1/accounts:"):
+            self._handle_auth(url.path[len("/v1/accounts:"):])
+            return
+        if not url.path.endswith(".json"):
+            self._send_json(404, {"error": "Not found"})
+            return
+        parts = _split_path(url.path[:-len(".json")])
+        getattr(self, f"_db_{method.lower()}")(parts, params)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    # -- realtime database ---------------------------------------------------
+
+    def _etag_headers(self, value):
+        if self.headers.get("X-Firebase-ETag", "").lower() == "true":
+            return {"ETag": _etag(value)}
+        return {}
+
+    def _write_response(self, params, value, headers=None):
+        if params.get("print") == "silent":
+            self._send_empty(204, headers)
+        else:
+            self._send_json(200, value, headers)
+
+    def _check_if_match(self, parts):
+        expected = self.headers.get("if-match")
+        if expected is None:
+            return True
+        current = self.emulator.db.get(parts)
+        if _etag(current) == expected:
+            return True
+        self._send_json(412, current, {"ETag": _etag(current)})
+        return False
+
+    def _db_get(self, parts, params):
+        if "text/event-stream" in self.headers.get("Accept", ""):
+            self._stream(parts)
+            return
+        db = self.emulator.db
+        with db.lock:
+            value = deepcopy(db.get(parts))
+        if params.get("shallow") == "true" and isinstance(value, dict):
+            value = {key: True for key in value}
+        else:
+            value = apply_query(value, params)
+        etag = _etag(value)
+        if self.headers.get("If-None-Match") == etag:
+            self._send_empty(304, {"ETag": etag})
+            return
+        self._send_json(200, value, self._etag_headers(value))
+
+    def _db_put(self, parts, params):
+        value = self._read_body()
+        db = self.emulator.db
+        with db.lock:
+            if not self._check_if_match(parts):
+                return
+            db.put(parts, value)
+            stored = db.get(parts)
+        self._write_response(params, stored, self._etag_headers(stored))
+
+    def _db_post(self, parts, params):
+        value = self._read_body()
+        key = new_push_key()
+        self.emulator.db.put(parts + [key], value)
+        self._send_json(200, {"name": key})
+
+    def _db_patch(self, parts, params):
+        updates = self._read_body() or {}
+        self.emulator.db.patch(parts, updates)
+        self._write_response(params, updates)
+
+    def _db_delete(self, parts, params):
+        db = self.emulator.db
+        with db.lock:
+            if not self._check_if_match(parts):
+                return
+            db.put(parts, None)
+        self._write_response(params, None)
+
+    def _stream(self, parts):
+        db = self.emulator.db
+        events = db.subscribe(parts)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            while not self.emulator.stopping.is_set():
+                try:
+                    event, data = events.get(timeout=self.emulator.keep_alive_interval)
+                except queue.Empty:
+                    event, data = "keep-alive", None
+                chunk = f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+                self.wfile.write(chunk)
+                self.wfile.flush()
+                self.emulator._count_bytes(sent=len(chunk))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            db.unsubscribe(events)
+            self.close_connection = True
+
+    # -- identity toolkit ----------------------------------------------------
+
+    def _auth_error(self, message):
+        self._send_json(400, {"error": {"code": 400, "message": message}})
+
+    def _handle_auth(self, action):
+        payload = self._read_body() or {}
+        accounts = self.emulator.accounts
+        with self.emulator.accounts_lock:
+            if action == "signUp":
+                email = payload.get("email", "")
+                if email in accounts:
+                    self._auth_error("EMAIL_EXISTS")
+                    return
+                accounts[email] = {"password": payload.get("password"), "localId": uuid.uuid4().hex}
+            elif action == "signInWithPassword":
+                email = payload.get("email", "")
+                account = accounts.get(email)
+                if account is None:
+                    self._auth_error("EMAIL_NOT_FOUND")
+                    return
+                if account["password"] != payload.get("password"):
+                    self._auth_error("INVALID_PASSWORD")
+                    return
+            elif action == "signInWithIdp":
+                # Any id_token is accepted; tokens that look like an email
+                # address sign in as that address
+                post_body = parse_qs(payload.get("postBody", ""))
+                token = post_body.get("id_token", [""])[0]
+                email = token if "@" in token else f"{token or 'user'}@example.com"
+                accounts.setdefault(email, {"password": None, "localId": uuid.uuid4().hex})
+            else:
+                self._send_json(404, {"error": {"code": 404, "message": "NOT_FOUND"}})
+                return
+            account = accounts[email]
+        self._send_json(200, {
+            "localId": account["localId"],
+            "email": email,
+            "displayName": email.split("@")[0],
+            "idToken": uuid.uuid4().hex,
+            "refreshToken": uuid.uuid4().hex,
+            "expiresIn": "3600",
+        })
+
+
+class FirebaseEmulator:
+    """
+    In-process Firebase stand-in.
+
+    ``latency`` is a delay in seconds (or a ``(min, max)`` range) added to
+    every request, ``failure_rate`` the probability that a request answers
+    503. ``fail_next(n)`` fails the next n requests deterministically.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, failure_rate=0.0,
+                 seed=None, keep_alive_interval=KEEP_ALIVE_INTERVAL):
+        self.db = Database()
+        self.accounts = {}
+        self.accounts_lock = threading.Lock()
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.keep_alive_interval = keep_alive_interval
+        self.stopping = threading.Event()
+        self._random = random.Random(seed)
+        self._stats_lock = threading.Lock()
+        self._fail_next = 0
+        self.stats = {"requests": 0, "failures": 0, "bytes_sent": 0, "bytes_received": 0}
+        self.requests_by_method = {}
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.emulator = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="firebase-emulator", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.stopping.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def fail_next(self, count=1):
+        with self._stats_lock:
+            self._fail_next += count
+
+    def reset(self, data=None):
+        """Replace the whole database (and drop auth accounts)."""
+        self.db.put([], data)
+        with self.accounts_lock:
+            self.accounts.clear()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            for key in self.stats:
+                self.stats[key] = 0
+            self.requests_by_method.clear()
+
+    def _count_bytes(self, sent=0, received=0):
+        with self._stats_lock:
+            self.stats["bytes_sent"] += sent
+            self.stats["bytes_received"] += received
+
+    def _before_request(self, method, path):
+        # Returns True when the request should fail
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            with self._stats_lock:
+                latency = self._random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            self.requests_by_method[method] = self.requests_by_method.get(method, 0) + 1
+            fail = False
+            if self._fail_next:
+                self._fail_next -= 1
+                fail = True
+            elif self.failure_rate and self._random.random() < self.failure_rate:
+                fail = True
+            if fail:
+                self.stats["failures"] += 1
+            return fail
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Firebase Realtime Database stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability of a 503")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--data", help="JSON file to load as the initial database")
+    args = parser.parse_args()
+
+    emulator = FirebaseEmulator(args.host, args.port, latency=args.latency,
+                                failure_rate=args.failure_rate, seed=args.seed)
+    if args.data:
+        with open(args.data, "r") as f:
+            emulator.reset(json.load(f))
+    print(f"Firebase emulator listening on {emulator.url}")
+    print(f"  FIREBASE_DB_URL={emulator.url} FIREBASE_AUTH_URL={emulator.url}")
+    try:
+        emulator._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
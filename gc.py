@@ -1,9 +1,20 @@
-import streamlit as st
-import json
+import atexit
 import os
+import streamlit as st
 from datetime import datetime
 from uuid import uuid4
-import time
+import retention
+import storage
+from message_cache import MessageCache
+from render import CHAT_CSS, render_transcript
+
+# Number of messages shown, and twice that kept in the shared message cache
+CHAT_WINDOW_SIZE = storage.CHAT_WINDOW_SIZE
+MAX_LOCAL_MESSAGES = 2 * CHAT_WINDOW_SIZE
+
+# Seconds between retention passes; the window comes from the admin settings
+# (1000 messages by default, see retention.py)
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "300"))
 
 # Page configuration
 st.set_page_config(
@@ -19,135 +30,74 @@ def format_message_time():
 
 
 def save_global_chat_message(message):
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
+    storage.save_global_chat_message(message)
+    get_message_cache().add(message)
 
-        global_chat_file = "database/global_chat.json"
 
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "r") as f:
-                global_chat = json.load(f)
-        else:
-            global_chat = {"messages": []}
+@st.cache_resource
+def get_message_cache():
+    # Shared by all sessions of this process
+    return MessageCache(storage.fetch_global_chat, max_messages=MAX_LOCAL_MESSAGES, ttl=1)
 
-        global_chat["messages"].append(message)
 
-        # Keep only last 1000 messages
-        if len(global_chat["messages"]) > 1000:
-            global_chat["messages"] = global_chat["messages"][-1000:]
-
-        with open(global_chat_file, "w") as f:
-            json.dump(global_chat, f, indent=2)
-    except Exception:
-        pass
+@st.cache_resource
+def get_retention_job():
+    # One compaction thread per process, as in app.py
+    job = retention.RetentionJob(interval=RETENTION_INTERVAL)
+    atexit.register(job.stop)
+    return job
 
 
 def load_global_chat():
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-
-        global_chat_file = "database/global_chat.json"
-
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "r") as f:
-                global_chat = json.load(f)
-            return global_chat.get("messages", [])
-        return []
-    except Exception:
-        return []
+    return list(get_message_cache().snapshot()[1])
 
 
 def clear_global_chat():
-    try:
-        global_chat_file = "database/global_chat.json"
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "w") as f:
-                json.dump({"messages": []}, f, indent=2)
-    except Exception:
-        pass
+    storage.clear_global_chat()
+
+    get_message_cache().reset()
 
 
 def initialize_session():
     if "current_user" not in st.session_state:
         st.session_state.current_user = f"User_{str(uuid4())[:8]}"
-    if "last_global_check" not in st.session_state:
-        st.session_state.last_global_check = time.time()
+
+
+def message_counter():
+    st.metric("Total Messages", storage.load_stats()["messages"])
+
+
+def message_pane(current_user, auto_refresh):
+    # Runs as a fragment so auto-refresh re-executes only this pane
+    global_messages = load_global_chat()
+
+    if global_messages:
+        st.subheader("💬 Global Conversation")
+
+        # Status info
+        col1_status, col2_status = st.columns([2, 1])
+        with col1_status:
+            refresh_status = "ON" if auto_refresh else "OFF"
+            st.info(f"📊 {storage.load_stats()['messages']} messages • 🔄 Auto-refresh: {refresh_status}")
+        with col2_status:
+            current_time_str = datetime.now().strftime("%H:%M:%S")
+            st.caption(f"Last update: {current_time_str}")
+
+        # Message display: the last window of messages as one element
+        st.markdown(render_transcript(global_messages[-CHAT_WINDOW_SIZE:], current_user, time_prefix="🕐 "),
+                    unsafe_allow_html=True)
+    else:
+        st.info("🌟 Be the first to start the global conversation!")
+        st.markdown("**Welcome to Anonymous Chat!**")
+        st.markdown("- Chat with all users in real-time")
+        st.markdown("- Your messages appear on the right")
+        st.markdown("- Others' messages appear on the left")
+        st.markdown("- Messages refresh automatically every 3 seconds")
 
 
 def main():
     initialize_session()
-
-    # Custom CSS for chat styling
-    st.markdown("""
-    <style>
-    .chat-container {
-        display: flex;
-        flex-direction: column;
-        gap: 1rem;
-    }
-    .message-row-right {
-        display: flex;
-        justify-content: flex-end;
-        width: 100%;
-    }
-    .message-row-left {
-        display: flex;
-        justify-content: flex-start;
-        width: 100%;
-    }
-    .message-content {
-        max-width: 70%;
-        padding: 0.75rem;
-        border-radius: 0.5rem;
-        margin: 0.25rem;
-        background-color: var(--background-color);
-        border: 1px solid var(--border-color);
-        color: var(--text-color);
-    }
-    .message-time {
-        font-size: 0.8rem;
-        color: var(--secondary-text-color);
-        margin-top: 0.25rem;
-    }
-
-    /* Light mode */
-    [data-theme="light"] .message-content {
-        --background-color: #f8f9fa;
-        --border-color: #e9ecef;
-        --text-color: #333;
-        --secondary-text-color: #666;
-    }
-
-    /* Dark mode */
-    [data-theme="dark"] .message-content,
-    .stApp[data-theme="dark"] .message-content,
-    .message-content {
-        background-color: #2b2b2b !important;
-        border: 1px solid #404040 !important;
-        color: #ffffff !important;
-    }
-
-    [data-theme="dark"] .message-time,
-    .stApp[data-theme="dark"] .message-time,
-    .message-time {
-        color: #cccccc !important;
-    }
-
-    /* Fallback for any theme */
-    @media (prefers-color-scheme: dark) {
-        .message-content {
-            background-color: #2b2b2b !important;
-            border: 1px solid #404040 !important;
-            color: #ffffff !important;
-        }
-        .message-time {
-            color: #cccccc !important;
-        }
-    }
-    </style>
-    """, unsafe_allow_html=True)
+    get_retention_job()
 
     # Header
     col1, col2 = st.columns([3, 1])
@@ -174,79 +124,21 @@ def main():
 
         st.markdown("---")
 
-        # Chat statistics
-        global_messages = load_global_chat()
-        st.metric("Total Messages", len(global_messages))
-
         # Auto-refresh control
         auto_refresh = st.checkbox("Auto-refresh (3s)", value=True)
+        run_every = 3 if auto_refresh else None
+
+        # Chat statistics
+        st.fragment(message_counter, run_every=run_every)()
 
         if st.button("Refresh Now"):
             st.rerun()
 
-    # Auto-refresh logic
-    current_time = time.time()
-    time_since_last_check = current_time - st.session_state.last_global_check
-
-    if auto_refresh and time_since_last_check >= 3:
-        st.session_state.last_global_check = current_time
-        st.rerun()
-
     # Load and display messages
-    global_messages = load_global_chat()
     current_user = st.session_state.current_user
-
-    if global_messages:
-        st.subheader("💬 Global Conversation")
-
-        # Status info
-        col1_status, col2_status = st.columns([2, 1])
-        with col1_status:
-            refresh_status = "ON" if auto_refresh else "OFF"
-            st.info(f"📊 {len(global_messages)} messages • 🔄 Auto-refresh: {refresh_status}")
-        with col2_status:
-            current_time_str = datetime.now().strftime("%H:%M:%S")
-            st.caption(f"Last update: {current_time_str}")
-
-        # Message display
-        st.markdown('<div class="chat-container">', unsafe_allow_html=True)
-
-        # Show last 50 messages
-        for message in global_messages[-50:]:
-            content = message.get("content", "")
-            timestamp = message.get("timestamp", "")
-            message_user = message.get("user_id", "")
-
-            is_current_user = (message_user == current_user)
-
-            if is_current_user:
-                st.markdown(f"""
-                <div class="message-row-right">
-                    <div class="message-content">
-                        <div><strong>You:</strong> {content}</div>
-                        <div class="message-time">🕐 {timestamp}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div class="message-row-left">
-                    <div class="message-content">
-                        <div><strong>Anonymous:</strong> {content}</div>
-                        <div class="message-time">🕐 {timestamp}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-
-        st.markdown('</div>', unsafe_allow_html=True)
-        st.markdown("<div style='height: 20px;'></div>", unsafe_allow_html=True)
-    else:
-        st.info("🌟 Be the first to start the global conversation!")
-        st.markdown("**Welcome to Anonymous Chat!**")
-        st.markdown("- Chat with all users in real-time")
-        st.markdown("- Your messages appear on the right")
-        st.markdown("- Others' messages appear on the left")
-        st.markdown("- Messages refresh automatically every 3 seconds")
+    # The stylesheet is sent once per page, not with every pane refresh
+    st.markdown(CHAT_CSS, unsafe_allow_html=True)
+    st.fragment(message_pane, run_every=run_every)(current_user, auto_refresh)
 
     # Chat input
     if global_prompt := st.chat_input("Type your message..."):
@@ -259,14 +151,8 @@ def main():
         }
 
         save_global_chat_message(user_message)
-        st.session_state.last_global_check = time.time()
-        st.rerun()
-
-    # Auto-refresh at the end
-    if auto_refresh:
-        time.sleep(3)
         st.rerun()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,154 @@
+"""
+Shared HTTP client for the Firebase REST and Identity Toolkit calls.
+
+All requests to the same host go through one ``requests.Session`` whose
+adapter keeps a pool of keep-alive connections, so repeated calls reuse an
+open TCP/TLS connection instead of paying a new handshake each time. Sessions
+are created lazily per host and are safe to share between Streamlit sessions
+(the Firebase endpoints do not use cookies).
+
+Pool sizes come from ``HTTP_POOL_CONNECTIONS`` (number of per-host pools
+kept) and ``HTTP_POOL_MAXSIZE`` (connections kept open per host).
+
+Every new connection opened by the pools is counted per host, see
+``connection_stats``. Run ``python http_client.py URL [REQUESTS]`` to see how
+many connections a series of requests needs.
+"""
+import os
+import sys
+import threading
+from collections import Counter
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import metrics
+
+POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_new_connections = Counter()
+_stats_lock = threading.Lock()
+
+
+def _record_new_connection(host):
+    with _stats_lock:
+        _new_connections[host] += 1
+
+
+# Counting happens in connect() so reconnects of a pooled connection object
+# (server closed the keep-alive socket) are counted as new handshakes too.
+class CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        _record_new_connection(self.host)
+        super().connect()
+
+
+class CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _record_new_connection(self.host)
+        super().connect()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+
+class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+
+def _create_session():
+    session = requests.Session()
+    adapter = PooledAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(url):
+    """Return the shared session for the scheme and host of ``url``."""
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _create_session()
+                _sessions[key] = session
+    return session
+
+
+def request(method, url, **kwargs):
+    response = get_session(url).request(method, url, **kwargs)
+    # Payload sizes go to the storage/auth call in progress; streamed
+    # bodies are left unread
+    body = response.request.body
+    received = 0 if kwargs.get("stream") else len(response.content)
+    metrics.record_bytes(sent=len(body) if body else 0, received=received)
+    return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+
+def patch(url, **kwargs):
+    return request("PATCH", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
+
+
+def connection_stats():
+    """Number of connections opened so far, per host."""
+    with _stats_lock:
+        return dict(_new_connections)
+
+
+def reset_connection_stats():
+    with _stats_lock:
+        _new_connections.clear()
+
+
+def close_all():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python http_client.py URL [REQUESTS]")
+        sys.exit(1)
+    target = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    for _ in range(count):
+        get(target).content
+    opened = sum(connection_stats().values())
+    print(f"{count} requests to {target} opened {opened} connection(s)")
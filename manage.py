@@ -0,0 +1,58 @@
+"""
+Maintenance commands for the chat storage.
+
+Usage:
+    python manage.py rebuild-email-index
+    python manage.py compact-messages
+    python manage.py rebuild-search-index
+    python manage.py recount-stats
+"""
+import argparse
+
+import retention
+import storage
+
+
+def rebuild_email_index(args):
+    count = storage.rebuild_email_index()
+    print(f"Indexed {count} email address(es)")
+
+
+def compact_messages(args):
+    result = retention.compact_now()
+    print(f"Removed {result['removed']} message(s) in {result['duration_ms']:.0f} ms")
+
+
+def rebuild_search_index(args):
+    count = storage.rebuild_search_index()
+    print(f"Indexed {count} message(s)")
+
+
+def recount_stats(args):
+    stats = storage.recount_stats()
+    print(f"Counted {stats['messages']} message(s), {stats['users']} user(s), {stats['banned']} banned")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Anonymous Chat maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser(
+        "rebuild-email-index", help="recreate the email -> username index from the users tree"
+    ).set_defaults(func=rebuild_email_index)
+    commands.add_parser(
+        "compact-messages", help="apply the message retention settings once"
+    ).set_defaults(func=compact_messages)
+    commands.add_parser(
+        "rebuild-search-index", help="recreate the message search index from the message store"
+    ).set_defaults(func=rebuild_search_index)
+    commands.add_parser(
+        "recount-stats", help="recompute the message and user counters from the stored data"
+    ).set_defaults(func=recount_stats)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
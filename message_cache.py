@@ -0,0 +1,155 @@
+"""
+Process-wide cache of the newest chat messages.
+
+One instance is shared by every Streamlit session of the process (see
+``get_message_cache`` in app.py), so N connected users cost one storage poll
+per refresh interval instead of several reads per session and rerun.
+
+Invalidation rules:
+
+* a message written by this process is added to the cache directly and
+  bumps the version, no storage read is needed;
+* clearing the chat empties the cache and bumps the version;
+* after ``ttl`` seconds the next reader polls storage incrementally (since
+  the last cursor) to pick up writes from other processes; the version only
+  changes when that poll returned something new;
+* every ``resync_interval`` seconds the window is reloaded in full, which
+  catches deletes and clears done by other processes.
+
+Memory is bounded by ``max_messages``. The storage poll runs outside the
+lock, one at a time: other readers keep getting the current snapshot and
+``add()`` never waits on the network. Only the very first load makes
+readers wait for it.
+
+Delivery is poll-based: the chat pages refresh their message pane with a
+fragment timer (see app.py) and read ``snapshot()``; nothing is pushed to
+sessions.
+"""
+import threading
+import time
+from collections import deque
+
+
+class MessageCache:
+    def __init__(self, fetch, max_messages=1000, ttl=2.0, resync_interval=60.0):
+        # fetch(cursor, limit) -> {"messages": [...], "cursor": ..., "reset": bool}
+        self._fetch = fetch
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.resync_interval = resync_interval
+        self._lock = threading.Lock()
+        self._fetched = threading.Condition(self._lock)
+        self._fetching = False
+        # Messages added while a poll was running; a full reload keeps them
+        self._added_while_fetching = []
+        # Bumped by reset(), so a poll that started before it is dropped
+        self._generation = 0
+        self._messages = deque(maxlen=max_messages)
+        self._ids = set()
+        self._cursor = None
+        self._version = 0
+        self._snapshot = (0, ())
+        self._last_poll = None
+        self._last_resync = None
+
+    @property
+    def version(self):
+        return self._version
+
+    def _bump(self):
+        # Called with the lock held
+        self._version += 1
+
+    def _add(self, message):
+        message_id = message.get("message_id")
+        if message_id is not None:
+            if message_id in self._ids:
+                return False
+            self._ids.add(message_id)
+        if len(self._messages) == self._messages.maxlen:
+            evicted = self._messages[0].get("message_id")
+            self._ids.discard(evicted)
+        self._messages.append(message)
+        return True
+
+    def _replace(self, messages):
+        self._messages.clear()
+        self._ids.clear()
+        for message in messages:
+            self._add(message)
+
+    def _merge(self, result, now):
+        # Called with the lock held
+        self._last_poll = now
+        if result["reset"]:
+            self._last_resync = now
+            before = [m.get("message_id") for m in self._messages]
+            self._replace(result["messages"])
+            for message in self._added_while_fetching:
+                self._add(message)
+            changed = before != [m.get("message_id") for m in self._messages]
+        else:
+            changed = False
+            for message in result["messages"]:
+                changed = self._add(message) or changed
+        self._cursor = result["cursor"]
+        if changed:
+            self._bump()
+
+    def refresh(self, force=False):
+        """Poll storage if the TTL expired; returns the (possibly new) version."""
+        with self._lock:
+            now = time.monotonic()
+            if not (force or self._last_poll is None or now - self._last_poll >= self.ttl):
+                return self._version
+            if self._fetching:
+                # Another thread is polling; only wait when nothing is loaded yet
+                while self._fetching and self._last_poll is None:
+                    self._fetched.wait()
+                return self._version
+            self._fetching = True
+            full = (self._last_resync is None
+                    or now - self._last_resync >= self.resync_interval)
+            cursor = None if full else self._cursor
+            generation = self._generation
+        result = None
+        try:
+            result = self._fetch(cursor, self.max_messages)
+        finally:
+            with self._lock:
+                self._fetching = False
+                if result is not None and generation == self._generation:
+                    self._merge(result, now)
+                self._added_while_fetching = []
+                self._fetched.notify_all()
+        with self._lock:
+            return self._version
+
+    def snapshot(self):
+        """Return ``(version, messages)``; messages is an immutable tuple."""
+        self.refresh()
+        with self._lock:
+            if self._snapshot[0] != self._version:
+                self._snapshot = (self._version, tuple(self._messages))
+            return self._snapshot
+
+    def add(self, message):
+        with self._lock:
+            if self._fetching:
+                self._added_while_fetching.append(message)
+            if self._add(message):
+                self._bump()
+            return self._version
+
+    def reset(self):
+        with self._lock:
+            self._messages.clear()
+            self._ids.clear()
+            self._cursor = None
+            # Force a full reload on the next read
+            self._last_poll = None
+            self._last_resync = None
+            self._generation += 1
+            self._added_while_fetching = []
+            self._bump()
+            return self._version
@@ -0,0 +1,540 @@
+"""
+Append-only message log for the local chat store.
+
+Messages are written one JSON record per line into segment files named after
+the sequence number of their first record (``000000000001.jsonl``). Appending
+is O(1): the active segment is kept open in append mode and a send never
+rewrites existing data. When the active segment is full a new one is created
+atomically.
+
+Each segment has an index file (``000000000001.idx``) holding the byte
+offset of every record as a little-endian uint64, so ``read_before`` can
+seek straight to any page of history and only parse the records it returns.
+Indexes are rebuilt from the segment when missing or inconsistent. A
+partial last line left in the active segment by a crash is cut off before
+the next append, so that append begins on a new line.
+
+Several processes (app.py, gc.py, more than one server) may share a
+directory. Writers take an exclusive ``flock`` on ``<directory>/LOCK`` and
+re-read the active segment, its record count and size from disk under it
+before appending or rolling over, so sequence numbers and index offsets stay
+contiguous across processes. Where ``fcntl`` is unavailable (Windows) only
+threads of one process are serialized.
+
+Nothing is deleted on the send path: ``compact`` (run by the retention job,
+see retention.py) removes whole sealed segments that fall outside the
+retention window, optionally archiving them gzip-compressed first.
+"""
+import gzip
+import json
+import os
+import shutil
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+
+SEGMENT_SUFFIX = ".jsonl"
+INDEX_SUFFIX = ".idx"
+LOCK_NAME = "LOCK"
+_OFFSET = struct.Struct("<Q")
+DEFAULT_DIRECTORY = "database/global_chat"
+
+
+def _segment_name(base_seq):
+    return f"{base_seq:012d}{SEGMENT_SUFFIX}"
+
+
+def _fsync_directory(directory):
+    # Directory fsync makes file creation/rename durable; not supported everywhere
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class MessageLog:
+    def __init__(self, directory=DEFAULT_DIRECTORY, segment_max_records=500,
+                 fsync=FSYNC_INTERVAL, fsync_interval=1.0):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.directory = directory
+        self.segment_max_records = max(1, int(segment_max_records))
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._lock = threading.RLock()
+        self._lock_fd = None
+        self._lock_depth = 0
+        self._fd = None
+        self._index_fd = None
+        self._active_base = None
+        self._last_fsync = 0.0
+        self._open()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the thread lock and the file lock shared with other processes,
+        with the active segment state brought up to date from disk.
+        """
+        with self._lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                if self._lock_depth == 1:
+                    self._refresh()
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and fcntl is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # -- segment bookkeeping -------------------------------------------------
+
+    def _segment_bases(self):
+        bases = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    bases.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(bases)
+
+    def _segment_path(self, base_seq):
+        return os.path.join(self.directory, _segment_name(base_seq))
+
+    def _index_path(self, base_seq):
+        return os.path.join(self.directory, f"{base_seq:012d}{INDEX_SUFFIX}")
+
+    def _remove_segment(self, base_seq):
+        for path in (self._segment_path(base_seq), self._index_path(base_seq)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_fd = os.open(os.path.join(self.directory, LOCK_NAME), os.O_RDWR | os.O_CREAT)
+        self.next_seq = 1
+        with self._locked():
+            pass
+
+    def _refresh(self):
+        """Follow appends, rollovers and clears made by other processes."""
+        bases = self._segment_bases()
+        if not bases:
+            self._create_segment(self.next_seq)
+            return
+        path = self._segment_path(bases[-1])
+        try:
+            replaced = (self._fd is None or bases[-1] != self._active_base
+                        or os.fstat(self._fd).st_ino != os.stat(path).st_ino)
+        except FileNotFoundError:
+            replaced = True
+        if replaced:
+            self._attach(bases[-1])
+        elif os.fstat(self._fd).st_size != self._active_size:
+            self._attach(self._active_base)
+
+    def _attach(self, base_seq):
+        """Make ``base_seq`` the active segment, with its count and size taken from disk."""
+        if self._fd is not None:
+            os.close(self._fd)
+            os.close(self._index_fd)
+        self._fd = os.open(self._segment_path(base_seq), os.O_WRONLY | os.O_APPEND)
+        self._index_fd = os.open(self._index_path(base_seq), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        size = os.fstat(self._fd).st_size
+        index_size = os.fstat(self._index_fd).st_size
+        count = index_size // _OFFSET.size
+        if index_size % _OFFSET.size or not self._index_matches(base_seq, count, size):
+            # A write cut short by a crash, or an index lagging behind its
+            # segment: drop any partial line and index the segment again
+            self._truncate_torn_tail(base_seq)
+            count = len(self._rebuild_index(base_seq))
+            os.close(self._index_fd)
+            self._index_fd = os.open(self._index_path(base_seq), os.O_WRONLY | os.O_APPEND)
+            size = os.fstat(self._fd).st_size
+        self._active_base = base_seq
+        self._active_count = count
+        self._active_size = size
+        self.next_seq = base_seq + count
+
+    def _index_matches(self, base_seq, count, size):
+        # The last index entry must point at a single complete line ending
+        # the segment
+        if count == 0:
+            return size == 0
+        with open(self._index_path(base_seq), "rb") as f:
+            f.seek((count - 1) * _OFFSET.size)
+            last, = _OFFSET.unpack(f.read(_OFFSET.size))
+        if last >= size:
+            return False
+        with open(self._segment_path(base_seq), "rb") as f:
+            f.seek(last)
+            tail = f.read(size - last)
+        return tail.endswith(b"\n") and tail.count(b"\n") == 1
+
+    def _truncate_torn_tail(self, base_seq):
+        """Cut everything after the last newline (a torn write) off a segment."""
+        with open(self._segment_path(base_seq), "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            keep = 0
+            while end > 0:
+                start = max(0, end - 65536)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    keep = start + newline + 1
+                    break
+                end = start
+            if keep < size:
+                f.truncate(keep)
+                os.fsync(f.fileno())
+
+    def _create_segment(self, base_seq):
+        # Called under the file lock with next_seq read from disk, so no
+        # other process can have created this segment. It is built under a
+        # temporary name and renamed into place, so readers either see a
+        # complete segment or none at all.
+        path = self._segment_path(base_seq)
+        index_path = self._index_path(base_seq)
+        if not os.path.exists(path):
+            for new_path in (index_path, path):
+                tmp_path = new_path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, new_path)
+            _fsync_directory(self.directory)
+        self._attach(base_seq)
+
+    def _roll_over(self):
+        self._sync(force=True)
+        self._create_segment(self.next_seq)
+
+    def _archive_segment(self, base_seq, archive_dir):
+        os.makedirs(archive_dir, exist_ok=True)
+        name = os.path.basename(os.path.normpath(self.directory))
+        archive_path = os.path.join(archive_dir, f"{name}-{_segment_name(base_seq)}.gz")
+        tmp_path = archive_path + ".tmp"
+        with open(self._segment_path(base_seq), "rb") as src, gzip.open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, archive_path)
+        return archive_path
+
+    def _sync(self, force=False):
+        if self._fd is None or self.fsync == FSYNC_NEVER:
+            return
+        now = time.monotonic()
+        if (force or self.fsync == FSYNC_ALWAYS
+                or now - self._last_fsync >= self.fsync_interval):
+            os.fsync(self._fd)
+            if force:
+                # The index can be rebuilt from the segment, so it is only
+                # made durable when the segment is sealed or closed
+                os.fsync(self._index_fd)
+            self._last_fsync = now
+
+    def _read_segment(self, base_seq):
+        records = []
+        try:
+            with open(self._segment_path(base_seq), "rb") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Torn write from a crash: skip the partial line
+                        continue
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _scan_offsets(self, base_seq):
+        """Byte offset of every complete, parseable record in a segment."""
+        offsets = []
+        try:
+            with open(self._segment_path(base_seq), "rb") as f:
+                position = 0
+                for line in f:
+                    if line.endswith(b"\n"):
+                        try:
+                            json.loads(line)
+                            offsets.append(position)
+                        except ValueError:
+                            pass
+                    position += len(line)
+        except FileNotFoundError:
+            pass
+        return offsets
+
+    def _rebuild_index(self, base_seq):
+        offsets = self._scan_offsets(base_seq)
+        index_path = self._index_path(base_seq)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(_OFFSET.pack(offset) for offset in offsets))
+        os.replace(tmp_path, index_path)
+        return offsets
+
+    def _read_records(self, base_seq, first, last, count):
+        """
+        Records ``first``..``last`` (positions within the segment) using the
+        index: two offset lookups and one read of just those lines.
+        """
+        try:
+            with open(self._index_path(base_seq), "rb") as f:
+                if os.fstat(f.fileno()).st_size < count * _OFFSET.size:
+                    raise ValueError("index is shorter than the segment")
+                f.seek(first * _OFFSET.size)
+                entries = f.read((last - first + 2) * _OFFSET.size)
+            offsets = [entry[0] for entry in _OFFSET.iter_unpack(entries[:len(entries) - len(entries) % _OFFSET.size])]
+            begin = offsets[0]
+            end = offsets[last - first + 1] if last + 1 < count else None
+            with open(self._segment_path(base_seq), "rb") as f:
+                f.seek(begin)
+                data = f.read() if end is None else f.read(end - begin)
+            records = [json.loads(line) for line in data.splitlines()[:last - first + 1]]
+            if [r.get("seq") for r in records] == list(range(base_seq + first, base_seq + last + 1)):
+                return records
+        except (OSError, ValueError, IndexError):
+            pass
+        # Missing or stale index (e.g. a segment written before indexes
+        # existed): rebuild it and fall back to a scan of this segment
+        if base_seq != self._active_base:
+            self._rebuild_index(base_seq)
+        wanted = range(base_seq + first, base_seq + last + 1)
+        return [r for r in self._read_segment(base_seq) if r.get("seq") in wanted]
+
+    # -- public API ----------------------------------------------------------
+
+    def append(self, message):
+        return self.extend([message])[-1]
+
+    def extend(self, messages):
+        """Append messages and return the sequence numbers assigned to them."""
+        seqs = []
+        with self._locked():
+            offsets = []
+            for message in messages:
+                if self._active_count >= self.segment_max_records:
+                    os.write(self._index_fd, b"".join(offsets))
+                    offsets = []
+                    self._roll_over()
+                record = dict(message)
+                record["seq"] = self.next_seq
+                line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+                os.write(self._fd, line)
+                offsets.append(_OFFSET.pack(self._active_size))
+                self._active_size += len(line)
+                seqs.append(self.next_seq)
+                self.next_seq += 1
+                self._active_count += 1
+            os.write(self._index_fd, b"".join(offsets))
+            self._sync()
+        return seqs
+
+    def read_tail(self, limit=None):
+        """Return the newest ``limit`` messages (all when None), oldest first."""
+        with self._lock:
+            bases = self._segment_bases()
+        chunks = []
+        total = 0
+        for base in reversed(bases):
+            records = self._read_segment(base)
+            chunks.append(records)
+            total += len(records)
+            if limit is not None and total >= limit:
+                break
+        messages = [m for chunk in reversed(chunks) for m in chunk]
+        if limit is not None:
+            messages = messages[-limit:] if limit else []
+        return messages
+
+    def read_since(self, seq, limit=None):
+        """Return messages with a sequence number greater than ``seq``.
+
+        Only the segments that can hold newer records are read, so a poll
+        costs O(new messages) rather than O(history).
+        """
+        with self._lock:
+            bases = self._segment_bases()
+        chunks = []
+        for base in reversed(bases):
+            records = [r for r in self._read_segment(base) if r.get("seq", 0) > seq]
+            chunks.append(records)
+            if base <= seq + 1:
+                break
+        messages = [m for chunk in reversed(chunks) for m in chunk]
+        if limit is not None:
+            messages = messages[-limit:] if limit else []
+        return messages
+
+    def read_before(self, seq, limit):
+        """
+        Return up to ``limit`` messages with a sequence number below ``seq``,
+        oldest first, and whether even older messages exist.
+
+        Only the index entries and lines of the requested page are read, so
+        the cost does not depend on how much history is stored.
+        """
+        with self._locked():
+            bases = self._segment_bases()
+            active_base, active_count = self._active_base, self._active_count
+        if not bases or limit <= 0:
+            return [], False
+        oldest = bases[0]
+        low = max(oldest, seq - limit)
+        high = min(seq - 1, active_base + active_count - 1)
+        chunks = []
+        for i in range(len(bases) - 1, -1, -1):
+            base = bases[i]
+            if base > high:
+                continue
+            count = active_count if base == active_base else bases[i + 1] - base
+            first, last = max(low, base) - base, min(high, base + count - 1) - base
+            if first <= last:
+                chunks.append(self._read_records(base, first, last, count))
+            if base <= low:
+                break
+        messages = [m for chunk in reversed(chunks) for m in chunk]
+        return messages, low > oldest
+
+    def compact(self, max_records=0, max_age=0, max_bytes=0, archive_dir=None):
+        """
+        Remove the oldest sealed segments outside the retention window.
+
+        A segment expires when all of its messages are older than the newest
+        ``max_records``, when it was last written more than ``max_age``
+        seconds ago, or while the log is larger than ``max_bytes``; a zero
+        limit is disabled. The active segment is never removed. Expired
+        segments are gzip-copied into ``archive_dir`` first when given.
+        Returns the number of messages removed.
+        """
+        with self._locked():
+            bases = self._segment_bases()
+            next_seq = self.next_seq
+        sizes = {}
+        for base in bases:
+            try:
+                sizes[base] = os.path.getsize(self._segment_path(base))
+            except OSError:
+                sizes[base] = 0
+        total_bytes = sum(sizes.values())
+        now = time.time()
+
+        removed = 0
+        # Segments are removed oldest first so the log stays contiguous
+        for base, next_base in zip(bases, bases[1:]):
+            path = self._segment_path(base)
+            try:
+                too_old = bool(max_age) and os.path.getmtime(path) < now - max_age
+            except OSError:
+                too_old = False
+            if not ((max_records and next_base <= next_seq - max_records)
+                    or too_old
+                    or (max_bytes and total_bytes > max_bytes)):
+                break
+            try:
+                if archive_dir:
+                    self._archive_segment(base, archive_dir)
+            except FileNotFoundError:
+                pass
+            self._remove_segment(base)
+            total_bytes -= sizes[base]
+            removed += next_base - base
+        return removed
+
+    def clear(self):
+        with self._locked():
+            for base in self._segment_bases():
+                self._remove_segment(base)
+            # Sequence numbers keep increasing across clears
+            self._create_segment(self.next_seq)
+
+    def seq_range(self):
+        """``(first_seq, next_seq)``: the oldest stored sequence number and the next one to assign."""
+        with self._locked():
+            return self._segment_bases()[0], self.next_seq
+
+    @property
+    def first_seq(self):
+        """Sequence number of the oldest stored message (next_seq when empty)."""
+        return self.seq_range()[0]
+
+    def __len__(self):
+        """Number of messages stored (sequence numbers are contiguous)."""
+        first_seq, next_seq = self.seq_range()
+        return next_seq - first_seq
+
+    def is_empty(self):
+        with self._locked():
+            bases = self._segment_bases()
+            return bases == [self._active_base] and self._active_count == 0
+
+    def migrate_from_json(self, legacy_path):
+        """One-time import of the old ``{"messages": [...]}`` chat file."""
+        if not os.path.exists(legacy_path):
+            return 0
+        with self._locked():
+            if not self.is_empty():
+                return 0
+            with open(legacy_path, "r") as f:
+                messages = json.load(f).get("messages", [])
+            if messages:
+                self.extend(messages)
+                self._sync(force=True)
+            os.replace(legacy_path, legacy_path + ".migrated")
+            return len(messages)
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                self._sync(force=True)
+                os.close(self._fd)
+                os.close(self._index_fd)
+                os.close(self._lock_fd)
+                self._fd = None
+                self._index_fd = None
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def get_message_log(directory=DEFAULT_DIRECTORY):
+    """
+    Process-wide log for ``directory``, configured from the environment.
+
+    On first use the legacy ``<directory>.json`` chat file is migrated into it.
+    """
+    directory = os.path.normpath(directory)
+    with _logs_lock:
+        log = _logs.get(directory)
+        if log is None:
+            log = MessageLog(
+                directory,
+                segment_max_records=int(os.getenv("MESSAGE_LOG_SEGMENT_RECORDS", "500")),
+                fsync=os.getenv("MESSAGE_LOG_FSYNC", FSYNC_INTERVAL),
+                fsync_interval=float(os.getenv("MESSAGE_LOG_FSYNC_INTERVAL", "1.0")),
+            )
+            log.migrate_from_json(directory + ".json")
+            _logs[directory] = log
+        return log
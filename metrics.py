@@ -0,0 +1,210 @@
+"""
+In-process metrics for storage and auth calls.
+
+Functions decorated with ``timed`` record a call count, an error count and a
+latency histogram under their operation name. While such a call runs, code
+further down (the Firebase backend, the HTTP client) can attribute events to
+it without knowing its name:
+
+* ``record_error()``: a failure that was handled and not re-raised
+* ``record_fallback()``: Firebase was unavailable and local data was used
+* ``record_bytes(sent, received)``: HTTP payload sizes
+
+Events outside any timed call are attributed to ``"other"``. ``snapshot()``
+returns everything as plain dicts (shown in the admin panel) and
+``to_prometheus()`` renders the Prometheus text format. Setting
+``METRICS_PORT`` makes the app serve that text on ``/metrics``.
+"""
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_operations = {}
+_active = threading.local()
+
+
+class _Operation:
+    __slots__ = ("calls", "errors", "fallbacks", "bytes_sent", "bytes_received",
+                 "total_seconds", "max_seconds", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        # One counter per bucket plus the +Inf bucket, not cumulative
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, in seconds."""
+        if not self.calls:
+            return 0.0
+        target = self.calls * p / 100
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max_seconds
+
+
+def _operation(name):
+    # Callers hold _lock
+    op = _operations.get(name)
+    if op is None:
+        op = _operations[name] = _Operation()
+    return op
+
+
+def _current():
+    stack = getattr(_active, "stack", None)
+    return stack[-1] if stack else "other"
+
+
+def observe(name, seconds, error=False):
+    with _lock:
+        op = _operation(name)
+        op.calls += 1
+        op.total_seconds += seconds
+        op.max_seconds = max(op.max_seconds, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                op.buckets[i] += 1
+                break
+        else:
+            op.buckets[-1] += 1
+        if error:
+            op.errors += 1
+
+
+def timed(name=None):
+    """
+    Decorator recording calls, raised errors and latency of a function under
+    ``name`` (default ``module.function``).
+    """
+    def decorator(func):
+        op_name = name or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = getattr(_active, "stack", None)
+            if stack is None:
+                stack = _active.stack = []
+            stack.append(op_name)
+            start = time.perf_counter()
+            error = False
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                error = True
+                raise
+            finally:
+                stack.pop()
+                observe(op_name, time.perf_counter() - start, error)
+        return wrapper
+    return decorator
+
+
+def record_error(name=None):
+    with _lock:
+        _operation(name or _current()).errors += 1
+
+
+def record_fallback(name=None):
+    with _lock:
+        _operation(name or _current()).fallbacks += 1
+
+
+def record_bytes(sent=0, received=0, name=None):
+    with _lock:
+        op = _operation(name or _current())
+        op.bytes_sent += sent
+        op.bytes_received += received
+
+
+def snapshot():
+    """Per-operation metrics, latencies in milliseconds."""
+    with _lock:
+        return {
+            name: {
+                "calls": op.calls,
+                "errors": op.errors,
+                "fallbacks": op.fallbacks,
+                "bytes_sent": op.bytes_sent,
+                "bytes_received": op.bytes_received,
+                "mean_ms": op.total_seconds / op.calls * 1000 if op.calls else 0.0,
+                "p50_ms": op.percentile(50) * 1000,
+                "p95_ms": op.percentile(95) * 1000,
+                "p99_ms": op.percentile(99) * 1000,
+                "max_ms": op.max_seconds * 1000,
+            }
+            for name, op in sorted(_operations.items())
+        }
+
+
+def reset():
+    with _lock:
+        _operations.clear()
+
+
+def to_prometheus(prefix="chat"):
+    """Render all metrics in the Prometheus text exposition format."""
+    with _lock:
+        operations = sorted(_operations.items())
+        lines = []
+
+        def counter(metric, help_text, attr):
+            lines.append(f"# HELP {prefix}_{metric} {help_text}")
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            for name, op in operations:
+                lines.append(f'{prefix}_{metric}{{operation="{name}"}} {getattr(op, attr)}')
+
+        counter("operation_errors_total", "Failed calls, raised or handled.", "errors")
+        counter("operation_fallbacks_total", "Reads or writes served by local storage instead of Firebase.", "fallbacks")
+        counter("operation_bytes_sent_total", "HTTP request payload bytes.", "bytes_sent")
+        counter("operation_bytes_received_total", "HTTP response payload bytes.", "bytes_received")
+
+        metric = f"{prefix}_operation_duration_seconds"
+        lines.append(f"# HELP {metric} Call latency.")
+        lines.append(f"# TYPE {metric} histogram")
+        for name, op in operations:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, op.buckets):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{operation="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{operation="{name}",le="+Inf"}} {op.calls}')
+            lines.append(f'{metric}_sum{{operation="{name}"}} {op.total_seconds:.6f}')
+            lines.append(f'{metric}_count{{operation="{name}"}} {op.calls}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port, host="0.0.0.0"):
+    """Serve ``/metrics`` from a background thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
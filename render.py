@@ -0,0 +1,129 @@
+"""
+HTML rendering of the chat transcript.
+
+The transcript is sent as a single markdown element with one fragment per
+message. ``CHAT_CSS`` is sent once per page as its own element, outside the
+auto-refreshing message pane, so refreshes do not resend the stylesheet. Message text is HTML-escaped. Fragments are
+cached by message id and side (own messages on the right, others on the
+left), so each message is rendered once no matter how many reruns and
+sessions show it.
+"""
+import threading
+from collections import OrderedDict
+from html import escape
+
+# Fragments kept in the cache; two per message covers both sides of the
+# shared message window
+MAX_CACHED_FRAGMENTS = 4096
+
+CHAT_CSS = """<style>
+.chat-container {
+    display: flex;
+    flex-direction: column;
+    gap: 1rem;
+}
+.message-row-right {
+    display: flex;
+    justify-content: flex-end;
+    width: 100%;
+}
+.message-row-left {
+    display: flex;
+    justify-content: flex-start;
+    width: 100%;
+}
+.message-content {
+    max-width: 70%;
+    padding: 0.75rem;
+    border-radius: 0.5rem;
+    margin: 0.25rem;
+    background-color: var(--background-color);
+    border: 1px solid var(--border-color);
+    color: var(--text-color);
+}
+.message-time {
+    font-size: 0.8rem;
+    color: var(--secondary-text-color);
+    margin-top: 0.25rem;
+}
+
+/* Light mode */
+[data-theme="light"] .message-content {
+    --background-color: #f8f9fa;
+    --border-color: #e9ecef;
+    --text-color: #333;
+    --secondary-text-color: #666;
+}
+
+/* Dark mode */
+[data-theme="dark"] .message-content,
+.stApp[data-theme="dark"] .message-content,
+.message-content {
+    background-color: #2b2b2b !important;
+    border: 1px solid #404040 !important;
+    color: #ffffff !important;
+}
+
+[data-theme="dark"] .message-time,
+.stApp[data-theme="dark"] .message-time,
+.message-time {
+    color: #cccccc !important;
+}
+
+/* Fallback for any theme */
+@media (prefers-color-scheme: dark) {
+    .message-content {
+        background-color: #2b2b2b !important;
+        border: 1px solid #404040 !important;
+        color: #ffffff !important;
+    }
+    .message-time {
+        color: #cccccc !important;
+    }
+}
+</style>"""
+
+_fragments = OrderedDict()
+_fragments_lock = threading.Lock()
+
+
+def _render(message, own, time_prefix):
+    content = escape(str(message.get("content", ""))).replace("\n", "<br>")
+    timestamp = escape(str(message.get("timestamp", "")))
+    side, author = ("right", "You") if own else ("left", "Anonymous")
+    return (
+        f'<div class="message-row-{side}"><div class="message-content">'
+        f"<div><strong>{author}:</strong> {content}</div>"
+        f'<div class="message-time">{time_prefix}{timestamp}</div>'
+        "</div></div>"
+    )
+
+
+def render_message(message, own, time_prefix=""):
+    """HTML for one message, cached by (message_id, side)."""
+    message_id = message.get("message_id")
+    if not message_id:
+        return _render(message, own, time_prefix)
+    key = (message_id, own, time_prefix)
+    with _fragments_lock:
+        fragment = _fragments.get(key)
+        if fragment is not None:
+            _fragments.move_to_end(key)
+            return fragment
+    fragment = _render(message, own, time_prefix)
+    with _fragments_lock:
+        _fragments[key] = fragment
+        while len(_fragments) > MAX_CACHED_FRAGMENTS:
+            _fragments.popitem(last=False)
+    return fragment
+
+
+def render_transcript(messages, current_user, time_prefix=""):
+    """All messages as one HTML block for ``st.markdown`` (styled by ``CHAT_CSS``)."""
+    # No blank lines: the markdown renderer treats the whole string as one
+    # raw HTML block
+    parts = ['<div class="chat-container">']
+    for message in messages:
+        parts.append(render_message(message, message.get("user_id", "") == current_user, time_prefix))
+    parts.append("</div><div style='height: 20px;'></div>")
+    return "\n".join(parts)
@@ -0,0 +1,91 @@
+"""
+Message retention.
+
+The retention window is configured in the admin settings:
+
+* ``retention_max_messages``: keep at most this many messages (default 1000)
+* ``retention_max_age_days``: drop messages older than this (0 = off)
+* ``retention_max_mb``: cap the local message store size (0 = off)
+
+``RetentionJob`` applies the window from a background thread every
+``interval`` seconds (``RETENTION_INTERVAL``, default 300), so sends never
+pay for trimming. Each backend removes what falls outside the window,
+Firebase ``/messages`` included, and archives it gzip-compressed under the
+local ``archive`` directory. In Firebase only one process at a time
+compacts (a lease at ``/locks/compaction``), in batches of a few hundred
+messages. ``python manage.py compact-messages`` runs one pass by hand.
+"""
+import logging
+import threading
+import time
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+RETENTION_DEFAULTS = {
+    "retention_max_messages": 1000,
+    "retention_max_age_days": 0,
+    "retention_max_mb": 0,
+}
+
+
+def policy_from_settings(settings):
+    """Turn admin settings into ``compact_global_chat`` keyword arguments."""
+    def setting(key):
+        try:
+            return max(0.0, float(settings.get(key, RETENTION_DEFAULTS[key]) or 0))
+        except (TypeError, ValueError):
+            return float(RETENTION_DEFAULTS[key])
+
+    return {
+        "max_records": int(setting("retention_max_messages")),
+        "max_age": setting("retention_max_age_days") * 86400,
+        "max_bytes": int(setting("retention_max_mb") * 1024 * 1024),
+    }
+
+
+def compact_now():
+    """Apply the current retention settings once; returns the stats dict."""
+    policy = policy_from_settings(storage.load_admin_settings())
+    started = time.perf_counter()
+    removed = storage.compact_global_chat(**policy)
+    return {
+        "removed": removed,
+        "duration_ms": (time.perf_counter() - started) * 1000,
+        "finished_at": time.time(),
+        "policy": policy,
+    }
+
+
+class RetentionJob:
+    def __init__(self, interval=300.0, run=compact_now):
+        self.interval = interval
+        self._run_once = run
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.last_result = None
+        self._thread = threading.Thread(target=self._run, name="chat-retention", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # First pass right away, so a restart applies a lowered limit
+        while True:
+            self.run_now()
+            if self._stop.wait(self.interval):
+                return
+
+    def run_now(self):
+        """Run one compaction pass in the calling thread."""
+        # One pass at a time, whether started by the timer or an admin
+        with self._lock:
+            try:
+                result = self._run_once()
+            except Exception:
+                logger.exception("Message compaction failed")
+                return None
+            self.last_result = result
+            return result
+
+    def stop(self):
+        self._stop.set()
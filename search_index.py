@@ -0,0 +1,334 @@
+"""
+Inverted index for searching the chat history.
+
+Every indexed message gets a document id in send order and keeps its
+position in the message store (local sequence number or Firebase push key),
+which identifies it when the same message is offered again and tells
+retention which documents to drop. The index maps each
+word of the message content to the ascending list of document ids that
+contain it, and each user_id to the documents that user sent, so a query
+only touches the postings of its own words: it walks the shortest list from
+newest to oldest and checks the others by binary search.
+
+Queries are words that must all appear, in any order, plus optional
+``"quoted phrases"`` (consecutive words) and a ``user:<id>`` filter::
+
+    spam link user:alice
+    "buy now"
+
+On disk, under the index directory:
+
+* ``snapshot.json``: documents and postings as of the last checkpoint;
+* ``journal.jsonl``: one line per document indexed since then.
+
+Opening loads the snapshot and replays the journal. Once the journal holds
+``checkpoint_records`` lines, a background thread writes a new snapshot and
+drops the journal lines it covers, so sends never wait for a checkpoint.
+When retention archives messages, ``prune_below(position)`` drops the
+documents stored before that position and their postings. The index is derived data:
+``python manage.py rebuild-search-index`` recreates it from the message
+store.
+"""
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r"\w+")
+USER_FILTER = "user:"
+CHECKPOINT_RECORDS = 10000
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(str(text or "").lower())
+
+
+def parse_query(query):
+    """Split a query into ``(words, phrases, user_id)``."""
+    phrases = [tokenize(p) for p in re.findall(r'"([^"]*)"', query)]
+    words = []
+    user_id = None
+    for word in re.sub(r'"[^"]*"', " ", query).split():
+        if word.lower().startswith(USER_FILTER) and len(word) > len(USER_FILTER):
+            user_id = word[len(USER_FILTER):]
+        else:
+            words.extend(tokenize(word))
+    return words, [p for p in phrases if p], user_id
+
+
+def _contains(postings, doc_id):
+    i = bisect.bisect_left(postings, doc_id)
+    return i < len(postings) and postings[i] == doc_id
+
+
+class SearchIndex:
+    def __init__(self, directory, checkpoint_records=CHECKPOINT_RECORDS):
+        self.directory = directory
+        self.checkpoint_records = checkpoint_records
+        self._lock = threading.Lock()
+        # Held while a snapshot is written; prune() and clear() wait for it
+        self._checkpoint_lock = threading.Lock()
+        # Id of self._docs[0]; ids below it were pruned
+        self._base = 0
+        # doc id - base -> [message_id, user_id, content, timestamp, position]
+        self._docs = []
+        self._postings = {}
+        self._users = {}
+        # Positions of the indexed documents and the highest of them
+        self._positions = set()
+        self.last_position = None
+        self._journal_records = 0
+        self.created = False
+        self._load()
+        self._checkpoint_due = threading.Event()
+        threading.Thread(target=self._checkpoint_worker, name="search-index-checkpoint", daemon=True).start()
+
+    @property
+    def _snapshot_path(self):
+        return os.path.join(self.directory, "snapshot.json")
+
+    @property
+    def _journal_path(self):
+        return os.path.join(self.directory, "journal.jsonl")
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.created = not (os.path.exists(self._snapshot_path) or os.path.exists(self._journal_path))
+        try:
+            with open(self._snapshot_path, "r") as f:
+                snapshot = json.load(f)
+            self._base = snapshot.get("base", 0)
+            self._docs = snapshot["docs"]
+            self._postings = snapshot["postings"]
+            for i, doc in enumerate(self._docs):
+                self._users.setdefault(doc[1], []).append(self._base + i)
+                self._track(doc[4])
+        except (OSError, ValueError, KeyError, IndexError):
+            self._reset()
+        try:
+            with open(self._journal_path, "r") as f:
+                for line in f:
+                    try:
+                        doc_id, doc = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line
+                    # Lines already in the snapshot (crash before truncation)
+                    if doc_id == self._base + len(self._docs):
+                        self._index(doc)
+                        self._journal_records += 1
+        except FileNotFoundError:
+            pass
+        except IndexError:
+            self._reset()
+        if self._docs and len(self._docs[0]) < 5:
+            # Written before documents kept their position: built again
+            self._reset()
+            self.created = True
+
+    def _reset(self):
+        self._base, self._docs, self._postings, self._users = 0, [], {}, {}
+        self._positions = set()
+        self.last_position = None
+
+    def _track(self, position):
+        if position is not None:
+            self._positions.add(position)
+            if self.last_position is None or position > self.last_position:
+                self.last_position = position
+
+    def _index(self, doc):
+        doc_id = self._base + len(self._docs)
+        self._docs.append(doc)
+        for token in set(tokenize(doc[2])):
+            self._postings.setdefault(token, []).append(doc_id)
+        self._users.setdefault(doc[1], []).append(doc_id)
+        self._track(doc[4])
+
+    def _checkpoint_worker(self):
+        while True:
+            self._checkpoint_due.wait()
+            self._checkpoint_due.clear()
+            try:
+                self.checkpoint()
+            except OSError:
+                logger.warning("Search index checkpoint failed", exc_info=True)
+
+    def checkpoint(self):
+        """Write a snapshot of the index and drop the journal lines it covers."""
+        with self._checkpoint_lock:
+            # Only the sizes are taken under the lock; postings lists only
+            # grow while the checkpoint lock is held, so their prefixes are
+            # stable while the snapshot is written
+            with self._lock:
+                base = self._base
+                docs = self._docs[:]
+                lengths = {token: len(ids) for token, ids in self._postings.items()}
+            end = base + len(docs)
+            postings = {token: self._postings[token][:length] for token, length in lengths.items()}
+            tmp_path = self._snapshot_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"base": base, "docs": docs, "postings": postings}, f, separators=(",", ":"))
+            os.replace(tmp_path, self._snapshot_path)
+            with self._lock:
+                kept = []
+                try:
+                    with open(self._journal_path, "r") as f:
+                        for line in f:
+                            try:
+                                if json.loads(line)[0] >= end:
+                                    kept.append(line)
+                            except ValueError:
+                                continue
+                except FileNotFoundError:
+                    pass
+                with open(self._journal_path + ".tmp", "w") as f:
+                    f.writelines(kept)
+                os.replace(self._journal_path + ".tmp", self._journal_path)
+                self._journal_records = len(kept)
+
+    def add(self, messages, positions=None):
+        """
+        Index ``messages`` stored at ``positions`` (by default their ``key``
+        or ``seq``). Messages whose position is already indexed are skipped.
+        """
+        messages = list(messages)
+        if positions is None:
+            positions = [m.get("key", m.get("seq")) for m in messages]
+        with self._lock:
+            docs = []
+            offered = set()
+            for m, position in zip(messages, positions):
+                if position is not None and (position in self._positions or position in offered):
+                    continue
+                offered.add(position)
+                docs.append([m.get("message_id"), m.get("user_id"), m.get("content", ""),
+                             m.get("timestamp"), position])
+            if not docs:
+                return
+            first = self._base + len(self._docs)
+            lines = "".join(
+                json.dumps([first + i, doc], separators=(",", ":")) + "\n" for i, doc in enumerate(docs)
+            )
+            with open(self._journal_path, "a") as f:
+                f.write(lines)
+            for doc in docs:
+                self._index(doc)
+            self._journal_records += len(docs)
+            if self._journal_records >= self.checkpoint_records:
+                self._checkpoint_due.set()
+
+    def search(self, query, user_id=None, limit=50):
+        """Messages matching ``query``, newest first, at most ``limit``."""
+        words, phrases, query_user = parse_query(query)
+        user_id = user_id or query_user
+        with self._lock:
+            lists = []
+            for token in set(words).union(*phrases):
+                postings = self._postings.get(token)
+                if not postings:
+                    return []
+                lists.append(postings)
+            if user_id:
+                postings = self._users.get(user_id)
+                if not postings:
+                    return []
+                lists.append(postings)
+            if not lists:
+                return []
+            lists.sort(key=len)
+
+            results = []
+            for doc_id in reversed(lists[0]):
+                if not all(_contains(postings, doc_id) for postings in lists[1:]):
+                    continue
+                message_id, sender, content, timestamp = self._docs[doc_id - self._base][:4]
+                if phrases:
+                    text = f" {' '.join(tokenize(content))} "
+                    if not all(f" {' '.join(p)} " in text for p in phrases):
+                        continue
+                results.append({
+                    "message_id": message_id,
+                    "user_id": sender,
+                    "content": content,
+                    "timestamp": timestamp,
+                })
+                if len(results) >= limit:
+                    break
+            return results
+
+    def stats(self):
+        with self._lock:
+            return {"messages": len(self._docs), "tokens": len(self._postings)}
+
+    def prune_below(self, position):
+        """
+        Drop the oldest documents stored before ``position`` (they are no
+        longer in the message store); returns how many went.
+        """
+        with self._checkpoint_lock, self._lock:
+            drop = 0
+            for doc in self._docs:
+                if doc[4] is None or doc[4] >= position:
+                    break
+                drop += 1
+            if not drop:
+                return 0
+            base = self._base + drop
+            self._positions.difference_update(doc[4] for doc in self._docs[:drop])
+            self._docs = self._docs[drop:]
+            for table in (self._postings, self._users):
+                for key in list(table):
+                    ids = table[key]
+                    i = bisect.bisect_left(ids, base)
+                    if i == len(ids):
+                        del table[key]
+                    elif i:
+                        table[key] = ids[i:]
+            self._base = base
+        # The journal may still replay pruned ids on top of the old snapshot
+        self._checkpoint_due.set()
+        return drop
+
+    def clear(self):
+        with self._checkpoint_lock, self._lock:
+            self._reset()
+            self._journal_records = 0
+            for path in (self._snapshot_path, self._journal_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def rebuild(self, messages):
+        """Replace the index with ``messages`` (oldest first); returns the count."""
+        self.clear()
+        messages = list(messages)
+        self.add(messages)
+        self.checkpoint()
+        return len(messages)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_search_index(directory, initial=None):
+    """
+    Process-wide index for ``directory``.
+
+    When no index exists there yet (first start with search), it is built
+    from ``initial()``, the messages already stored.
+    """
+    directory = os.path.normpath(directory)
+    with _indexes_lock:
+        index = _indexes.get(directory)
+        if index is None:
+            index = SearchIndex(directory)
+            if index.created and initial is not None:
+                index.rebuild(initial())
+            _indexes[directory] = index
+        return index
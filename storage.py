@@ -0,0 +1,325 @@
+"""
+Persistence for users, chat messages and admin settings.
+
+The functions here delegate to the configured storage backend (see
+backends/__init__.py for STORAGE_BACKEND and friends) and keep the app's
+long-standing contract: storage errors never reach the UI, reads fall back to
+empty defaults. This module has no Streamlit dependency so it can also be
+used from maintenance commands (see manage.py).
+"""
+import threading
+import weakref
+
+from dotenv import load_dotenv
+
+import metrics
+from backends import email_key, empty_stats, get_backend
+
+load_dotenv()
+
+# Default number of messages returned by fetch_global_chat
+CHAT_WINDOW_SIZE = 50
+
+DEFAULT_ADMIN_SETTINGS = {"auto_refresh_interval": 2}  # Default 2 seconds
+
+# Backends whose email index is known to exist in this process
+_email_indexed = weakref.WeakSet()
+_email_index_lock = threading.Lock()
+
+
+@metrics.timed()
+def load_users():
+    try:
+        return get_backend().load_users() or {}
+    except Exception:
+        metrics.record_error()
+        return {}
+
+
+@metrics.timed()
+def save_users(users):
+    try:
+        get_backend().save_users(users)
+    except Exception:
+        metrics.record_error()
+
+
+@metrics.timed()
+def get_user(username):
+    try:
+        return get_backend().get_user(username)
+    except Exception:
+        metrics.record_error()
+        return None
+
+
+@metrics.timed()
+def patch_users(updates, before=None):
+    """
+    Apply a batch of record-level changes with one multi-path PATCH.
+
+    `updates` maps paths relative to /users to new values, e.g.
+    {"alice/status": "banned", "bob": None}; None deletes the path. Only the
+    listed paths are written, so concurrent edits to other users or fields
+    are not overwritten. `before` may hold the current records of touched
+    users the caller already has (see StorageBackend.patch_users).
+    """
+    if not updates:
+        return
+    try:
+        get_backend().patch_users(updates, before)
+    except Exception:
+        metrics.record_error()
+
+
+def create_user(username, user_data):
+    """
+    Store a new user and index their email. Returns False, writing nothing,
+    when ``username`` is already taken.
+    """
+    try:
+        if get_backend().get_user(username) is not None:
+            return False
+    except Exception:
+        metrics.record_error()
+        return False
+    patch_users({username: user_data}, before={username: None})
+    index_user_email(user_data.get("email"), username)
+    return True
+
+
+def patch_user(username, fields):
+    patch_users({f"{username}/{field}": value for field, value in fields.items()})
+
+
+def delete_user(username):
+    delete_users({username: get_user(username)})
+
+
+@metrics.timed()
+def delete_users(users):
+    """
+    Delete ``{username: user_data}`` together with their email index entries.
+    The records are the ones the caller already holds (the admin panel's user
+    directory), so nothing is read back first.
+    """
+    if not users:
+        return
+    try:
+        get_backend().delete_users(users)
+    except Exception:
+        metrics.record_error()
+
+
+@metrics.timed()
+def find_username_by_email(email):
+    """
+    Look up the username registered for `email` with a single keyed read of
+    the email index. Data from before the index existed is indexed once, on
+    the first email lookup or write of the process.
+    """
+    if not email:
+        return None
+    try:
+        ensure_email_index()
+        return get_backend().lookup_email(email)
+    except Exception:
+        metrics.record_error()
+        return None
+
+
+@metrics.timed()
+def index_user_email(email, username):
+    if not email:
+        return
+    try:
+        # Built first, so users stored before the index are not left out
+        ensure_email_index()
+        get_backend().index_email(email, username)
+    except Exception:
+        metrics.record_error()
+
+
+@metrics.timed()
+def unindex_user_email(email):
+    if not email:
+        return
+    try:
+        get_backend().unindex_email(email)
+    except Exception:
+        metrics.record_error()
+
+
+def ensure_email_index():
+    """Build the email index from the users tree if it was never built."""
+    backend = get_backend()
+    if backend in _email_indexed:
+        return
+    with _email_index_lock:
+        if backend in _email_indexed:
+            return
+        exists = backend.has_email_index()
+        if exists is None:
+            # Storage unreachable: checked again on the next call
+            return
+        if not exists:
+            rebuild_email_index()
+        _email_indexed.add(backend)
+
+
+@metrics.timed()
+def rebuild_email_index():
+    """Recreate the email index from the users tree; returns the entry count."""
+    index = {}
+    for username, user_data in load_users().items():
+        email = user_data.get("email")
+        if email:
+            index[email_key(email)] = username
+    try:
+        get_backend().replace_email_index(index)
+    except Exception:
+        metrics.record_error()
+    return len(index)
+
+
+@metrics.timed()
+def load_admin_settings():
+    try:
+        settings = get_backend().load_settings()
+    except Exception:
+        metrics.record_error()
+        settings = None
+    return settings if settings else dict(DEFAULT_ADMIN_SETTINGS)
+
+
+@metrics.timed()
+def save_admin_settings(settings):
+    try:
+        get_backend().save_settings(settings)
+    except Exception:
+        metrics.record_error()
+
+
+def save_global_chat_message(message):
+    save_global_chat_messages([message])
+
+
+@metrics.timed()
+def append_global_chat_messages(messages):
+    """
+    Store a batch of messages; Firebase writes it with one multi-path PATCH.
+    Unlike the other functions here, storage errors are raised, so the
+    write-behind queue can retry and count failed batches.
+    """
+    if not messages:
+        return
+    try:
+        get_backend().append_messages(messages)
+    except Exception:
+        metrics.record_error()
+        raise
+
+
+def save_global_chat_messages(messages):
+    try:
+        append_global_chat_messages(messages)
+    except Exception:
+        pass
+
+
+@metrics.timed()
+def fetch_global_chat(cursor=None, limit=CHAT_WINDOW_SIZE):
+    """
+    Incrementally fetch messages newer than `cursor`.
+
+    Without a cursor only the newest `limit` messages are fetched. The returned
+    cursor is the Firebase push key (or local sequence number) of the newest
+    message and should be passed back on the next poll. When `reset` is True
+    the caller must replace its window instead of appending to it.
+    """
+    try:
+        return get_backend().fetch_messages(cursor, limit)
+    except Exception:
+        metrics.record_error()
+        return {"messages": [], "cursor": cursor, "reset": False}
+
+
+@metrics.timed()
+def fetch_global_chat_before(cursor, limit=CHAT_WINDOW_SIZE):
+    """
+    Fetch the page of up to `limit` messages sent before the message at
+    `cursor` (see `message_cursor`), for "load older" paging. The returned
+    cursor fetches the page before that one; `more` is False at the start of
+    the history.
+    """
+    try:
+        return get_backend().fetch_messages_before(cursor, limit)
+    except Exception:
+        metrics.record_error()
+        return {"messages": [], "cursor": cursor, "more": False}
+
+
+def message_cursor(message):
+    """Paging cursor of a fetched message (push key or sequence number), or None."""
+    return message.get("key", message.get("seq"))
+
+
+@metrics.timed()
+def search_global_chat(query, user_id=None, limit=CHAT_WINDOW_SIZE):
+    """Messages matching a search query, newest first (see search_index.py)."""
+    try:
+        return get_backend().search_messages(query, user_id, limit)
+    except Exception:
+        metrics.record_error()
+        return []
+
+
+@metrics.timed()
+def rebuild_search_index():
+    """Recreate the message search index from the stored messages."""
+    try:
+        return get_backend().rebuild_search_index()
+    except Exception:
+        metrics.record_error()
+        return 0
+
+
+@metrics.timed()
+def load_stats():
+    """
+    Maintained counters: messages, users, banned users and messages per
+    user_id. Reading them does not touch the messages or users themselves.
+    """
+    try:
+        return get_backend().load_stats() or empty_stats()
+    except Exception:
+        metrics.record_error()
+        return empty_stats()
+
+
+@metrics.timed()
+def recount_stats():
+    """Recompute the counters from the stored data (repairs drift)."""
+    try:
+        return get_backend().recount_stats()
+    except Exception:
+        metrics.record_error()
+        return empty_stats()
+
+
+@metrics.timed()
+def compact_global_chat(max_records=0, max_age=0, max_bytes=0):
+    """Drop and archive messages outside the retention window (see retention.py)."""
+    try:
+        return get_backend().compact_messages(max_records, max_age, max_bytes)
+    except Exception:
+        metrics.record_error()
+        return 0
+
+
+@metrics.timed()
+def clear_global_chat():
+    try:
+        get_backend().clear_messages()
+    except Exception:
+        metrics.record_error()
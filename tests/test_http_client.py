@@ -0,0 +1,47 @@
+"""Connection reuse through the pooled sessions of http_client."""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import http_client  # noqa: E402
+from firebase_emulator import FirebaseEmulator  # noqa: E402
+
+
+@pytest.fixture
+def emulator():
+    server = FirebaseEmulator()
+    server.start()
+    http_client.close_all()
+    http_client.reset_connection_stats()
+    yield server
+    http_client.close_all()
+    server.stop()
+
+
+def opened():
+    return sum(http_client.connection_stats().values())
+
+
+def test_sequential_requests_reuse_one_connection(emulator):
+    http_client.put(f"{emulator.url}/items/a.json", json={"n": 1})
+    for _ in range(50):
+        response = http_client.get(f"{emulator.url}/items.json")
+        assert response.status_code == 200
+    assert opened() == 1
+
+
+def test_concurrent_requests_stay_within_the_pool(emulator):
+    def fetch(_):
+        return http_client.get(f"{emulator.url}/items.json").status_code
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert set(pool.map(fetch, range(200))) == {200}
+    assert 1 <= opened() <= 8
+
+
+def test_sessions_are_shared_per_host(emulator):
+    assert http_client.get_session(f"{emulator.url}/a.json") is http_client.get_session(f"{emulator.url}/b.json")
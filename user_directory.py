@@ -0,0 +1,126 @@
+"""
+Sorted in-memory indexes over the users tree for the admin user list.
+
+One instance is shared by every session of the process (see
+``get_user_directory`` in app.py). It keeps, per field, a sorted list of
+``(key, username)`` pairs:
+
+* ``username``, ``name`` and ``email`` (lower-cased) for prefix search,
+  answered with a binary search plus a walk over the matching range;
+* ``created_at`` and ``status`` for the sort orders of the list.
+
+``page()`` slices a sort order directly when there is no search, so a page
+costs O(page size) whatever the number of users; with a search it costs
+O(matches). Writes made through ``apply()`` update the indexes in place;
+writes from other processes are picked up by a full reload every ``ttl``
+seconds.
+"""
+import bisect
+import threading
+import time
+
+from backends import apply_path_updates
+
+SEARCH_FIELDS = ("username", "name", "email")
+SORT_FIELDS = ("created_at", "status", "username")
+
+
+def _field(username, user_data, field):
+    if field == "username":
+        return username.lower()
+    value = user_data.get(field)
+    if field == "status":
+        value = value or "active"
+    return str(value or "").lower()
+
+
+class UserDirectory:
+    def __init__(self, load, ttl=30.0):
+        # load() -> {username: user_data}
+        self._load = load
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._users = {}
+        self._indexes = {}
+        self._loaded_at = None
+
+    def _rebuild(self, users):
+        self._users = dict(users)
+        self._indexes = {
+            field: sorted((_field(u, d, field), u) for u, d in self._users.items())
+            for field in set(SEARCH_FIELDS + SORT_FIELDS)
+        }
+
+    def _unindex(self, username):
+        user_data = self._users.pop(username, None)
+        if user_data is None:
+            return
+        for field, index in self._indexes.items():
+            i = bisect.bisect_left(index, (_field(username, user_data, field), username))
+            if i < len(index) and index[i][1] == username:
+                del index[i]
+
+    def _index(self, username, user_data):
+        self._users[username] = user_data
+        for field, index in self._indexes.items():
+            bisect.insort(index, (_field(username, user_data, field), username))
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if force or self._loaded_at is None or now - self._loaded_at >= self.ttl:
+                self._rebuild(self._load())
+                self._loaded_at = now
+
+    def apply(self, updates):
+        """Mirror a ``patch_users`` call, e.g. ``{"alice/status": "banned", "bob": None}``."""
+        with self._lock:
+            touched = {path.strip("/").partition("/")[0] for path in updates}
+            current = {u: dict(self._users[u]) for u in touched if u in self._users}
+            updated = apply_path_updates(current, updates)
+            for username in touched:
+                self._unindex(username)
+                user_data = updated.get(username)
+                if isinstance(user_data, dict):
+                    self._index(username, user_data)
+
+    def _matches(self, query):
+        prefix = query.strip().lower()
+        found = set()
+        for field in SEARCH_FIELDS:
+            index = self._indexes[field]
+            i = bisect.bisect_left(index, (prefix,))
+            while i < len(index) and index[i][0].startswith(prefix):
+                found.add(index[i][1])
+                i += 1
+        return found
+
+    def page(self, query="", sort="created_at", descending=False, offset=0, limit=25):
+        """
+        Return ``(users, total)``: one page of ``(username, user_data)`` pairs
+        ordered by ``sort`` and the number of users matching ``query`` (a
+        prefix of the username, name or email; empty matches everyone).
+        """
+        self.refresh()
+        with self._lock:
+            order = self._indexes[sort]
+            if query.strip():
+                matches = self._matches(query)
+                keys = sorted((_field(u, self._users[u], sort), u) for u in matches)
+            else:
+                keys = order
+            total = len(keys)
+            if descending:
+                end = max(0, total - offset)
+                selected = keys[max(0, end - limit):end][::-1]
+            else:
+                selected = keys[offset:offset + limit]
+            return [(u, self._users[u]) for _, u in selected], total
+
+    def get(self, username):
+        with self._lock:
+            return self._users.get(username)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._users)
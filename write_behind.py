@@ -0,0 +1,128 @@
+"""
+Write-behind queue for chat sends.
+
+``submit`` only puts the message into a bounded in-memory queue, so the
+sender's rerun does not wait for the network. A worker thread takes whatever
+has accumulated (up to ``batch_size`` items) and hands it to the ``flush``
+callable in one call, which lets storage write a whole batch with a single
+request. ``flush`` must raise when the write fails: the batch is then tried
+again up to ``retries`` times, ``retry_delay`` seconds apart, and finally
+logged and counted as failed.
+
+When the queue is full ``submit`` blocks for up to ``put_timeout`` seconds
+(backpressure) and then returns False so the caller can write synchronously
+instead. ``close`` drains the queue before stopping the worker and is
+registered with ``atexit`` by the owner.
+"""
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    def __init__(self, flush, max_size=1000, batch_size=100, put_timeout=2.0,
+                 retries=2, retry_delay=0.5):
+        self._flush = flush
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "flushed": 0,
+            "failed": 0,
+            "retries": 0,
+            "batches": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="chat-write-behind", daemon=True)
+        self._worker.start()
+
+    def submit(self, item):
+        """Queue ``item``; returns False if the queue stayed full or is closed."""
+        if self._closed:
+            return False
+        try:
+            self._queue.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats["rejected"] += 1
+            return False
+        with self._stats_lock:
+            self._stats["submitted"] += 1
+        return True
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            items = [item for item in batch if item is not None]
+            if items:
+                self._flush_batch(items)
+            for _ in batch:
+                self._queue.task_done()
+            if len(items) != len(batch):
+                # None is the stop sentinel queued by close()
+                return
+
+    def _flush_batch(self, items):
+        started = time.perf_counter()
+        failed = False
+        for attempt in range(self.retries + 1):
+            try:
+                self._flush(items)
+                break
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception("Write-behind flush of %d item(s) failed; dropping them: %r",
+                                     len(items), items)
+                    failed = True
+                    break
+                with self._stats_lock:
+                    self._stats["retries"] += 1
+                time.sleep(self.retry_delay)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["failed" if failed else "flushed"] += len(items)
+            self._stats["last_flush_ms"] = elapsed_ms
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], elapsed_ms)
+            self._stats["total_flush_ms"] += elapsed_ms
+
+    def drain(self):
+        """Block until every item submitted so far has been flushed."""
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def metrics(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["depth"] = self._queue.qsize()
+        batches = stats.pop("batches")
+        total_ms = stats.pop("total_flush_ms")
+        stats["batches"] = batches
+        stats["avg_flush_ms"] = total_ms / batches if batches else 0.0
+        return stats